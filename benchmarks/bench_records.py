@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Memory used by the flagged signatures of a report run
+
+Collects synthetic results for a number of users, first as the dicts of
+signature and SigError list that report runs used to keep, then as
+SigRecords. For each, tracemalloc gives the memory held while the run goes
+on, and the peak including the serialization at the end of the run.
+
+    python3 benchmarks/bench_records.py [--users N]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Tuple
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+from datatypes import SigError, SigRecords  # noqa: E402
+
+# Common combinations of errors, cycled through for the synthetic users
+ERRORS = [
+    [SigError.NO_USER_LINKS],
+    [SigError.MISSING_END_TAG],
+    [SigError.OBSOLETE_FONT_TAG, SigError.MISSING_END_TAG],
+    [SigError.SIG_TOO_LONG, SigError.NO_USER_LINKS],
+    [SigError.LINK_USER_MISMATCH],
+]
+
+
+def results(users: int):
+    for i in range(users):
+        user = f"Example{i}"
+        yield user, f"[[User:{user}|<font color=red>{user}</font>]]", ERRORS[i % 5]
+
+
+def collect_dicts(users: int) -> Dict[str, Dict]:
+    resultdata: Dict[str, Dict] = {}
+    for user, sig, errors in results(users):
+        resultdata[user] = {"signature": sig, "errors": list(errors)}
+    return resultdata
+
+
+def serialize_dicts(resultdata: Dict[str, Dict]) -> Dict:
+    stats: Dict[str, int] = {"total": len(resultdata)}
+    for user, line in resultdata.items():
+        line["errors"] = [error.value for error in line["errors"]]
+        for error in line["errors"]:
+            stats[error] = stats.get(error, 0) + 1
+    return {
+        "errors": stats,
+        "sigs": {key: resultdata[key] for key in sorted(resultdata)},
+    }
+
+
+def collect_records(users: int) -> SigRecords:
+    resultdata = SigRecords()
+    for user, sig, errors in results(users):
+        resultdata.add(user, sig, errors)
+    return resultdata
+
+
+def serialize_records(resultdata: SigRecords) -> Dict:
+    stats = resultdata.stats()
+    return {"errors": stats, "sigs": resultdata.export(clear=True)}
+
+
+LAYOUTS: Dict[str, Tuple[Callable[[int], Any], Callable[[Any], Dict]]] = {
+    "dicts": (collect_dicts, serialize_dicts),
+    "records": (collect_records, serialize_records),
+}
+
+
+def measure(layout: str, users: int) -> Tuple[float, float, float]:
+    """Memory held during the run and peak memory in MiB, and seconds taken
+
+    The seconds are timed without tracing, which slows allocation down.
+    """
+    collect, serialize = LAYOUTS[layout]
+    tracemalloc.start()
+    data = collect(users)
+    held = tracemalloc.get_traced_memory()[0]
+    serialize(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del data
+
+    start = time.perf_counter()
+    serialize(collect(users))
+    return held / 2**20, peak / 2**20, time.perf_counter() - start
+
+
+def run(users: int) -> None:
+    print(f"{users} flagged users")
+    print(f"{'Layout':<8} {'held':>10} {'peak':>10} {'time':>8}")
+    for layout in LAYOUTS:
+        held, peak, elapsed = measure(layout, users)
+        print(f"{layout:<8} {held:>7.1f}MiB {peak:>7.1f}MiB {elapsed:>7.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200000)
+    run(parser.parse_args().users)
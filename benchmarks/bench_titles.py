@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Microbenchmarks for link title classification
+
+Times TitleMatcher.classify, compare_links and check_images on the link
+shapes covered by tests/test_sigprobs.py, including usernames with colons,
+using offline site data for the English and German Wikipedias.
+
+    python3 benchmarks/bench_titles.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+import sigprobs  # noqa: E402
+from datatypes import SiteData  # noqa: E402
+
+SITES = {
+    "en": SiteData(
+        user=frozenset({"User"}),
+        user_talk=frozenset({"User_talk"}),
+        file=frozenset({"File", "Image"}),
+        special=frozenset({"Special"}),
+        contribs=frozenset({"Contributions", "Contribs"}),
+        subst=("subst:", "SUBST:", "Subst:"),
+        dbname="enwiki",
+        hostname="en.wikipedia.org",
+    ),
+    "de": SiteData(
+        user=frozenset({"User", "Benutzer", "Benutzerin"}),
+        user_talk=frozenset(
+            {"User_talk", "Benutzer_diskussion", "Benutzerin_diskussion"}
+        ),
+        file=frozenset({"File", "Image", "Datei", "Bild"}),
+        special=frozenset({"Special", "Spezial"}),
+        contribs=frozenset({"Contributions", "Beiträge"}),
+        subst=("ers:", "subst:", "ERS:", "SUBST:", "Ers:", "Subst:"),
+        dbname="dewiki",
+        hostname="de.wikipedia.org",
+    ),
+}
+
+# (user, signature), with {user}, {talk}, {contribs} and {file} filled in
+CASES = {
+    "user": ("Example", "[[{user}:Example|Example]] ([[{talk}:Example|talk]])"),
+    "contribs": ("Example", "[[{contribs}/Example]]"),
+    "mismatch": ("Example", "[[{user}:Example2|Example]]"),
+    "interwiki": ("Example", "[[meta:{user}:Example|Example]]"),
+    "section": ("Example", "[[{user}:Example#section|Example]]"),
+    "many-links": ("Example", "[[Foo]] [[meta:foo/bar]] [[Bar]] [[{user}:Example]]"),
+    "colon-user": ("(:Example:)", "[[{user}:(:Example:)|(:Example:)]]"),
+    "colon-contribs": ("(:Example:)", "[[{contribs}/(:Example:)]]"),
+    "colon-interwiki": ("(:Example:)", "[[meta:{user}:(:Example:)]]"),
+    "colon-escaped": ("(:Example:)", "[[Foo]] [[:{user}:(:Example:)]]"),
+    "image": ("Example", "[[{user}:Example]] [[{file}:Example.jpg]]"),
+}
+
+NAMES = {
+    "en": dict(user="User", talk="User talk", contribs="Special:Contribs", file="File"),
+    "de": dict(
+        user="Benutzerin",
+        talk="Benutzerin Diskussion",
+        contribs="Spezial:Beiträge",
+        file="Datei",
+    ),
+}
+
+
+def run(number: int) -> None:
+    print(f"{'Site':<4} {'Case':<16} {'classify':>10} {'links':>10} {'images':>10}")
+    for site, sitedata in SITES.items():
+        matcher = sitedata.titles
+        for case, (user, sig) in CASES.items():
+            sig = sig.format(**NAMES[site])
+            titles = [
+                str(link.title) for link in sigprobs.mwph.parse(sig).ifilter_wikilinks()
+            ]
+            timings = [
+                timeit.timeit(
+                    lambda: [matcher.classify(title) for title in titles],
+                    number=number,
+                ),
+                timeit.timeit(
+                    lambda: sigprobs.compare_links(user, sitedata, sig), number=number
+                ),
+                timeit.timeit(
+                    lambda: sigprobs.check_images(sig, sitedata), number=number
+                ),
+            ]
+            print(
+                f"{site:<4} {case:<16} "
+                + " ".join(f"{t / number * 1e6:>8.2f}µs" for t in timings)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=2000)
+    run(parser.parse_args().number)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Import time of the webservice
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter and prints
+the slowest of the modules imported directly by app, by cumulative time.
+With --save, the result is written to benchmarks/importtime.json, which is
+tracked so changes to startup time show up in review.
+
+    python3 benchmarks/importtime.py [--top N] [--save]
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, NamedTuple
+
+SRC = os.path.realpath(os.path.dirname(__file__) + "/../src")
+SNAPSHOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "importtime.json")
+# Modules the webservice only imports once a signature is checked
+LAZY = ("sigprobs", "mwparserfromhell")
+
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+class Import(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse(stderr: str) -> List[Import]:
+    imports = []
+    for line in stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append(
+                Import(module, int(self_us), int(cumulative_us), len(indent) // 2)
+            )
+    return imports
+
+
+def measure(module: str = "app") -> List[Import]:
+    # app logs to app.log in the working directory, so run it somewhere else
+    with tempfile.TemporaryDirectory() as tmp:
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=tmp,
+            env={**os.environ, "PYTHONPATH": SRC},
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+    return parse(proc.stderr)
+
+
+class Summary(NamedTuple):
+    total_us: int
+    modules: int
+    top: Dict[str, int]
+    lazy_loaded: List[str]
+
+
+def summarize(imports: List[Import], top: int, module: str = "app") -> Summary:
+    # Children are listed before the module that imported them
+    children: List[Import] = []
+    start = 0
+    for index, imp in enumerate(imports):
+        if imp.depth == 0:
+            if imp.module == module:
+                break
+            children = []
+            start = index + 1
+        elif imp.depth == 1:
+            children.append(imp)
+    else:
+        raise ValueError(f"{module} was not imported")
+    children.sort(key=lambda imp: imp.cumulative_us, reverse=True)
+    loaded = {imp.module for imp in imports[start:index]}
+    return Summary(
+        total_us=imp.cumulative_us,
+        modules=index - start + 1,
+        top={child.module: child.cumulative_us for child in children[:top]},
+        lazy_loaded=[module for module in LAZY if module in loaded],
+    )
+
+
+def main(argv: List[str] = sys.argv[1:]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--save", action="store_true", help="Update the snapshot")
+    args = parser.parse_args(argv)
+
+    summary = summarize(measure(), args.top)
+    print(f"import app: {summary.total_us / 1000:.1f} ms, {summary.modules} modules")
+    for module, cumulative in summary.top.items():
+        print(f"{cumulative / 1000:10.1f} ms  {module}")
+    if summary.lazy_loaded:
+        print(f"Imported at startup: {', '.join(summary.lazy_loaded)}")
+    if args.save:
+        with open(SNAPSHOT, "w") as f:
+            json.dump(summary._asdict(), f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,54 +3,150 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 # Copyright 2020 AntiCompositeNumber
 
+"""Start a report run as a Kubernetes Job
+
+Arguments not listed in --help are passed to sigprobs.py. With --shards N,
+N jobs each check part of the users, and another job merges their results
+into the report once they are all written. With --local, the shards are run
+as subprocesses instead.
+"""
+
+import argparse
+import os
 import subprocess
 import json
 import sys
+import time
+from typing import Any, Dict, List, Optional
 
-config = {
-    "apiVersion": "batch/v1",
-    "kind": "Job",
-    "metadata": {
-        "name": "signatures.sigprobs",
-        "namespace": "tool-signatures",
-        "labels": {"name": "signatures.sigprobs", "toolforge": "tool"},
-    },
-    "spec": {
-        "ttlSecondsAfterFinished": 86400,  # 1 day
-        "backoffLimit": 2,
-        "template": {
-            "metadata": {
-                "labels": {"name": "signatures.sigprobs", "toolforge": "tool"},
-            },
-            "spec": {
-                "containers": [
-                    {
-                        "name": "sigprobs",
-                        "image": (
-                            "docker-registry.tools.wmflabs.org/"
-                            "toolforge-python39-sssd-base:latest"
-                        ),
-                        "command": [
-                            "/data/project/signatures/signatures/venv/bin/python3",
-                            "/data/project/signatures/signatures/src/sigprobs.py",
-                        ],
-                        "args": sys.argv[1:],
-                        "workingDir": "/data/project/signatures",
-                        "env": [{"name": "HOME", "value": "/data/project/signatures"}],
-                        "imagePullPolicy": "Always",
-                    }
-                ],
-                "restartPolicy": "Never",
+PYTHON = "/data/project/signatures/signatures/venv/bin/python3"
+SIGPROBS = "/data/project/signatures/signatures/src/sigprobs.py"
+LOCAL_SIGPROBS = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "src", "sigprobs.py"
+)
+# Seconds the merge job waits for the shard jobs to finish
+MERGE_WAIT = 86400
+
+
+def job_config(name: str, args: List[str]) -> Dict[str, Any]:
+    return {
+        "apiVersion": "batch/v1",
+        "kind": "Job",
+        "metadata": {
+            "name": name,
+            "namespace": "tool-signatures",
+            "labels": {"name": name, "toolforge": "tool"},
+        },
+        "spec": {
+            "ttlSecondsAfterFinished": 86400,  # 1 day
+            "backoffLimit": 2,
+            "template": {
+                "metadata": {
+                    "labels": {"name": name, "toolforge": "tool"},
+                },
+                "spec": {
+                    "containers": [
+                        {
+                            "name": "sigprobs",
+                            "image": (
+                                "docker-registry.tools.wmflabs.org/"
+                                "toolforge-python39-sssd-base:latest"
+                            ),
+                            "command": [PYTHON, SIGPROBS],
+                            "args": args,
+                            "workingDir": "/data/project/signatures",
+                            "env": [
+                                {"name": "HOME", "value": "/data/project/signatures"}
+                            ],
+                            "imagePullPolicy": "Always",
+                        }
+                    ],
+                    "restartPolicy": "Never",
+                },
             },
         },
-    },
-}
-p = subprocess.run(
-    ["kubectl", "apply", "--validate=true", "-f", "-"],
-    input=json.dumps(config),
-    stdout=subprocess.PIPE,
-    stderr=subprocess.STDOUT,
-    universal_newlines=True,
-)
-print(p.stdout)
-sys.exit(p.returncode)
+    }
+
+
+def shard_args(args: List[str], index: int, shards: int, run_id: str) -> List[str]:
+    return [*args, "--shard", f"{index}/{shards}", "--run-id", run_id]
+
+
+def merge_args(args: List[str], shards: int, run_id: str) -> List[str]:
+    return [*args, "--merge", str(shards), "--run-id", run_id]
+
+
+def apply(config: Dict[str, Any]) -> int:
+    p = subprocess.run(
+        ["kubectl", "apply", "--validate=true", "-f", "-"],
+        input=json.dumps(config),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    print(p.stdout)
+    return p.returncode
+
+
+def start_jobs(args: List[str], shards: int, run_id: str) -> int:
+    """Start the report run, sharded if shards is more than 1"""
+    if shards == 1:
+        return apply(job_config("signatures.sigprobs", args))
+    for index in range(shards):
+        returncode = apply(
+            job_config(
+                f"signatures.sigprobs-{run_id}-{index}",
+                shard_args(args, index, shards, run_id),
+            )
+        )
+        if returncode:
+            return returncode
+    return apply(
+        job_config(
+            f"signatures.sigprobs-{run_id}-merge",
+            merge_args(args, shards, run_id) + ["--wait", str(MERGE_WAIT)],
+        )
+    )
+
+
+def run_local(
+    args: List[str], shards: int, run_id: str, command: Optional[List[str]] = None
+) -> int:
+    """Run the shards as concurrent subprocesses, then merge their results"""
+    if command is None:
+        command = [sys.executable, LOCAL_SIGPROBS]
+    if shards == 1:
+        return subprocess.run(command + args).returncode
+    procs = [
+        subprocess.Popen(command + shard_args(args, index, shards, run_id))
+        for index in range(shards)
+    ]
+    returncodes = [proc.wait() for proc in procs]
+    if any(returncodes):
+        print(f"Shards failed with exit codes {returncodes}", file=sys.stderr)
+        return max(returncodes)
+    return subprocess.run(command + merge_args(args, shards, run_id)).returncode
+
+
+def main(argv: List[str] = sys.argv[1:]) -> int:
+    parser = argparse.ArgumentParser(allow_abbrev=False, description=__doc__)
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of jobs to split each report run into (at most 100)",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Run as subprocesses on this host instead of as Kubernetes Jobs",
+    )
+    options, args = parser.parse_known_args(argv)
+    run_id = str(int(time.time()))
+    if options.local:
+        return run_local(args, options.shards, run_id)
+    return start_jobs(args, options.shards, run_id)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
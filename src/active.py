@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Users active on a site's discussion pages, kept between report runs
+
+Finding the users who edited a discussion page in the last N days means
+scanning N days of revisions on the replicas. In delta mode, each run only
+scans the revisions since the previous run, and merges the editors it finds
+into the set kept here, with the time of their last edit, so users whose
+last edit is too old can be dropped.
+"""
+
+import sqlite3
+from typing import Iterable, List, Tuple
+
+ACTIVE_SUFFIX = ".active.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_name TEXT PRIMARY KEY,
+    last_edit TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS users_last_edit ON users (last_edit);
+"""
+
+
+class ActiveUsers:
+    """Usernames with the MediaWiki timestamp of their last counted edit"""
+
+    def __init__(self, path: str) -> None:
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        return count
+
+    def update(self, edits: Iterable[Tuple[str, str]]) -> None:
+        """Record (user, timestamp) edits, keeping each user's latest"""
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT INTO users (user_name, last_edit) VALUES (?, ?) "
+                "ON CONFLICT (user_name) DO UPDATE SET "
+                "last_edit = max(last_edit, excluded.last_edit)",
+                edits,
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def expire(self, cutoff: str) -> int:
+        """Drop users whose last edit is not after cutoff"""
+        return self.conn.execute(
+            "DELETE FROM users WHERE last_edit <= ?", (cutoff,)
+        ).rowcount
+
+    def users(self) -> List[str]:
+        return [
+            user
+            for (user,) in self.conn.execute(
+                "SELECT user_name FROM users ORDER BY user_name"
+            )
+        ]
+
+    def high_water_mark(self) -> str:
+        """Timestamp of the latest recorded edit, or "" if there are none"""
+        (latest,) = self.conn.execute("SELECT MAX(last_edit) FROM users").fetchone()
+        return latest or ""
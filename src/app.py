@@ -7,7 +7,6 @@ import flask
 from flask_babel import gettext, ngettext, format_datetime  # type: ignore  # noqa: F401
 import flask_babel  # type: ignore
 import os
-import subprocess
 import logging
 import json
 
@@ -20,6 +19,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Short hash of the deployed git commit, written by deploy.py and upgrade.sh
+VERSION_FILE = os.path.realpath(os.path.join(os.path.dirname(__file__), "../VERSION"))
+
+
+def get_version(filename: str = VERSION_FILE) -> str:
+    try:
+        with open(filename) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
 
 def create_app():
     # Load Flask config
@@ -36,13 +46,7 @@ def create_app():
         "data_dir", os.path.realpath(os.path.join(os.path.dirname(__file__), "../data"))
     )
     # Put the short hash of the current git commit in the config
-    rev = subprocess.run(
-        ["git", "rev-parse", "--short", "HEAD"],
-        universal_newlines=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    app.config["version"] = rev.stdout
+    app.config["version"] = get_version()
     app.config["SWAGGER_UI_DOC_EXPANSION"] = "list"
     # Setup i18n extensions
     app.jinja_env.add_extension("jinja2.ext.i18n")
@@ -78,8 +82,12 @@ def create_app():
         )
 
     from web import frontend, api
+    import datasources
     import deploy
 
+    # HTTP transport settings for requests to the wikis, applied on first use
+    datasources.configure_transport(app.config.get("http"))
+
     app.register_blueprint(frontend.bp)
     app.register_blueprint(api.bp)
     app.register_blueprint(deploy.bp)
@@ -7,12 +7,17 @@ from datatypes import SiteData
 from . import api, db
 from .api import *  # noqa: F403, F401
 from .db import *  # noqa: F403, F401
-from typing import Union
-from mwparserfromhell.string_mixin import StringMixIn
+from .stream import *  # noqa: F403, F401
+from typing import List, Set, Union, TYPE_CHECKING
 import pymysql
 
+if TYPE_CHECKING:
+    # Only for annotations: mwparserfromhell is slow to import, and the
+    # webservice only needs it once a signature is checked
+    from mwparserfromhell.string_mixin import StringMixIn
 
-def normal_name(name: Union[str, StringMixIn]) -> str:
+
+def normal_name(name: Union[str, "StringMixIn"]) -> str:
     """Make first letter uppercase and replace spaces with underscores"""
     if name == "":
         return ""
@@ -32,6 +37,18 @@ def check_user_exists(user: str, sitedata: SiteData) -> bool:
     return result
 
 
+def check_users_exist(users: List[str], sitedata: SiteData) -> Set[str]:
+    """Check which of a list of users exist on the given wiki.
+
+    Uses database if available, falling back to the API if not.
+    """
+    try:
+        result = db._check_users_exist(users, sitedata.dbname)
+    except (ConnectionError, pymysql.err.OperationalError):
+        result = api._check_users_exist(users, sitedata.hostname)
+    return result
+
+
 def get_sitematrix():
     """Get list of domains for Wikimedia site matrix
 
@@ -4,38 +4,340 @@
 # Copyright 2020 AntiCompositeNumber
 
 import requests
+import requests.adapters
 import toolforge
 import itertools
+import gzip
 import logging
+import random
+import socket
+import threading
 import time
+import email.utils
+import urllib.parse
+from urllib3.connection import HTTPConnection
 from datatypes import SiteData
-from typing import Dict, Set, Iterator
+from typing import Any, Dict, List, Optional, Set, Iterator
 import datasources
 
 
-session = requests.Session()
+class TransportSession(requests.Session):
+    """Session that mounts the configured transport adapter on first use"""
+
+    def get_adapter(self, url: str) -> requests.adapters.BaseAdapter:
+        _mount_transport()
+        return super().get_adapter(url)
+
+
+session = TransportSession()
 session.headers.update(
     {"User-Agent": "sigprobs " + toolforge.set_user_agent("signatures")}
 )
 
 logger = logging.getLogger(__name__)
 
+# Transport settings, which can be overridden in the "http" section of the
+# configuration. Responses are always requested and decoded with gzip.
+TRANSPORT_DEFAULTS: Dict[str, Any] = {
+    # Number of hosts to keep connection pools for
+    "pool_connections": 10,
+    # Connections kept open to each host, so concurrent requests don't
+    # have to reconnect
+    "pool_maxsize": 20,
+    # Wait for a free connection instead of opening one past pool_maxsize
+    "pool_block": False,
+    "connect_timeout": 10.0,
+    "read_timeout": 60.0,
+    # Reuse connections, and send TCP keep-alive probes after this many
+    # seconds idle so dead connections are noticed
+    "keep_alive": True,
+    "keep_alive_idle": 60,
+    # Compress request bodies of at least gzip_min_size bytes. Only enable
+    # this for servers that accept gzip-encoded requests.
+    "gzip_requests": False,
+    "gzip_min_size": 4096,
+    # Count requests and bytes sent and received for each host
+    "account_sizes": False,
+    # Requests per second to each host, shared by every caller in this
+    # process, and how many may be made at once after an idle period
+    "rate_limit": 10.0,
+    "rate_burst": 10,
+}
+
+_transfer_stats: Dict[str, Dict[str, int]] = {}
+_transfer_lock = threading.Lock()
+# Settings for the adapter to mount before the session's next request, set by
+# configure_transport, as creating the connection pools slows down imports
+_adapter_options: Optional[Dict[str, Any]] = None
+_adapter_lock = threading.Lock()
+
+
+class TransportAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter applying the configured pool, timeout and gzip settings"""
+
+    def __init__(self, options: Dict[str, Any]) -> None:
+        # Set before initializing, since that creates the pool manager
+        self.options = options
+        super().__init__(
+            pool_connections=options["pool_connections"],
+            pool_maxsize=options["pool_maxsize"],
+            pool_block=options["pool_block"],
+        )
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        socket_options = list(HTTPConnection.default_socket_options)
+        if self.options["keep_alive"]:
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                socket_options.append(
+                    (
+                        socket.IPPROTO_TCP,
+                        socket.TCP_KEEPIDLE,
+                        self.options["keep_alive_idle"],
+                    )
+                )
+        kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (self.options["connect_timeout"], self.options["read_timeout"])
+        body = request.body
+        if (
+            self.options["gzip_requests"]
+            and body
+            and len(body) >= self.options["gzip_min_size"]
+            and "Content-Encoding" not in request.headers
+        ):
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            request.body = gzip.compress(body)
+            request.headers["Content-Encoding"] = "gzip"
+            request.headers["Content-Length"] = str(len(request.body))
+        return super().send(request, stream=stream, timeout=timeout, **kwargs)
+
+
+def _account_sizes(res: requests.Response, *args, **kwargs) -> None:
+    """Response hook recording the size of each request and response"""
+    body = res.request.body
+    sent = len(body) if isinstance(body, (bytes, str)) else 0
+    if kwargs.get("stream"):
+        # Reading a streamed response here would defeat the point
+        received = int(res.headers.get("Content-Length", 0))
+    else:
+        received = len(res.content)
+        if hasattr(res.raw, "tell"):
+            # Bytes actually read from the socket, before decompression
+            received = res.raw.tell()
+    host = urllib.parse.urlsplit(res.url).netloc
+    with _transfer_lock:
+        stats = _transfer_stats.setdefault(
+            host, {"requests": 0, "sent": 0, "received": 0}
+        )
+        stats["requests"] += 1
+        stats["sent"] += sent
+        stats["received"] += received
+
+
+def transport_options(options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """The transport settings in effect when options overrides the defaults"""
+    return {**TRANSPORT_DEFAULTS, **(options or {})}
+
+
+def _mount_transport() -> None:
+    """Mount an adapter with the settings from configure_transport, if due"""
+    global _adapter_options
+    if _adapter_options is None:
+        return
+    with _adapter_lock:
+        if _adapter_options is None:
+            return
+        adapter = TransportAdapter(_adapter_options)
+        for prefix in ("https://", "http://"):
+            old = session.adapters.get(prefix)
+            session.mount(prefix, adapter)
+            if old is not None:
+                old.close()
+        _adapter_options = None
+
+
+def configure_transport(options: Optional[Dict[str, Any]] = None) -> None:
+    """Apply transport settings to the shared session
+
+    options overrides TRANSPORT_DEFAULTS. The connection pools are replaced
+    when the session is next used, closing the existing pooled connections,
+    and the rate limits of hosts already contacted are updated.
+    """
+    global _adapter_options, _rate
+    options = transport_options(options)
+    with _adapter_lock:
+        _adapter_options = options
+    session.headers["Connection"] = "keep-alive" if options["keep_alive"] else "close"
+    hooks = session.hooks["response"]
+    if _account_sizes in hooks:
+        hooks.remove(_account_sizes)
+    if options["account_sizes"]:
+        hooks.append(_account_sizes)
+    _rate = (float(options["rate_limit"]), float(options["rate_burst"]))
+    with _buckets_lock:
+        for bucket in _buckets.values():
+            bucket.configure(*_rate)
+
+
+def get_transfer_stats() -> Dict[str, Dict[str, int]]:
+    """Requests made, and bytes sent and received, by host
+
+    Only counted when account_sizes is enabled.
+    """
+    with _transfer_lock:
+        return {host: dict(stats) for host, stats in _transfer_stats.items()}
+
+
+# Ask MediaWiki to refuse API requests when replication lag exceeds this
+MAXLAG = 5
+MAX_TRIES = 5
+# API error codes that mean the request should be retried later
+RETRYABLE_API_ERRORS = {"maxlag", "ratelimited", "readonly"}
+
+
+class RetryableError(Exception):
+    """A request failed in a way that may succeed if retried later"""
+
+    def __init__(self, message: str, retry_after: float = 0) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting the request rate to a host"""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # Nobody may take a token before this time, after a Retry-After
+        self.paused_until = 0.0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token, waiting until one is available
+
+        Returns the number of seconds spent waiting.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # Reserve the token now, so concurrent callers queue up behind it
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.paused_until - now, 0)
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def configure(self, rate: float, capacity: float) -> None:
+        with self.lock:
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for a while, e.g. when the host is lagged"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+# Rate limit and burst for new buckets, set by configure_transport
+_rate = (TRANSPORT_DEFAULTS["rate_limit"], TRANSPORT_DEFAULTS["rate_burst"])
+
+configure_transport()
+
+
+def get_bucket(host: str) -> TokenBucket:
+    with _buckets_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(*_rate)
+        return _buckets[host]
+
+
+def get_throttle_wait() -> Dict[str, float]:
+    """Total seconds spent waiting for the rate limiter, by host"""
+    with _buckets_lock:
+        return {host: bucket.waited for host, bucket in _buckets.items()}
+
+
+def parse_retry_after(value: Optional[str]) -> float:
+    """Seconds to wait from a Retry-After header, in either allowed format"""
+    if not value:
+        return 0
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return max(date.timestamp() - time.time(), 0)
+
+
+def _check_response(res: requests.Response) -> None:
+    """Raise RetryableError for responses worth retrying, or HTTPError if fatal"""
+    retry_after = parse_retry_after(res.headers.get("Retry-After"))
+    if res.status_code == 429 or res.status_code >= 500:
+        raise RetryableError(f"HTTP {res.status_code} from {res.url}", retry_after)
+    res.raise_for_status()
+    # MediaWiki reports API errors with a 200 status and a header
+    code = res.headers.get("MediaWiki-API-Error")
+    if code in RETRYABLE_API_ERRORS:
+        raise RetryableError(f"API error {code} from {res.url}", retry_after)
+
 
 def backoff_retry(method, url, output="text", **kwargs):
-    for i in range(0, 5):
+    """Make a request, retrying with jittered exponential backoff
+
+    Requests to each host are rate limited, and Action API requests include
+    maxlag. Connection errors, server errors and lag or rate limit errors are
+    retried, honoring Retry-After; other HTTP errors are raised immediately.
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    bucket = get_bucket(host)
+    if url.endswith("/api.php"):
+        key = "data" if method.lower() == "post" else "params"
+        kwargs[key] = {"maxlag": MAXLAG, **(kwargs.get(key) or {})}
+
+    for i in range(0, MAX_TRIES):
+        bucket.acquire()
         try:
             res = session.request(method, url, **kwargs)
-
-            res.raise_for_status()
+            _check_response(res)
             if output == "json":
                 return res.json()
             elif output == "text":
                 return res.text
-        except Exception as err:
-            if i >= 4:
+            elif output == "lines":
+                # Use with stream=True to avoid loading the whole response
+                return res.iter_lines(decode_unicode=True)
+        except requests.HTTPError:
+            raise
+        except (RetryableError, requests.RequestException, ValueError) as err:
+            if i >= MAX_TRIES - 1:
                 raise err
-            logger.info(f"Request failed, sleeping for {3**i}")
-            time.sleep(3 ** i)
+            delay = 3 ** i * random.uniform(0.5, 1.5)
+            retry_after = getattr(err, "retry_after", 0)
+            if retry_after:
+                # The host asked everyone to back off, not just this caller
+                bucket.pause(retry_after)
+                delay = max(delay, retry_after)
+            logger.info(f"Request failed ({err}), sleeping for {delay:.1f}")
+            time.sleep(delay)
 
 
 def get_site_data(hostname: str) -> SiteData:
@@ -94,18 +396,32 @@ def get_site_data(hostname: str) -> SiteData:
     )
 
     sitedata = SiteData(
-        user=namespaces["2"] - {""},
-        user_talk=namespaces["3"] - {""},
-        file=namespaces["6"] - {""},
-        special=namespaces["-1"] - {""},
-        contribs=contribs,
-        subst=subst,
+        user=frozenset(namespaces["2"] - {""}),
+        user_talk=frozenset(namespaces["3"] - {""}),
+        file=frozenset(namespaces["6"] - {""}),
+        special=frozenset(namespaces["-1"] - {""}),
+        contribs=frozenset(contribs),
+        subst=tuple(subst),
         dbname=general["wikiid"],
         hostname=hostname,
     )
     return sitedata
 
 
+def get_latest_revid(hostname: str, title: str) -> Optional[int]:
+    """Get the ID of the latest revision of a page, or None if it is missing"""
+    url = f"https://{hostname}/w/api.php"
+    params = {
+        "action": "query",
+        "format": "json",
+        "formatversion": "2",
+        "prop": "info",
+        "titles": title,
+    }
+    result = backoff_retry("get", url, output="json", params=params)
+    return result["query"]["pages"][0].get("lastrevid")
+
+
 def _get_sitematrix() -> Iterator[str]:
     # Construct the request to the Extension:Sitematrix api
     payload = {
@@ -147,3 +463,23 @@ def _check_user_exists(user: str, hostname: str) -> bool:
     url = f"https://{hostname}/w/api.php"
     result = backoff_retry("get", url, output="json", params=params)
     return bool(result["query"]["users"][0].get("missing", True))
+
+
+def _check_users_exist(users: List[str], hostname: str) -> Set[str]:
+    url = f"https://{hostname}/w/api.php"
+    exists: Set[str] = set()
+    # The API accepts up to 50 usernames per request
+    for i in range(0, len(users), 50):
+        params = {
+            "action": "query",
+            "format": "json",
+            "list": "users",
+            "ususers": "|".join(users[i : i + 50]),
+        }
+        result = backoff_retry("get", url, output="json", params=params)
+        exists.update(
+            user["name"]
+            for user in result["query"]["users"]
+            if "missing" not in user and "invalid" not in user
+        )
+    return exists
@@ -7,7 +7,11 @@ import datetime
 import toolforge
 import logging
 from datatypes import UserProps
-from typing import Iterator, Tuple, Dict, List, cast, Any
+from typing import Iterable, Iterator, Tuple, Dict, List, Optional, Set, cast, Any
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from active import ActiveUsers
 
 logger = logging.getLogger(__name__)
 
@@ -22,47 +26,188 @@ def wmcs() -> bool:
         return True
 
 
+# Blocks iter_active_user_sigs queries users in, by the last two digits of
+# the user id (the user id modulo 100)
+BLOCKS = range(0, 100)
+
+# Users with a custom fancy signature who have recently edited a discussion
+# page. Parameters: rev_timestamp lower bound.
+_ACTIVE_SIGS_FROM = """
+    FROM
+        user_properties
+        JOIN `user` ON user_id = up_user
+    WHERE
+        up_property = "nickname" AND
+        user_name IN (
+            SELECT actor_name
+            FROM revision_userindex
+            JOIN actor_revision ON rev_actor = actor_id
+            JOIN page ON rev_page = page_id
+            WHERE
+                rev_timestamp > %s
+                AND (
+                    page_namespace = 4
+                    OR (page_namespace %% 2) = 1
+                )
+        ) AND
+        up_user IN (
+            SELECT up_user
+            FROM user_properties
+            WHERE up_property = "fancysig" AND up_value = 1
+        ) AND
+        up_value != user_name"""
+
+
+# Users with a custom fancy signature, by name. Parameters: the usernames.
+_FANCY_SIGS_FROM = """
+    FROM
+        user_properties
+        JOIN `user` ON user_id = up_user
+    WHERE
+        up_property = "nickname" AND
+        user_name IN ({users}) AND
+        up_user IN (
+            SELECT up_user
+            FROM user_properties
+            WHERE up_property = "fancysig" AND up_value = 1
+        ) AND
+        up_value != user_name"""
+
+# In delta mode, revisions this long before the previous run's high-water
+# mark are scanned again, in case they reached the replica late
+DELTA_OVERLAP = datetime.timedelta(days=1)
+# Usernames per query when looking up the signatures of active users
+USER_CHUNK_SIZE = 500
+
+MW_TIMESTAMP = "%Y%m%d%H%M%S"
+
+
+def _lastedit(lastedit: str, days: int) -> str:
+    if lastedit:
+        return lastedit
+    return (datetime.datetime.utcnow() - datetime.timedelta(days=days)).strftime(
+        MW_TIMESTAMP
+    )
+
+
+def iter_recent_editors(dbname: str, since: str) -> Iterator[Tuple[str, str]]:
+    """Registered users who edited a discussion page after since
+
+    Yields each username with the timestamp of their latest such edit.
+    """
+    conn = toolforge.connect(f"{dbname}_p", cluster="analytics")
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT actor_name, MAX(rev_timestamp)
+            FROM revision_userindex
+            JOIN actor_revision ON rev_actor = actor_id
+            JOIN page ON rev_page = page_id
+            WHERE
+                rev_timestamp > %s
+                AND actor_user IS NOT NULL
+                AND (
+                    page_namespace = 4
+                    OR (page_namespace %% 2) = 1
+                )
+            GROUP BY actor_name""",
+            args=(since,),
+        )
+        for username, timestamp in cast(Iterator[Tuple[bytes, bytes]], cur.fetchall()):
+            yield username.decode("utf-8"), timestamp.decode("utf-8")
+
+
+def _in_blocks(blocks: Iterable[int]) -> Tuple[str, List[int]]:
+    """SQL condition selecting the users in blocks, and its parameters
+
+    The condition is empty when every block is selected.
+    """
+    block_ids = sorted(set(blocks))
+    if block_ids == list(BLOCKS):
+        return "", []
+    return f"AND up_user %% 100 IN ({', '.join(['%s'] * len(block_ids))})", block_ids
+
+
+def iter_user_sigs(
+    dbname: str, users: List[str], blocks: Iterable[int] = BLOCKS
+) -> Iterator[Tuple[str, str]]:
+    """Signatures of the users with a custom fancy signature among users
+
+    Only users in one of blocks (see iter_active_user_sigs) are included.
+    """
+    in_blocks, block_ids = _in_blocks(blocks)
+    conn = toolforge.connect(f"{dbname}_p", cluster="analytics")
+    with conn.cursor() as cur:
+        for start in range(0, len(users), USER_CHUNK_SIZE):
+            chunk = users[start : start + USER_CHUNK_SIZE]
+            cur.execute(
+                f"""
+                SELECT user_name, up_value
+                {_FANCY_SIGS_FROM.format(users=", ".join(["%s"] * len(chunk)))}
+                    {in_blocks}
+                ORDER BY up_user ASC""",
+                args=(*chunk, *block_ids),
+            )
+            for username, signature in cast(
+                Iterator[Tuple[bytes, bytes]], cur.fetchall()
+            ):
+                yield username.decode("utf-8"), signature.decode("utf-8")
+
+
+def _delta_active_user_sigs(
+    dbname: str,
+    lastedit: str,
+    blocks: Iterable[int],
+    active: "ActiveUsers",
+    since: str,
+) -> Iterator[Tuple[str, str]]:
+    start = lastedit
+    if since:
+        overlap = (
+            datetime.datetime.strptime(since, MW_TIMESTAMP) - DELTA_OVERLAP
+        ).strftime(MW_TIMESTAMP)
+        start = max(start, overlap)
+    logger.info(f"Querying edits since {start}")
+    active.update(iter_recent_editors(dbname, start))
+    expired = active.expire(lastedit)
+    logger.info(f"{expired} users no longer active")
+    yield from iter_user_sigs(dbname, active.users(), blocks)
+
+
 def iter_active_user_sigs(
-    dbname: str, lastedit: str = "", days: int = 365
+    dbname: str,
+    lastedit: str = "",
+    days: int = 365,
+    blocks: Iterable[int] = BLOCKS,
+    active: Optional["ActiveUsers"] = None,
+    since: str = "",
 ) -> Iterator[Tuple[str, str]]:
-    """Get usernames and signatures from the replica database"""
-    if not lastedit:
-        lastedit = (
-            datetime.datetime.utcnow() - datetime.timedelta(days=days)
-        ).strftime("%Y%m%d%H%M%S")
+    """Get usernames and signatures from the replica database
+
+    The query is broken into blocks by the last two digits of the user id,
+    so block 5 has users 5, 105, 205 and so on. Pass a subset of BLOCKS to
+    only get some of the users.
+
+    In delta mode, when active is given, only revisions after since (the
+    previous run's high-water mark, less DELTA_OVERLAP) are scanned. Their
+    editors are merged into active, users whose last edit is too old are
+    dropped from it, and the signatures of the rest are looked up. Without
+    since, the whole period is scanned to fill active.
+    """
+    lastedit = _lastedit(lastedit, days)
+    if active is not None:
+        yield from _delta_active_user_sigs(dbname, lastedit, blocks, active, since)
+        return
     conn = toolforge.connect(f"{dbname}_p", cluster="analytics")
     with conn.cursor() as cur:
-        # Break query into 100 queries paginated by last digits of user id
-        for i in range(0, 100):
+        for i in blocks:
             cur.execute(
-                """
+                f"""
                 SELECT user_name, up_value
-                FROM
-                    user_properties
-                    JOIN `user` ON user_id = up_user
-                WHERE
-                    RIGHT(up_user, 2) = %s AND
-                    up_property = "nickname" AND
-                    user_name IN (
-                        SELECT actor_name
-                        FROM revision_userindex
-                        JOIN actor_revision ON rev_actor = actor_id
-                        JOIN page ON rev_page = page_id
-                        WHERE
-                            rev_timestamp > %s
-                            AND (
-                                page_namespace = 4
-                                OR (page_namespace %% 2) = 1
-                            )
-                    ) AND
-                    up_user IN (
-                        SELECT up_user
-                        FROM user_properties
-                        WHERE up_property = "fancysig" AND up_value = 1
-                    ) AND
-                    up_value != user_name
+                {_ACTIVE_SIGS_FROM} AND
+                    up_user %% 100 = %s
                 ORDER BY up_user ASC""",
-                args=(str(i), lastedit),
+                args=(lastedit, i),
             )
             logger.info(f"Block {i}")
             for username, signature in cast(
@@ -73,6 +218,45 @@ def iter_active_user_sigs(
                 )
 
 
+def count_active_user_sigs(dbname: str, lastedit: str = "", days: int = 365) -> int:
+    """Count the signatures iter_active_user_sigs would return"""
+    conn = toolforge.connect(f"{dbname}_p", cluster="analytics")
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT COUNT(*) {_ACTIVE_SIGS_FROM}", args=(_lastedit(lastedit, days),)
+        )
+        (count,) = cast(Tuple[int], cur.fetchone())
+    return int(count)
+
+
+def sample_active_user_sigs(
+    dbname: str,
+    lastedit: str = "",
+    days: int = 365,
+    size: int = 300,
+    blocks: Iterable[int] = BLOCKS,
+) -> List[Tuple[str, str]]:
+    """A random sample of the signatures iter_active_user_sigs would return"""
+    in_blocks, block_ids = _in_blocks(blocks)
+    conn = toolforge.connect(f"{dbname}_p", cluster="analytics")
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT user_name, up_value
+            {_ACTIVE_SIGS_FROM}
+                {in_blocks}
+            ORDER BY RAND()
+            LIMIT %s""",
+            args=(_lastedit(lastedit, days), *block_ids, size),
+        )
+        return [
+            (username.decode("utf-8"), signature.decode("utf-8"))
+            for username, signature in cast(
+                Iterator[Tuple[bytes, bytes]], cur.fetchall()
+            )
+        ]
+
+
 def get_user_properties(user: str, dbname: str) -> UserProps:
     """Get signature and fancysig values for a user from the replica db"""
     logger.info("Getting user properties")
@@ -101,6 +285,43 @@ def get_user_properties(user: str, dbname: str) -> UserProps:
     )
 
 
+def get_users_properties(users: List[str], dbname: str) -> Dict[str, UserProps]:
+    """Get signature and fancysig values for many users in one query
+
+    Users that do not exist or have no properties set get empty UserProps.
+    """
+    result = {user: UserProps(nickname="", fancysig=False) for user in users}
+    if not users:
+        return result
+    conn = toolforge.connect(f"{dbname}_p")
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT user_name, up_property, up_value
+            FROM
+                user_properties
+                JOIN `user` ON user_id = up_user
+            WHERE
+                user_name IN ({", ".join(["%s"] * len(users))}) AND
+                up_property IN ("nickname", "fancysig")
+            """,
+            users,
+        )
+        resultset = cast(List[Tuple[bytes, bytes, bytes]], cur.fetchall())
+
+    data: Dict[str, Dict[str, str]] = {}
+    for name, key, value in resultset:
+        data.setdefault(name.decode("utf-8"), {})[key.decode("utf-8")] = value.decode(
+            "utf-8"
+        )
+    for user, props in data.items():
+        result[user] = UserProps(
+            nickname=props.get("nickname", ""),
+            fancysig=bool(int(props.get("fancysig", "0"))),
+        )
+    return result
+
+
 def iter_listed_user_sigs(userlist: list, dbname: str) -> Iterator[Tuple[str, str]]:
     """Iterate users and signatures from a list of usernames"""
     for user in userlist:
@@ -136,6 +357,16 @@ def _check_user_exists(user: str, dbname: str) -> bool:
     return bool(res)
 
 
+def _check_users_exist(users: List[str], dbname: str) -> Set[str]:
+    if not users:
+        return set()
+    query = "SELECT user_name FROM `user` WHERE user_name IN %(users)s"
+    res = do_db_query(dbname, query, users=users)
+    return {
+        row[0].decode("utf-8") if isinstance(row[0], bytes) else row[0] for row in res
+    }
+
+
 def _get_shard_from_site(site: str):
     if "//" not in site:
         site = "https://" + site
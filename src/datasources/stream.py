@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Server-sent event streams, such as Wikimedia EventStreams"""
+
+import ipaddress
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+import requests
+
+from . import api
+
+logger = logging.getLogger(__name__)
+
+EVENTSTREAM_URL = "https://stream.wikimedia.org/v2/stream/recentchange"
+# Seconds to wait before reconnecting to a stream that was closed
+RECONNECT_DELAY = 5.0
+# EventStreams sends a comment at least this often, even when idle
+READ_TIMEOUT = 60
+
+Event = NamedTuple("Event", [("id", str), ("event", str), ("data", str)])
+
+
+def parse_events(lines: Iterable[str]) -> Iterator[Event]:
+    """Parse the lines of an event stream into events"""
+    event_id, event = "", ""
+    data: List[str] = []
+    for line in lines:
+        if not line:
+            if data:
+                yield Event(event_id, event or "message", "\n".join(data))
+            event, data = "", []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            data.append(value)
+        elif field == "event":
+            event = value
+        elif field == "id":
+            # The id is kept for later events, as it is used to resume
+            event_id = value
+
+
+def iter_events(
+    url: str, last_event_id: str = "", retry: Optional[float] = RECONNECT_DELAY
+) -> Iterator[Event]:
+    """Iterate over the events of a stream, reconnecting if it is closed
+
+    On reconnecting, the stream is resumed after the last event received,
+    or after last_event_id at first. If retry is None, iteration stops when
+    the stream is closed instead.
+    """
+    while True:
+        headers = {"Accept": "text/event-stream"}
+        if last_event_id:
+            headers["Last-Event-ID"] = last_event_id
+        try:
+            with api.session.get(
+                url, headers=headers, stream=True, timeout=(10, READ_TIMEOUT)
+            ) as res:
+                res.raise_for_status()
+                res.encoding = "utf-8"
+                # Lines are read as each chunk arrives, not in fixed-size
+                # blocks, so a quiet stream does not hold back an event
+                lines = res.iter_lines(chunk_size=None, decode_unicode=True)
+                for event in parse_events(lines):
+                    if event.id:
+                        last_event_id = event.id
+                    yield event
+        except requests.RequestException as err:
+            logger.warning(f"Event stream failed: {err}")
+        if retry is None:
+            return
+        logger.info(f"Reconnecting to {url} in {retry} s")
+        time.sleep(retry)
+
+
+def heartbeat(events: Iterable[Event], interval: float) -> Iterator[Optional[Event]]:
+    """Iterate over events, yielding None after each interval without one
+
+    The events are read on a background thread, so callers can act on a
+    timer even when the stream is quiet. Errors reading the events are
+    raised here.
+    """
+    items: "queue.Queue[Any]" = queue.Queue(maxsize=1000)
+    end = object()
+
+    def read() -> None:
+        try:
+            for event in events:
+                items.put(event)
+        except BaseException as err:
+            items.put(err)
+        else:
+            items.put(end)
+
+    threading.Thread(target=read, name="events", daemon=True).start()
+    while True:
+        try:
+            item = items.get(timeout=interval)
+        except queue.Empty:
+            yield None
+            continue
+        if item is end:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def parse_change(event: Event) -> Optional[Dict[str, Any]]:
+    """The recent change carried by an event, if it is one"""
+    if event.event != "message":
+        return None
+    try:
+        change = json.loads(event.data)
+    except ValueError:
+        logger.warning(f"Invalid event data: {event.data!r}")
+        return None
+    return change if isinstance(change, dict) else None
+
+
+def is_talk_edit(change: Dict[str, Any], hostname: str) -> bool:
+    """Whether a change is a registered user's edit to a discussion page
+
+    These are the edits a user's activity is counted by in reports.
+    """
+    namespace = change.get("namespace")
+    if (
+        change.get("server_name") != hostname
+        or change.get("type") not in ("edit", "new")
+        or not isinstance(namespace, int)
+        or not (namespace == 4 or namespace % 2 == 1)
+    ):
+        return False
+    try:
+        ipaddress.ip_address(change.get("user", ""))
+    except ValueError:
+        return bool(change.get("user"))
+    return False
@@ -3,8 +3,23 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 # Copyright 2020 AntiCompositeNumber
 
+import dataclasses
 import enum
-from typing import NamedTuple, Set, List, Optional
+import functools
+import hashlib
+import json
+import re
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    NamedTuple,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+)
 
 
 def N_(text: str) -> str:
@@ -14,19 +29,142 @@ def N_(text: str) -> str:
 
 UserProps = NamedTuple("UserProps", [("nickname", str), ("fancysig", bool)])
 
-SiteData = NamedTuple(
-    "SiteData",
-    [
-        ("user", Set[str]),
-        ("user_talk", Set[str]),
-        ("file", Set[str]),
-        ("special", Set[str]),
-        ("contribs", Set[str]),
-        ("subst", List[str]),
-        ("dbname", str),
-        ("hostname", str),
-    ],
-)
+
+@dataclasses.dataclass(frozen=True)
+class SiteData:
+    """Namespace, special page and magic word names of a site
+
+    Instances are immutable and hashable, so they can be shared between
+    threads and used as cache keys. The subst regex, title matcher and
+    fingerprint are derived once, when the instance is created, and are left
+    out of pickles, which only carry the names.
+    """
+
+    user: FrozenSet[str]
+    user_talk: FrozenSet[str]
+    file: FrozenSet[str]
+    special: FrozenSet[str]
+    contribs: FrozenSet[str]
+    subst: Tuple[str, ...]
+    dbname: str
+    hostname: str
+
+    subst_re: Pattern[str] = dataclasses.field(init=False, repr=False, compare=False)
+    titles: "TitleMatcher" = dataclasses.field(init=False, repr=False, compare=False)
+    fingerprint: str = dataclasses.field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # Accept any iterables of names, but store them immutably
+        for name in ("user", "user_talk", "file", "special", "contribs"):
+            object.__setattr__(self, name, frozenset(getattr(self, name)))
+        object.__setattr__(self, "subst", tuple(self.subst))
+
+        # Longest first, so that when one alias is a prefix of another, the
+        # longer one is removed whole instead of leaving its end behind
+        prefixes = sorted(self.subst, key=len, reverse=True)
+        pattern = "|".join(re.escape(prefix) for prefix in prefixes) or "(?!)"
+        object.__setattr__(self, "subst_re", re.compile(pattern))
+        object.__setattr__(self, "titles", TitleMatcher(self))
+        # Hash of the configuration that checks depend on. The database name
+        # and hostname are left out, so sites configured alike share it.
+        config = [
+            sorted(self.user),
+            sorted(self.user_talk),
+            sorted(self.file),
+            sorted(self.special),
+            sorted(self.contribs),
+            list(self.subst),
+        ]
+        object.__setattr__(
+            self,
+            "fingerprint",
+            hashlib.sha256(json.dumps(config).encode("utf-8")).hexdigest(),
+        )
+
+    def __reduce__(self):
+        return (
+            SiteData,
+            (
+                self.user,
+                self.user_talk,
+                self.file,
+                self.special,
+                self.contribs,
+                self.subst,
+                self.dbname,
+                self.hostname,
+            ),
+        )
+
+    def strip_subst(self, text: str) -> str:
+        """Remove subst: prefixes from wikitext"""
+        return self.subst_re.sub("", text)
+
+
+class TitleKind(enum.Enum):
+    """What a link title points to, as far as signature checks care"""
+
+    USER = enum.auto()
+    USER_TALK = enum.auto()
+    CONTRIBS = enum.auto()
+    FILE = enum.auto()
+    # A user, user talk or contributions page on another wiki
+    INTERWIKI = enum.auto()
+
+
+def _title_key(name: str) -> str:
+    """Normalize a namespace or special page name for lookup"""
+    return "_".join(name.replace("_", " ").split()).casefold()
+
+
+class TitleMatcher:
+    """Classifies link titles using a site's namespace and special page names
+
+    Names are looked up in a single casefolded alias table, built once per
+    site, so classifying a title takes one split and a few dict lookups.
+    """
+
+    def __init__(self, sitedata: SiteData) -> None:
+        self.namespaces: Dict[str, TitleKind] = {}
+        for names, kind in [
+            (sitedata.file, TitleKind.FILE),
+            (sitedata.user_talk, TitleKind.USER_TALK),
+            (sitedata.user, TitleKind.USER),
+        ]:
+            self.namespaces.update((_title_key(name), kind) for name in names)
+        self.special = {_title_key(name) for name in sitedata.special}
+        self.contribs = {_title_key(name) for name in sitedata.contribs}
+
+    def classify(self, title: str) -> Tuple[Optional[TitleKind], str]:
+        """Classify a link title, and return the page name within its namespace
+
+        The page name of a contributions link is the target user. Titles of
+        any other kind are classified as None.
+        """
+        title = title.partition("#")[0].strip()
+        if title.startswith(":"):
+            title = title[1:]
+        parts = title.split(":")
+        # Interwiki prefixes come before the namespace
+        for i, prefix in enumerate(parts[:-1]):
+            key = _title_key(prefix)
+            page = ":".join(parts[i + 1 :]).strip()
+            kind: Optional[TitleKind]
+            if key in self.special:
+                special, slash, target = page.partition("/")
+                if _title_key(special) not in self.contribs:
+                    return None, page
+                kind, page = TitleKind.CONTRIBS, target.strip()
+            else:
+                kind = self.namespaces.get(key)
+                if kind is None:
+                    continue
+            if i == 0:
+                return kind, page
+            elif kind is TitleKind.FILE:
+                return None, page
+            return TitleKind.INTERWIKI, page
+        return None, title
 
 
 UserCheck = NamedTuple(
@@ -185,3 +323,120 @@ class WebAppMessage(Result):
     NO_ERRORS = N_("no-errors"), N_("no-errors-help")
     SIG_NOT_FANCY = N_("sig-not-fancy"), N_("sig-not-fancy-help")
     USER_DOES_NOT_EXIST = N_("user-does-not-exist"), N_("user-does-not-exist-help")
+
+
+# Each SigError has a bit in the error mask of a SigRecord, in definition order
+_ERROR_BITS: List[SigError] = list(SigError)
+ERROR_MASKS: Dict[SigError, int] = {
+    error: 1 << bit for bit, error in enumerate(_ERROR_BITS)
+}
+
+
+def error_mask(errors: Iterable[SigError]) -> int:
+    mask = 0
+    for error in errors:
+        mask |= ERROR_MASKS[error]
+    return mask
+
+
+# Few combinations of errors occur, so decoded masks are cached
+@functools.lru_cache(maxsize=None)
+def _bits(mask: int) -> Tuple[int, ...]:
+    bits = []
+    while mask:
+        low = mask & -mask
+        bits.append(low.bit_length() - 1)
+        mask ^= low
+    return tuple(bits)
+
+
+@functools.lru_cache(maxsize=None)
+def _values(mask: int) -> Tuple[str, ...]:
+    return tuple(_ERROR_BITS[bit].value for bit in _bits(mask))
+
+
+def mask_errors(mask: int) -> List[SigError]:
+    """Errors set in an error mask, in definition order"""
+    return [_ERROR_BITS[bit] for bit in _bits(mask)]
+
+
+class SigRecord:
+    """A flagged signature, with its errors as a mask"""
+
+    __slots__ = ("signature", "errors", "html_sig")
+
+    def __init__(
+        self, signature: str, errors: int = 0, html_sig: Optional[str] = None
+    ) -> None:
+        self.signature = signature
+        self.errors = errors
+        self.html_sig = html_sig
+
+    def export(self) -> Dict[str, Any]:
+        """The record in the report's JSON format"""
+        data: Dict[str, Any] = {
+            "signature": self.signature,
+            "errors": list(_values(self.errors)),
+        }
+        if self.html_sig is not None:
+            data["html_sig"] = self.html_sig
+        return data
+
+
+class SigRecords:
+    """Flagged signatures of a report run, keyed by username
+
+    The number of users with each error is kept up to date as errors are
+    added, so the report's stats need no extra pass over the records.
+    """
+
+    __slots__ = ("records", "counts")
+
+    def __init__(self) -> None:
+        self.records: Dict[str, SigRecord] = {}
+        self.counts = [0] * len(_ERROR_BITS)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, user: object) -> bool:
+        return user in self.records
+
+    def add(self, user: str, signature: str, errors: Iterable[SigError]) -> None:
+        """Flag a user's signature with errors, if there are any"""
+        mask = error_mask(errors)
+        if not mask:
+            return
+        record = self.records.get(user)
+        if record is None:
+            record = self.records[user] = SigRecord(signature)
+        new = mask & ~record.errors
+        record.errors |= new
+        for bit in _bits(new):
+            self.counts[bit] += 1
+
+    def errors(self, user: str) -> List[SigError]:
+        record = self.records.get(user)
+        return mask_errors(record.errors) if record is not None else []
+
+    def stats(self) -> Dict[str, int]:
+        """Number of flagged users, and of users with each error"""
+        stats = {"total": len(self.records)}
+        stats.update(
+            (error.value, count)
+            for error, count in zip(_ERROR_BITS, self.counts)
+            if count
+        )
+        return stats
+
+    def export(self, clear: bool = False) -> Dict[str, Dict[str, Any]]:
+        """The records in the report's JSON format, ordered by username
+
+        With clear, each record is dropped once it is exported, so that the
+        records and their export are not both held in memory.
+        """
+        get = self.records.pop if clear else self.records.__getitem__
+        sigs = {user: get(user).export() for user in sorted(self.records)}
+        if clear:
+            self.counts = [0] * len(_ERROR_BITS)
+        return sigs
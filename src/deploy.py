@@ -3,8 +3,10 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 # Copyright 2020 AntiCompositeNumber
 
+import functools
 import hmac
 import logging
+import os
 import subprocess
 import json
 
@@ -13,7 +15,10 @@ import requests
 
 bp = flask.Blueprint("deploy", __name__, url_prefix="/deploy")
 
+REPO_DIR = "/data/project/signatures/signatures/"
 
+
+@functools.lru_cache(maxsize=None)
 def get_config(filename="/data/project/signatures/github_config.json"):
     try:
         with open(filename) as f:
@@ -23,9 +28,6 @@ def get_config(filename="/data/project/signatures/github_config.json"):
     return config
 
 
-config = get_config()
-
-
 def pull_master():
     logging.info("Pulling from git repository")
     try:
@@ -33,7 +35,7 @@ def pull_master():
             [
                 "git",
                 "-C",
-                "/data/project/signatures/signatures/",
+                REPO_DIR,
                 "pull",
             ],
             check=True,
@@ -52,6 +54,25 @@ def pull_master():
         return True
 
 
+def write_version(repo_dir=REPO_DIR):
+    """Save the short hash of the checked out commit for the webservice
+
+    This runs at deploy time, so the webservice does not have to start git.
+    """
+    rev = subprocess.run(
+        ["git", "-C", repo_dir, "rev-parse", "--short", "HEAD"],
+        universal_newlines=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if rev.returncode:
+        logging.error(rev.stderr)
+        return False
+    with open(os.path.join(repo_dir, "VERSION"), "w") as f:
+        f.write(rev.stdout)
+    return True
+
+
 def restart_webservice():
     logging.info("Webservice restarting!")
     subprocess.Popen(["webservice", "restart"])
@@ -68,9 +89,10 @@ def update_status(url, status, auth):
 def deploy(request, payload):
     logging.info("Deployment starting")
     logging.debug(payload)
-    auth = ("AntiCompositeNumber", config["github_deploy_pat"])
+    auth = ("AntiCompositeNumber", get_config()["github_deploy_pat"])
     status_url = payload["deployment"]["statuses_url"]
     if pull_master():
+        write_version()
         update_status(status_url, "success", auth)
         restart_webservice()
         return True
@@ -85,7 +107,9 @@ def check_status(payload):
 
 def verify_hmac(request):
     r_hmac = hmac.new(
-        (config["github_secret"]).encode(), msg=request.get_data(), digestmod="sha1"
+        (get_config()["github_secret"]).encode(),
+        msg=request.get_data(),
+        digestmod="sha1",
     )
     r_digest = "sha1=" + r_hmac.hexdigest()
     g_digest = request.headers["X-Hub-Signature"]
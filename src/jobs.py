@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Durable queue for background jobs started from the webservice
+
+Jobs are stored in a SQLite database in the data directory, so any web
+worker can enqueue a job or report on its status. Report purges run as
+separate sigprobs.py processes, so a slow report never ties up a web worker.
+Signature checks run on a small thread pool inside the webservice, separate
+from the threads handling requests.
+"""
+
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from typing import cast
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB = "jobs.sqlite3"
+SIGPROBS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "sigprobs.py")
+# Seconds between dispatches while purge jobs are queued or running
+DISPATCH_INTERVAL = 10.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    site TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created TEXT NOT NULL,
+    started TEXT,
+    finished TEXT,
+    pid INTEGER,
+    result TEXT
+);
+-- At most one queued or running purge per site. Other kinds of jobs, like
+-- signature checks, may run concurrently.
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_purge
+    ON jobs (site) WHERE kind = 'purge' AND status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (kind, status, job_id);
+CREATE INDEX IF NOT EXISTS jobs_site ON jobs (site, job_id);
+"""
+
+Job = NamedTuple(
+    "Job",
+    [
+        ("id", int),
+        ("kind", str),
+        ("site", str),
+        ("status", str),
+        ("created", str),
+        ("started", Optional[str]),
+        ("finished", Optional[str]),
+        ("result", Optional[str]),
+    ],
+)
+
+_columns = "job_id, kind, site, status, created, started, finished, result"
+
+# Job processes started by this process, so they can be reaped once finished
+_children: Dict[int, subprocess.Popen] = {}
+
+# Worker pool for jobs run inside this process, created on first use
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+# Background threads dispatching purge jobs, by data directory
+_dispatchers: Dict[str, threading.Thread] = {}
+_dispatch_lock = threading.Lock()
+_dispatch_stop = threading.Event()
+
+
+def _now() -> str:
+    return datetime.datetime.utcnow().isoformat()
+
+
+class JobStore:
+    def __init__(self, path: str) -> None:
+        # Autocommit mode, so that transactions are only started explicitly
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def enqueue(self, kind: str, site: str) -> Tuple[Job, bool]:
+        """Queue a job, unless a purge is already queued or running for the site
+
+        Returns the job, and whether a new job was created.
+        """
+        while True:
+            try:
+                cur = self.conn.execute(
+                    "INSERT INTO jobs (kind, site, status, created) "
+                    "VALUES (?, ?, 'queued', ?)",
+                    (kind, site, _now()),
+                )
+            except sqlite3.IntegrityError:
+                row = self.conn.execute(
+                    f"""
+                    SELECT {_columns} FROM jobs
+                    WHERE kind = ? AND site = ?
+                        AND status IN ('queued', 'running')""",
+                    (kind, site),
+                ).fetchone()
+                if row is None:
+                    # The existing job finished in the meantime, try again
+                    continue
+                return Job(*row), False
+            return cast(Job, self.get(cur.lastrowid)), True
+
+    def get(self, job_id: Optional[int]) -> Optional[Job]:
+        row = self.conn.execute(
+            f"SELECT {_columns} FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return Job(*row) if row else None
+
+    def list_jobs(self, site: str, kind: str, limit: int = 10) -> List[Job]:
+        """Most recent jobs for a site, newest first"""
+        return [
+            Job(*row)
+            for row in self.conn.execute(
+                f"""
+                SELECT {_columns} FROM jobs
+                WHERE site = ? AND kind = ?
+                ORDER BY job_id DESC
+                LIMIT ?""",
+                (site, kind, limit),
+            )
+        ]
+
+    def claim(self, kind: str, max_running: int) -> Optional[Job]:
+        """Mark the oldest queued job as running, if below the concurrency limit"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            (running,) = self.conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE kind = ? AND status = 'running'",
+                (kind,),
+            ).fetchone()
+            row = self.conn.execute(
+                "SELECT job_id FROM jobs WHERE kind = ? AND status = 'queued' "
+                "ORDER BY job_id LIMIT 1",
+                (kind,),
+            ).fetchone()
+            if running >= max_running or row is None:
+                self.conn.execute("ROLLBACK")
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET status = 'running', started = ? WHERE job_id = ?",
+                (_now(), row[0]),
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return self.get(row[0])
+
+    def count(self, kind: str, status: str) -> int:
+        (count,) = self.conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE kind = ? AND status = ?", (kind, status)
+        ).fetchone()
+        return count
+
+    def start(self, job_id: int) -> None:
+        self.conn.execute(
+            "UPDATE jobs SET status = 'running', started = ? WHERE job_id = ?",
+            (_now(), job_id),
+        )
+
+    def set_pid(self, job_id: int, pid: int) -> None:
+        self.conn.execute("UPDATE jobs SET pid = ? WHERE job_id = ?", (pid, job_id))
+
+    def finish(self, job_id: int, status: str, result: Optional[str] = None) -> None:
+        """Record that a job is done (or failed)"""
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, finished = ?, result = ? WHERE job_id = ?",
+            (status, _now(), result, job_id),
+        )
+
+    def wait(self, job_id: int, timeout: float, interval: float = 0.5) -> Optional[Job]:
+        """Wait up to timeout seconds for a job to finish, then return it"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job.status not in ("queued", "running"):
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            time.sleep(min(interval, remaining))
+
+    def prune(self, kind: str, age: datetime.timedelta) -> None:
+        """Delete finished jobs of a kind that finished more than age ago"""
+        self.conn.execute(
+            "DELETE FROM jobs WHERE kind = ? AND finished < ?",
+            (kind, (datetime.datetime.utcnow() - age).isoformat()),
+        )
+
+    def reap(self, kind: str) -> None:
+        """Mark unfinished jobs whose process has exited as failed"""
+        for job_id, pid in self.conn.execute(
+            "SELECT job_id, pid FROM jobs WHERE kind = ? "
+            "AND status IN ('queued', 'running') AND pid IS NOT NULL",
+            (kind,),
+        ).fetchall():
+            if not _pid_alive(pid):
+                logger.warning(f"Job {job_id} (pid {pid}) exited without finishing")
+                self.finish(job_id, "failed", "Job process exited unexpectedly")
+
+
+@contextlib.contextmanager
+def running(db_path: str, job_id: int) -> Iterator[None]:
+    """Mark a job as done or failed when the enclosed code finishes"""
+    with JobStore(db_path) as store:
+        try:
+            yield
+        except BaseException as err:
+            store.finish(job_id, "failed", str(err) or type(err).__name__)
+            raise
+        store.finish(job_id, "done")
+
+
+def _pid_alive(pid: int) -> bool:
+    proc = _children.get(pid)
+    if proc is not None:
+        # Polling our own children also reaps them once they exit
+        if proc.poll() is None:
+            return True
+        del _children[pid]
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def purge_command(job: Job, data_dir: str, db_path: str) -> List[str]:
+    return [
+        sys.executable,
+        SIGPROBS,
+        job.site,
+        "--output",
+        data_dir,
+        "--job",
+        str(job.id),
+        "--jobs-db",
+        db_path,
+    ]
+
+
+def _dispatch(data_dir: str, max_running: int) -> int:
+    """Reap and start purge jobs, returning how many are still unfinished"""
+    db_path = os.path.join(data_dir, JOBS_DB)
+    with JobStore(db_path) as store:
+        store.reap("purge")
+        while True:
+            job = store.claim("purge", max_running)
+            if job is None:
+                break
+            logger.info(f"Starting purge job {job.id} for {job.site}")
+            try:
+                proc = subprocess.Popen(
+                    purge_command(job, data_dir, db_path),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True,
+                )
+            except OSError as err:
+                store.finish(job.id, "failed", str(err))
+                continue
+            _children[proc.pid] = proc
+            store.set_pid(job.id, proc.pid)
+        return store.count("purge", "queued") + store.count("purge", "running")
+
+
+def _dispatch_loop(data_dir: str, max_running: int) -> None:
+    while not _dispatch_stop.wait(DISPATCH_INTERVAL):
+        with _dispatch_lock:
+            try:
+                unfinished = _dispatch(data_dir, max_running)
+            except Exception:
+                logger.exception("Dispatching purge jobs failed")
+                unfinished = 0
+            if not unfinished:
+                _dispatchers.pop(data_dir, None)
+                return
+
+
+def dispatch(data_dir: str, max_running: int = 1) -> None:
+    """Start queued purge jobs, up to max_running at a time
+
+    Called whenever a job is queued or its status is checked. While purge
+    jobs are queued or running, a background thread dispatches again every
+    DISPATCH_INTERVAL seconds, so queued jobs start and jobs whose process
+    died are reaped without waiting for another request.
+    """
+    with _dispatch_lock:
+        unfinished = _dispatch(data_dir, max_running)
+        if unfinished and data_dir not in _dispatchers:
+            _dispatch_stop.clear()
+            thread = threading.Thread(
+                target=_dispatch_loop,
+                args=(data_dir, max_running),
+                name="dispatch",
+                daemon=True,
+            )
+            _dispatchers[data_dir] = thread
+            thread.start()
+
+
+def stop_dispatchers() -> None:
+    """Stop the background dispatch threads, and wait for them to exit"""
+    _dispatch_stop.set()
+    with _dispatch_lock:
+        threads = list(_dispatchers.values())
+        _dispatchers.clear()
+    for thread in threads:
+        thread.join()
+
+
+def _run_job(db_path: str, job_id: int, func: Callable[[], Any]) -> None:
+    with JobStore(db_path) as store:
+        store.start(job_id)
+        try:
+            result = func()
+        except Exception as err:
+            logger.exception(f"Job {job_id} failed")
+            store.finish(job_id, "failed", str(err) or type(err).__name__)
+        else:
+            store.finish(job_id, "done", json.dumps(result))
+
+
+def submit(
+    db_path: str, job: Job, func: Callable[[], Any], max_workers: int = 4
+) -> concurrent.futures.Future:
+    """Run func for a job on this process's worker pool
+
+    The job is marked as running when a worker picks it up, and its result is
+    stored as JSON once func returns. At most max_workers jobs run at once,
+    the rest wait in the queue.
+    """
+    global _executor
+    with _executor_lock:
+        # Requests may arrive together, but only one pool may be created
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="jobs"
+            )
+        executor = _executor
+    return executor.submit(_run_job, db_path, job.id, func)
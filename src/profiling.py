@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Timing of report runs, broken down by check and by upstream endpoint
+
+Functions are instrumented by temporarily replacing them on their module, so
+only calls made through the module attribute (which is how sigprobs calls
+its checks and datasources) are counted. Times are inclusive: a check that
+makes an API request counts the request's time as well, and the request is
+also counted under its endpoint. Calls from several threads, like the
+concurrent checks of a signature, are all counted, so the times can add up
+to more than the wall time.
+"""
+
+import contextlib
+import cProfile
+import functools
+import inspect
+import threading
+import time
+import urllib.parse
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+
+class Profile:
+    def __init__(self) -> None:
+        # name -> [calls, seconds], updated from any thread under lock
+        self.stats: Dict[str, List[float]] = {}
+        self.wall_time = 0.0
+        self.cprofile: Optional[cProfile.Profile] = None
+        self.lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, calls: int = 1) -> None:
+        with self.lock:
+            entry = self.stats.setdefault(name, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+    def wrap(self, func: Callable, name: Callable[..., str]) -> Callable:
+        """Wrap func so each call is timed under name(*args, **kwargs)
+
+        The time includes any nested calls, instrumented or not.
+
+        If func returns a generator, the time spent producing its items is
+        counted, not just the time to create it.
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = name(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                self.add(key, time.perf_counter() - start)
+            if inspect.isgenerator(result):
+                return self._timed_iter(result, key)
+            return result
+
+        return wrapper
+
+    def _timed_iter(self, iterator: Iterator, key: str) -> Iterator:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(key, time.perf_counter() - start, calls=0)
+                return
+            self.add(key, time.perf_counter() - start, calls=0)
+            yield item
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Calls and inclusive seconds by name, slowest first"""
+        with self.lock:
+            stats = {name: tuple(entry) for name, entry in self.stats.items()}
+        return {
+            "wall_time": round(self.wall_time, 6),
+            "timings": {
+                name: {"calls": int(calls), "seconds": round(seconds, 6)}
+                for name, (calls, seconds) in sorted(
+                    stats.items(), key=lambda item: -item[1][1]
+                )
+            },
+        }
+
+    def table(self) -> str:
+        """Breakdown of time spent, slowest first, as a plain text table"""
+        timings = self.as_dict()["timings"]
+        width = max([len(name) for name in timings] + [len("Total")])
+        lines = [
+            f"{'Name':<{width}} {'Calls':>8} {'Seconds':>10} {'Mean ms':>9} "
+            f"{'% wall':>6}",
+        ]
+        for name, entry in timings.items():
+            calls, seconds = entry["calls"], entry["seconds"]
+            mean = seconds / calls * 1000 if calls else 0
+            share = seconds / self.wall_time * 100 if self.wall_time else 0
+            lines.append(
+                f"{name:<{width}} {calls:>8} {seconds:>10.3f} {mean:>9.2f} "
+                f"{share:>6.1f}"
+            )
+        lines.append(f"{'Total':<{width}} {'':>8} {self.wall_time:>10.3f}")
+        return "\n".join(lines)
+
+
+def endpoint_name(method: str, url: str, *args, **kwargs) -> str:
+    """Name an upstream request by host, path and API action"""
+    parsed = urllib.parse.urlsplit(url)
+    name = f"{method.upper()} {parsed.netloc}{parsed.path}"
+    params = kwargs.get("params") or kwargs.get("data")
+    if isinstance(params, dict) and "action" in params:
+        name += f"?action={params['action']}"
+    return name
+
+
+@contextlib.contextmanager
+def instrument(
+    profile: Profile,
+    module: ModuleType,
+    names: Iterable[str],
+    prefix: str = "",
+    namer: Optional[Callable[..., str]] = None,
+) -> Iterator[None]:
+    """Time calls to the named functions of module while in the block"""
+    originals = {name: getattr(module, name) for name in names}
+    for name, func in originals.items():
+        key = namer or (lambda *args, _name=prefix + name, **kwargs: _name)
+        setattr(module, name, profile.wrap(func, key))
+    try:
+        yield
+    finally:
+        for name, func in originals.items():
+            setattr(module, name, func)
+
+
+@contextlib.contextmanager
+def collect(targets: List[Dict[str, Any]], cprofile: bool = False) -> Iterator[Profile]:
+    """Profile the enclosed block
+
+    targets are keyword arguments for instrument(). If cprofile is set, a
+    cProfile.Profile is also run, and left on the profile for dumping.
+    """
+    profile = Profile()
+    with contextlib.ExitStack() as stack:
+        for target in targets:
+            stack.enter_context(instrument(profile, **target))
+        if cprofile:
+            profile.cprofile = cProfile.Profile()
+            profile.cprofile.enable()
+        start = time.perf_counter()
+        try:
+            yield profile
+        finally:
+            profile.wall_time = time.perf_counter() - start
+            if profile.cprofile is not None:
+                profile.cprofile.disable()
@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Storage backends for batch report data
+
+Reports are always written as a single JSON file per site. Optionally, a
+per-site SQLite database is written alongside, which allows the web API to
+look up single users or errors without loading the entire report.
+"""
+
+import abc
+import contextlib
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+
+JSON_SUFFIX = ".json"
+SQLITE_SUFFIX = ".sqlite3"
+# Pre-compressed copies of the report and of the report organized by error
+GZIP_SUFFIX = ".json.gz"
+ERRORS_GZIP_SUFFIX = ".error.json.gz"
+# Timing breakdown written by sigprobs.py --profile
+PROFILE_SUFFIX = ".profile.json"
+# Report published by a run that is still in progress
+PARTIAL_SUFFIX = ".partial.json"
+# A partial report that has not been updated for this many of its run's
+# partial_interval, or for PARTIAL_MAX_AGE seconds if the run publishes
+# every so many users instead, was left behind by a run that died
+PARTIAL_STALE_INTERVALS = 3
+PARTIAL_MAX_AGE = 6 * 3600
+# Other JSON files in the data directory, which are not reports
+DERIVED_JSON_SUFFIXES = (PROFILE_SUFFIX, PARTIAL_SUFFIX)
+# Subdirectory of the data directory for the outputs of sharded runs
+SHARD_DIR = "shards"
+# Archive of every run of a site's report, see ReportHistory
+HISTORY_SUFFIX = ".history.sqlite3"
+
+SCHEMA = """
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    user_name TEXT NOT NULL UNIQUE,
+    signature TEXT NOT NULL,
+    html_sig TEXT
+);
+CREATE TABLE errors (
+    error_id INTEGER PRIMARY KEY,
+    error_name TEXT NOT NULL UNIQUE,
+    count INTEGER NOT NULL
+);
+CREATE TABLE user_errors (
+    user_id INTEGER NOT NULL REFERENCES users (user_id),
+    error_id INTEGER NOT NULL REFERENCES errors (error_id),
+    PRIMARY KEY (user_id, error_id)
+) WITHOUT ROWID;
+CREATE INDEX user_errors_error ON user_errors (error_id, user_id);
+"""
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    last_update TEXT NOT NULL UNIQUE,
+    meta TEXT NOT NULL,
+    counts TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    user_name TEXT NOT NULL,
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    info TEXT,
+    PRIMARY KEY (user_name, run_id)
+) WITHOUT ROWID;
+"""
+
+Validators = NamedTuple(
+    "Validators", [("etag", str), ("last_modified", datetime.datetime)]
+)
+
+# Validators for each report file, keyed by path. The stat result is stored
+# with them, so they are only recomputed when the file is replaced.
+_validator_cache: Dict[str, Tuple[Tuple[int, int, int], Validators]] = {}
+# Meta of each partial report, keyed and validated the same way
+_partial_cache: Dict[str, Tuple[Tuple[int, int, int], Dict[str, Any]]] = {}
+
+
+def list_sites(data_dir: str) -> List[str]:
+    """List sites that have a report in data_dir"""
+    return [
+        item[: -len(JSON_SUFFIX)]
+        for item in os.listdir(data_dir)
+        if item.endswith(JSON_SUFFIX) and not item.endswith(DERIVED_JSON_SUFFIXES)
+    ]
+
+
+def get_validators(data_dir: str, site: str) -> Validators:
+    """Get HTTP cache validators for a site's report
+
+    The ETag is a hash of the JSON report, and the modification time is the
+    report's last_update. Raises FileNotFoundError if there is no report.
+    """
+    path = os.path.join(data_dir, site + JSON_SUFFIX)
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _validator_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with open(path, "rb") as f:
+        raw = f.read()
+    last_update = datetime.datetime.fromisoformat(
+        json.loads(raw)["meta"]["last_update"]
+    )
+    validators = Validators(
+        etag=hashlib.sha256(raw).hexdigest(),
+        last_modified=last_update.replace(tzinfo=datetime.timezone.utc),
+    )
+    _validator_cache[path] = (key, validators)
+    return validators
+
+
+def partial_meta(data_dir: str, site: str) -> Optional[Dict[str, Any]]:
+    """Meta of the partial report of a run in progress, if there is one
+
+    Partial reports older than the complete report are ignored, and so are
+    those that have not been updated for too long, see PARTIAL_MAX_AGE.
+    """
+    path = os.path.join(data_dir, site + PARTIAL_SUFFIX)
+    try:
+        stat = os.stat(path)
+        report_stat = os.stat(os.path.join(data_dir, site + JSON_SUFFIX))
+    except FileNotFoundError:
+        return None
+    if stat.st_mtime_ns < report_stat.st_mtime_ns:
+        return None
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _partial_cache.get(path)
+    if cached is None or cached[0] != key:
+        with open(path) as f:
+            cached = (key, json.load(f)["meta"])
+        _partial_cache[path] = cached
+    meta = cached[1]
+    max_age = (
+        PARTIAL_STALE_INTERVALS * float(meta["partial_interval"])
+        if meta.get("partial_interval")
+        else PARTIAL_MAX_AGE
+    )
+    if time.time() - stat.st_mtime > max_age:
+        return None
+    return dict(meta)
+
+
+def precompressed_path(data_dir: str, site: str, suffix: str) -> Optional[str]:
+    """Path to a pre-compressed report artifact, if it is current
+
+    Artifacts older than the JSON report are ignored, since they belong to
+    an earlier run.
+    """
+    path = os.path.join(data_dir, site + suffix)
+    try:
+        stat = os.stat(path)
+        report_stat = os.stat(os.path.join(data_dir, site + JSON_SUFFIX))
+    except FileNotFoundError:
+        return None
+    if stat.st_mtime_ns < report_stat.st_mtime_ns:
+        return None
+    return path
+
+
+@contextlib.contextmanager
+def atomic_open(path: str, overwrite: bool = True) -> Iterator[TextIO]:
+    """Open a file for writing, which only replaces path once it is complete
+
+    Readers of path keep seeing the previous version while the new one is
+    being written.
+    """
+    if not overwrite and os.path.exists(path):
+        raise FileExistsError(path)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            yield f
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def write_gzip(text: str, path: str) -> None:
+    """Write a gzip-compressed copy of text, replacing any existing file"""
+    tmp_path = path + ".tmp"
+    with gzip.GzipFile(tmp_path, "wb", compresslevel=9, mtime=0) as f:
+        f.write(text.encode("utf-8"))
+    os.replace(tmp_path, path)
+
+
+def by_error(report: "Report") -> Dict[str, Any]:
+    """Organize a report by error, listing the users with each error"""
+    counts = report.counts()
+    counts.pop("total")
+    return {
+        "errors": {
+            error: [user for user, info in report.iter_users(error=error)]
+            for error in counts
+        },
+        "meta": report.meta(),
+    }
+
+
+def count_errors(sigs: Dict[str, Any]) -> Dict[str, int]:
+    """Stats of a report: the number of users, and of users with each error"""
+    stats = {"total": len(sigs)}
+    for info in sigs.values():
+        for error in info.get("errors", []):
+            stats[error] = stats.get(error, 0) + 1
+    return stats
+
+
+def merge_shards(shards: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine the reports of a sharded run into a single report
+
+    Each shard's meta has a "shard" entry of "i/N". Raises ValueError unless
+    there is exactly one report for each of the N shards.
+    """
+    found = sorted(shard["meta"].get("shard", "") for shard in shards)
+    count = len(shards)
+    if found != sorted(f"{i}/{count}" for i in range(count)):
+        raise ValueError(f"Incomplete set of shards: {', '.join(found)}")
+
+    sigs: Dict[str, Any] = {}
+    for shard in shards:
+        sigs.update(shard["sigs"])
+    sigs = {user: sigs[user] for user in sorted(sigs)}
+
+    meta = dict(shards[0]["meta"])
+    del meta["shard"]
+    meta["last_update"] = max(shard["meta"]["last_update"] for shard in shards)
+    return {"errors": count_errors(sigs), "meta": meta, "sigs": sigs}
+
+
+def write_sqlite(report: Dict[str, Any], path: str) -> None:
+    """Write a report to a SQLite database, replacing any existing database
+
+    The database is built in a temporary file and moved into place, so
+    readers never see a partially written report.
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        with conn:
+            conn.executescript(SCHEMA)
+            conn.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in report["meta"].items()),
+            )
+            conn.executemany(
+                "INSERT INTO errors (error_name, count) VALUES (?, ?)",
+                (
+                    (error, count)
+                    for error, count in report["errors"].items()
+                    if error != "total"
+                ),
+            )
+            error_ids = dict(conn.execute("SELECT error_name, error_id FROM errors"))
+            # Users are inserted in sorted order, so user_id order matches
+            # user_name order and pagination can use either.
+            for user in sorted(report["sigs"]):
+                info = report["sigs"][user]
+                cur = conn.execute(
+                    "INSERT INTO users (user_name, signature, html_sig) "
+                    "VALUES (?, ?, ?)",
+                    (user, info["signature"], info.get("html_sig")),
+                )
+                conn.executemany(
+                    "INSERT INTO user_errors (user_id, error_id) VALUES (?, ?)",
+                    ((cur.lastrowid, error_ids[error]) for error in info["errors"]),
+                )
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+
+class Report(abc.ABC):
+    """Read-only view of a site report"""
+
+    @abc.abstractmethod
+    def meta(self) -> Dict[str, Any]:
+        """Metadata of the run that produced the report"""
+
+    @abc.abstractmethod
+    def counts(self) -> Dict[str, int]:
+        """Number of users with each error, plus the total number of users"""
+
+    @abc.abstractmethod
+    def get_user(self, user: str) -> Optional[Dict[str, Any]]:
+        """A user's entry in the report, or None if they are not in it"""
+
+    @abc.abstractmethod
+    def iter_users(
+        self, error: Optional[str] = None, after: str = "", limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Iterate over users in the report, ordered by username
+
+        If error is given, only users with that error are included. If after
+        is given, only users sorting after that username are included.
+        """
+
+    def export(self) -> Dict[str, Any]:
+        """Return the report in the legacy JSON format"""
+        return {
+            "errors": self.counts(),
+            "meta": self.meta(),
+            "sigs": dict(self.iter_users()),
+        }
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class DictReport(Report):
+    """Report held in memory in the legacy JSON format"""
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.data = data
+
+    def meta(self) -> Dict[str, Any]:
+        return dict(self.data["meta"])
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self.data["errors"])
+
+    def get_user(self, user: str) -> Optional[Dict[str, Any]]:
+        return self.data["sigs"].get(user)
+
+    def iter_users(
+        self, error: Optional[str] = None, after: str = "", limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        count = 0
+        for user, info in self.data["sigs"].items():
+            if limit is not None and count >= limit:
+                return
+            if user <= after:
+                continue
+            if error is not None and error not in info["errors"]:
+                continue
+            count += 1
+            yield user, info
+
+    def export(self) -> Dict[str, Any]:
+        return self.data
+
+
+class JSONReport(DictReport):
+    """Report backed by a single JSON file, loaded into memory"""
+
+    def __init__(self, path: str) -> None:
+        with open(path) as f:
+            super().__init__(json.load(f))
+
+
+class SQLiteReport(Report):
+    """Report backed by a per-site SQLite database"""
+
+    # Errors are collected with a correlated subquery so that each page of
+    # users is a single query. Error names never contain commas.
+    _columns = """
+        users.user_name,
+        users.signature,
+        (
+            SELECT group_concat(error_name, ',')
+            FROM user_errors AS ue JOIN errors USING (error_id)
+            WHERE ue.user_id = users.user_id
+        ),
+        users.html_sig"""
+
+    def __init__(self, path: str) -> None:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+    def meta(self) -> Dict[str, Any]:
+        return {
+            key: json.loads(value)
+            for key, value in self.conn.execute("SELECT key, value FROM meta")
+        }
+
+    def counts(self) -> Dict[str, int]:
+        (total,) = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        counts = {"total": total}
+        counts.update(
+            self.conn.execute(
+                "SELECT error_name, count FROM errors ORDER BY error_id"
+            ).fetchall()
+        )
+        return counts
+
+    def get_user(self, user: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(
+            f"SELECT {self._columns} FROM users WHERE user_name = ?", (user,)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._info(row)
+
+    def iter_users(
+        self, error: Optional[str] = None, after: str = "", limit: Optional[int] = None
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        if error is None:
+            query = f"""
+                SELECT {self._columns}
+                FROM users
+                WHERE user_name > ?
+                ORDER BY user_name
+                LIMIT ?"""
+            args: Tuple[Any, ...] = (after, -1 if limit is None else limit)
+        else:
+            query = f"""
+                SELECT {self._columns}
+                FROM user_errors JOIN users USING (user_id)
+                WHERE
+                    error_id = (SELECT error_id FROM errors WHERE error_name = ?)
+                    AND user_name > ?
+                ORDER BY user_id
+                LIMIT ?"""
+            args = (error, after, -1 if limit is None else limit)
+        # Iterate the cursor directly so that large reports can be streamed
+        # without loading every row at once.
+        for row in self.conn.execute(query, args):
+            yield row[0], self._info(row)
+
+    @staticmethod
+    def _info(row: Tuple[str, str, Optional[str], Optional[str]]) -> Dict[str, Any]:
+        info: Dict[str, Any] = {
+            "signature": row[1],
+            "errors": row[2].split(",") if row[2] else [],
+        }
+        if row[3] is not None:
+            info["html_sig"] = row[3]
+        return info
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class ReportHistory:
+    """Archive of every run of a site's report, stored as deltas
+
+    For each run, only the users that were added, removed, or whose entry
+    changed since the previous run are stored, as a row in changes. A
+    removed user's row has no info. The counts of each run are stored in
+    full, so trends can be read without rebuilding any report.
+    """
+
+    # Latest change to each user up to and including a run
+    _as_of = """
+        SELECT user_name, info FROM changes AS c
+        WHERE run_id = (
+            SELECT MAX(run_id) FROM changes
+            WHERE user_name = c.user_name AND run_id <= ?
+        ) AND info IS NOT NULL
+        ORDER BY user_name"""
+
+    def __init__(self, path: str, readonly: bool = False) -> None:
+        if readonly:
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+            self.conn.executescript(HISTORY_SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def runs(self) -> List[Dict[str, Any]]:
+        """last_update and error counts of each archived run, oldest first"""
+        return [
+            {"run": run_id, "last_update": last_update, "errors": json.loads(counts)}
+            for run_id, last_update, counts in self.conn.execute(
+                "SELECT run_id, last_update, counts FROM runs ORDER BY run_id"
+            )
+        ]
+
+    def _sigs(self, run_id: int) -> Dict[str, Any]:
+        return {
+            user: json.loads(info)
+            for user, info in self.conn.execute(self._as_of, (run_id,))
+        }
+
+    def get(self, run_id: int) -> Optional[DictReport]:
+        """Rebuild the report of an archived run"""
+        row = self.conn.execute(
+            "SELECT meta, counts FROM runs WHERE run_id = ?", (run_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return DictReport(
+            {
+                "errors": json.loads(row[1]),
+                "meta": json.loads(row[0]),
+                "sigs": self._sigs(run_id),
+            }
+        )
+
+    def add(self, report: Dict[str, Any]) -> bool:
+        """Archive a report as a new run, unless it is archived already"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            last_update = report["meta"]["last_update"]
+            run_id, latest = self.conn.execute(
+                "SELECT MAX(run_id), MAX(last_update) FROM runs"
+            ).fetchone()
+            if latest is not None and last_update <= latest:
+                self.conn.execute("ROLLBACK")
+                return False
+            previous = self._sigs(run_id) if run_id is not None else {}
+            cur = self.conn.execute(
+                "INSERT INTO runs (last_update, meta, counts) VALUES (?, ?, ?)",
+                (last_update, json.dumps(report["meta"]), json.dumps(report["errors"])),
+            )
+            sigs = report["sigs"]
+            changes: List[Tuple[str, Optional[int], Optional[str]]] = [
+                (user, cur.lastrowid, json.dumps(info))
+                for user, info in sigs.items()
+                if previous.get(user) != info
+            ]
+            changes.extend(
+                (user, cur.lastrowid, None) for user in previous if user not in sigs
+            )
+            self.conn.executemany(
+                "INSERT INTO changes (user_name, run_id, info) VALUES (?, ?, ?)",
+                changes,
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return True
+
+
+def open_report(data_dir: str, site: str, backend: str = "json") -> Report:
+    """Open the report for a site, preferring the configured backend
+
+    If the SQLite backend is configured but no database exists for the site,
+    the JSON report is used instead. Raises FileNotFoundError if there is no
+    report for the site.
+    """
+    if backend == "sqlite":
+        try:
+            return SQLiteReport(os.path.join(data_dir, site + SQLITE_SUFFIX))
+        except FileNotFoundError:
+            pass
+    return JSONReport(os.path.join(data_dir, site + JSON_SUFFIX))
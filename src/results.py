@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Check results shared between report runs and between sites
+
+Under SUL, many users use the same signature on every wiki they edit, so the
+same wikitext is checked over and over. Results are stored in a SQLite
+database in the data directory, keyed by a hash of the checked text and by
+the fingerprint of the site's namespace and subst configuration, so any site
+with the same configuration can reuse them.
+"""
+
+import datetime
+import hashlib
+import json
+import sqlite3
+from typing import Dict, Iterable, List, Set
+
+RESULTS_DB = "results.sqlite3"
+# Results older than this are checked again, in case the checks have changed
+MAX_AGE = datetime.timedelta(days=30)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    kind TEXT NOT NULL,
+    text_hash TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    errors TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (kind, text_hash, fingerprint)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_updated ON results (updated);
+"""
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResultStore:
+    def __init__(self, path: str) -> None:
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.executescript(SCHEMA)
+        self.conn.execute(
+            "DELETE FROM results WHERE updated < ?",
+            ((datetime.datetime.utcnow() - MAX_AGE).isoformat(),),
+        )
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def get_many(
+        self, kind: str, texts: Iterable[str], fingerprint: str
+    ) -> Dict[str, List[str]]:
+        """Stored errors for each of texts that has a result, keyed by text"""
+        hashes: Dict[str, str] = {text_hash(text): text for text in texts}
+        found = {}
+        keys = list(hashes)
+        # Stay under SQLite's limit on the number of parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self.conn.execute(
+                f"""
+                SELECT text_hash, errors FROM results
+                WHERE kind = ? AND fingerprint = ?
+                    AND text_hash IN ({", ".join("?" * len(chunk))})""",
+                (kind, fingerprint, *chunk),
+            ).fetchall()
+            for key, errors in rows:
+                found[hashes[key]] = json.loads(errors)
+        return found
+
+    def put_many(
+        self, kind: str, results: Dict[str, Set[str]], fingerprint: str
+    ) -> None:
+        """Store the errors found in each text"""
+        now = datetime.datetime.utcnow().isoformat()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results "
+                "(kind, text_hash, fingerprint, errors, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        kind,
+                        text_hash(text),
+                        fingerprint,
+                        json.dumps(sorted(errors)),
+                        now,
+                    )
+                    for text, errors in results.items()
+                ],
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
@@ -15,11 +15,84 @@ import itertools
 import functools
 import operator
 import argparse
+import active
 import datasources
 import datatypes
 import pathlib
-from datatypes import Checks, SigError, SiteData
-from typing import Union, Dict, Set, Optional, List, cast, Tuple, TextIO
+import reports
+import jobs
+import profiling
+import results
+import contextlib
+import re
+import secrets
+import threading
+import concurrent.futures
+import contextvars
+import enum
+import math
+import time
+import zlib
+from datatypes import Checks, SigError, SiteData, TitleKind
+from typing import (
+    Any,
+    Callable,
+    NamedTuple,
+    Union,
+    Dict,
+    Iterable,
+    Set,
+    Optional,
+    List,
+    cast,
+    Tuple,
+    TextIO,
+    ContextManager,
+    Iterator,
+)
+
+# Number of signatures linted together in a single request
+LINT_BATCH_SIZE = 5
+# Number of signatures expanded together in a single request
+SUBST_BATCH_SIZE = 50
+# Number of signatures rendered together in a single request
+RENDER_BATCH_SIZE = 20
+# Network-bound checks of a signature run concurrently, at most this many,
+# unless check_concurrency is set
+CHECK_WORKERS = 4
+# Number of signatures run through the local checks by --estimate
+ESTIMATE_SAMPLE_SIZE = 300
+# Assumed seconds per API request for --estimate, unless configured
+DEFAULT_REQUEST_LATENCY = 0.5
+# Seconds between checks for missing shards when merging with --wait
+SHARD_POLL_INTERVAL = 60
+# Users checked together by --follow, and the longest it waits to fill a
+# batch before checking the users it has, unless follow_interval is set
+FOLLOW_BATCH_SIZE = 50
+FOLLOW_INTERVAL = 60
+# Longest --follow waits for an event before checking whether to write a batch
+FOLLOW_HEARTBEAT = 5.0
+# Seconds before --follow checks a user again, unless follow_recheck is set
+FOLLOW_RECHECK = 86400
+
+# Expansions made by evaluate_subst_batch, keyed by hostname and wikitext.
+# Each report run has its own, see subst_cache.
+_subst_cache: "contextvars.ContextVar[Optional[Dict[Tuple[str, str], str]]]" = (
+    contextvars.ContextVar("subst_cache", default=None)
+)
+
+# Tags that change how the rest of the wikitext is parsed if left open, which
+# would spill over into the next signature in a batch
+_SPILL_OPEN = re.compile(
+    r"<(nowiki|pre|includeonly|noinclude|onlyinclude)(\s[^>]*[^/>])?\s*>", re.I
+)
+_SPILL_CLOSE = re.compile(r"</(nowiki|pre|includeonly|noinclude|onlyinclude)\s*>", re.I)
+
+_HTML_TAG = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*?(/?)>")
+_VOID_ELEMENTS = {"area", "br", "col", "hr", "img", "input", "link", "meta", "wbr"}
+
+# Kinds of link that count as linking to a user
+_USER_TITLES = {TitleKind.USER, TitleKind.USER_TALK, TitleKind.CONTRIBS}
 
 
 def load_config(site):
@@ -43,46 +116,229 @@ def load_config(site):
     return config
 
 
+class Cost(enum.IntEnum):
+    """How expensive a check is to run"""
+
+    # String operations on the signature
+    LOCAL = 1
+    # Parses the signature
+    PARSE = 2
+    # May make API or database requests
+    NETWORK = 3
+
+
+CheckResult = Union[Optional[SigError], Set[SigError]]
+
+CheckSpec = NamedTuple(
+    "CheckSpec",
+    [
+        ("flag", Checks),
+        ("cost", Cost),
+        # Checks that, if they find an error, make this check pointless
+        ("needs", Checks),
+        # Called with (user, sig, sitedata, checks)
+        ("run", Callable[[str, str, SiteData, Checks], CheckResult]),
+    ],
+)
+
+
+def _schedule(specs: List[CheckSpec]) -> List[CheckSpec]:
+    """Order checks cheapest first, but each after the checks it needs
+
+    Network-bound checks run concurrently, so they may only need cheaper
+    checks. Raises ValueError if a check's needs cannot be met.
+    """
+    registered = functools.reduce(operator.or_, (spec.flag for spec in specs))
+    network = [spec.flag for spec in specs if spec.cost is Cost.NETWORK]
+    for spec in specs:
+        if spec.needs | registered != registered:
+            raise ValueError(f"{spec.flag!r} needs an unknown check")
+        if spec.cost is Cost.NETWORK and any(flag & spec.needs for flag in network):
+            raise ValueError(f"{spec.flag!r} needs a network-bound check")
+    ordered: List[CheckSpec] = []
+    done = Checks(0)
+    remaining = list(specs)
+    while remaining:
+        ready = [spec for spec in remaining if spec.needs & done == spec.needs]
+        if not ready:
+            raise ValueError(f"Checks need each other: {remaining!r}")
+        spec = min(ready, key=lambda spec: spec.cost)
+        ordered.append(spec)
+        remaining.remove(spec)
+        done |= spec.flag
+    return ordered
+
+
+# Checks run by check_sig, in order of cost. The check functions are looked
+# up when called, so they can be replaced (by profiling, for example).
+CHECKS = _schedule(
+    [
+        CheckSpec(
+            Checks.LINKS,
+            Cost.NETWORK,
+            Checks(0),
+            lambda u, s, d, c: check_links(u, s, d),
+        ),
+        CheckSpec(
+            Checks.LENGTH, Cost.LOCAL, Checks(0), lambda u, s, d, c: check_length(s)
+        ),
+        CheckSpec(
+            Checks.FANCY, Cost.LOCAL, Checks(0), lambda u, s, d, c: check_fanciness(s)
+        ),
+        CheckSpec(
+            Checks.LINT,
+            Cost.NETWORK,
+            Checks.FANCY,
+            lambda u, s, d, c: get_lint_errors(s, d, c),
+        ),
+        CheckSpec(
+            Checks.NESTED_SUBST,
+            Cost.NETWORK,
+            Checks.FANCY,
+            lambda u, s, d, c: check_tildes(s, d),
+        ),
+        CheckSpec(
+            Checks.IMAGES,
+            Cost.PARSE,
+            Checks.FANCY,
+            lambda u, s, d, c: check_images(s, d),
+        ),
+        CheckSpec(
+            Checks.TRANSCLUSION,
+            Cost.PARSE,
+            Checks.FANCY,
+            lambda u, s, d, c: check_transclusion(s, d),
+        ),
+        CheckSpec(
+            Checks.SUBST_LENGTH,
+            Cost.NETWORK,
+            Checks.FANCY | Checks.LENGTH,
+            lambda u, s, d, c: check_post_subst_length(s, d),
+        ),
+        CheckSpec(
+            Checks.LINK_NAME,
+            Cost.NETWORK,
+            Checks.FANCY,
+            lambda u, s, d, c: check_impersonation(s, u, d),
+        ),
+        CheckSpec(
+            Checks.FREE_PIPES,
+            Cost.PARSE,
+            Checks.FANCY,
+            lambda u, s, d, c: check_pipes(s),
+        ),
+        CheckSpec(
+            Checks.BREAKS,
+            Cost.PARSE,
+            Checks.FANCY,
+            lambda u, s, d, c: check_line_breaks(s),
+        ),
+    ]
+)
+
+# Worker pools for running a signature's network checks concurrently, by
+# number of workers, created on first use
+_check_executors: Dict[int, concurrent.futures.ThreadPoolExecutor] = {}
+_check_executors_lock = threading.Lock()
+
+
+def _check_executor(workers: int) -> concurrent.futures.ThreadPoolExecutor:
+    with _check_executors_lock:
+        if workers not in _check_executors:
+            _check_executors[workers] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="check"
+            )
+        return _check_executors[workers]
+
+
+def _map_concurrent(func: Callable[[Any], Any], items: List, workers: int) -> List:
+    """Call func on each item, on up to workers threads, and return the results"""
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    executor = _check_executor(workers)
+    futures = [
+        executor.submit(contextvars.copy_context().run, func, item) for item in items
+    ]
+    return [future.result() for future in futures]
+
+
+def _run_check(
+    spec: CheckSpec, user: str, sig: str, sitedata: SiteData, checks: Checks
+) -> Set[SigError]:
+    result = spec.run(user, sig, sitedata, checks)
+    if isinstance(result, set):
+        return cast(Set[SigError], result - {None})
+    return {result} if result is not None else set()
+
+
 def check_sig(
     user: str,
     sig: str,
     sitedata: SiteData,
     hostname: str,
     checks: Checks = Checks.DEFAULT,
+    first_error: bool = False,
+    workers: Optional[int] = None,
 ) -> Set[SigError]:
-    """Run a signature through the test suite and return any errors"""
-    errors = set()
-    sig = html.unescape(sig)
-
-    if checks & Checks.LINKS:
-        errors.add(check_links(user, sig, sitedata))
-    if checks & Checks.LENGTH:
-        errors.add(check_length(sig))
-    if checks & Checks.FANCY:
-        fanciness = check_fanciness(sig)
-        if fanciness:
-            # This check short circuits -- there's no point in doing the
-            # more expensive checks if there's only plain text
-            errors.add(fanciness)
-            return cast(Set[SigError], errors - {None, SigError.NO_USER_LINKS})
-    if checks & Checks.LINT:
-        errors.update(get_lint_errors(sig, sitedata, checks))
-    if checks & Checks.NESTED_SUBST:
-        errors.add(check_tildes(sig, sitedata))
-    if checks & Checks.IMAGES:
-        errors.add(check_images(sig, sitedata))
-    if checks & Checks.TRANSCLUSION:
-        errors.add(check_transclusion(sig, sitedata))
-    if checks & Checks.SUBST_LENGTH:
-        errors.add(check_post_subst_length(sig, sitedata))
-    if checks & Checks.LINK_NAME:
-        errors.add(check_impersonation(sig, user, sitedata))
-    if checks & Checks.FREE_PIPES:
-        errors.add(check_pipes(sig))
-    if checks & Checks.BREAKS:
-        errors.add(check_line_breaks(sig))
+    """Run a signature through the test suite and return any errors
+
+    Checks run cheapest first, and are skipped if a check they need found an
+    error. Network-bound checks run last, on up to workers threads (by
+    default CHECK_WORKERS). If first_error is set, checking stops at the
+    first check that finds an error, and the network-bound checks run one at
+    a time so the rest can be skipped.
+    """
+    workers = workers or CHECK_WORKERS
+    errors: Set[SigError] = set()
+    failed = Checks(0)
+    sig = normalize_sig(sig)
+
+    selected = [spec for spec in CHECKS if spec.flag & checks]
+    network = []
+    for spec in selected:
+        if spec.needs & failed:
+            continue
+        if spec.cost is Cost.NETWORK and not first_error and workers > 1:
+            network.append(spec)
+            continue
+        found = _run_check(spec, user, sig, sitedata, checks)
+        if found:
+            errors |= found
+            failed |= spec.flag
+            if first_error:
+                break
 
-    return cast(Set[SigError], errors - {None})
+    if len(network) > 1:
+        executor = _check_executor(workers)
+        # Run in copies of this context, so the checks see the run's caches.
+        # Other shared state, like the profiler's counters, is locked.
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                _run_check,
+                spec,
+                user,
+                sig,
+                sitedata,
+                checks,
+            )
+            for spec in network
+        ]
+        for future in futures:
+            errors |= future.result()
+    elif network:
+        errors |= _run_check(network[0], user, sig, sitedata, checks)
+
+    if failed & Checks.FANCY:
+        # There's no point in linking to the user page when there is only
+        # plain text
+        errors.discard(SigError.NO_USER_LINKS)
+    return errors
+
+
+def normalize_sig(sig: str) -> str:
+    """The text of a signature that is checked and expanded"""
+    return html.unescape(sig)
 
 
 def lint_to_error(error: Dict[str, str]) -> Optional[SigError]:
@@ -137,73 +393,27 @@ def compare_links(
     """Compare links in a sig to data in sitedata"""
     wikitext = mwph.parse(sig)
     user = datasources.normal_name(user)
+    matcher = sitedata.titles
     errors = set()
     for link in wikitext.ifilter_wikilinks():
-        title = str(link.title).partition("#")[0]
-        # Extract namespace and page.
-        # Interwiki prefixes are left in the namespace
-        if ":" in user:
-            # Colons in usernames break the partitioning
-            if title.endswith(f":{user}"):
-                ns = title.replace(f":{user}", "")
-                sep = ":"
-                page = title.replace(f"{ns}:", "")
-            elif title.endswith(f"/{user}"):
-                raw = title.replace(f"/{user}", "")
-                ns, sep, page = raw.rpartition(":")
-                page += f"/{user}"
-            else:
-                continue  # pragma: no cover
-        else:
-            ns, sep, page = title.rpartition(":")
-
-        # strip whitespace from ns, page
-        ns, page = ns.strip(), page.strip()
-
-        # remove leading colon from namespace
-        if ns.startswith(":"):
-            ns = ns[1:]
-
-        ns = datasources.normal_name(ns.lower())
-
-        # Check if linking to user or user talk
-        if not sep:
-            continue
-        elif ":" in ns:
+        kind, page = matcher.classify(str(link.title))
+        if kind is TitleKind.INTERWIKI:
             errors.add("interwiki-user-link")
-        elif ns in sitedata.user or ns in sitedata.user_talk:
-            # Check that it's the right user or user_talk
+        elif kind in _USER_TITLES:
+            # Check that it's the right user
             if datasources.normal_name(page) == user:
                 return True
-            else:
-                errors.add("link-username-mismatch")
-                continue
-        elif ns in sitedata.special:
-            # Could be a contribs page, check
-            # split page and normalize names
-            specialpage, slash, target = page.partition("/")
-            specialpage = datasources.normal_name(specialpage.strip())
-            target = datasources.normal_name(target.strip())
-            if specialpage in sitedata.contribs:
-                # It's contribs
-                if target == user:
-                    # The right one
-                    return True
-                else:
-                    errors.add("link-username-mismatch")
-                    continue  # pragma: no cover
-            else:
-                continue  # pragma: no cover
-    else:
-        return errors
+            errors.add("link-username-mismatch")
+    return errors
 
 
-def evaluate_subst(text: str, sitedata: SiteData) -> str:
-    """Perform substitution by removing "subst:" and expanding the wikitext"""
-    if not text:
-        return ""
-    for subst in sitedata.subst:
-        text = text.replace(subst, "")
+def _needs_expansion(text: str) -> bool:
+    # Without templates, parser functions, comments or tags, expansion is a
+    # no-op, so there's no need to ask the API
+    return "{" in text or "<" in text
+
+
+def _expand(text: str, sitedata: SiteData, method: str = "get") -> str:
     data = {
         "action": "expandtemplates",
         "format": "json",
@@ -211,10 +421,175 @@ def evaluate_subst(text: str, sitedata: SiteData) -> str:
         "prop": "wikitext",
     }
     url = f"https://{sitedata.hostname}/w/api.php"
-    res = datasources.backoff_retry("get", url, params=data, output="json")
+    if method == "post":
+        res = datasources.backoff_retry("post", url, data=data, output="json")
+    else:
+        res = datasources.backoff_retry("get", url, params=data, output="json")
     return res["expandtemplates"]["wikitext"]
 
 
+def evaluate_subst(text: str, sitedata: SiteData) -> str:
+    """Perform substitution by removing "subst:" and expanding the wikitext"""
+    if not text:
+        return ""
+    text = sitedata.strip_subst(text)
+    if not _needs_expansion(text):
+        return text
+    cache = _subst_cache.get()
+    cached = cache.get((sitedata.hostname, text)) if cache is not None else None
+    if cached is not None:
+        return cached
+    return _expand(text, sitedata)
+
+
+@contextlib.contextmanager
+def subst_cache() -> Iterator[Dict[Tuple[str, str], str]]:
+    """Keep the expansions of evaluate_subst_batch until the block exits
+
+    The cache belongs to the current context, so other threads, like those
+    of the webservice, neither see nor clear it.
+    """
+    cache: Dict[Tuple[str, str], str] = {}
+    token = _subst_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _subst_cache.reset(token)
+
+
+def _batchable(text: str) -> bool:
+    """Whether text can be expanded alongside others without affecting them"""
+    return (
+        text.count("{") == text.count("}")
+        and text.count("<!--") == text.count("-->")
+        and len(_SPILL_OPEN.findall(text)) == len(_SPILL_CLOSE.findall(text))
+    )
+
+
+def evaluate_subst_batch(texts: Iterable[str], sitedata: SiteData) -> None:
+    """Expand many texts at once, so later evaluate_subst calls are cached
+
+    The texts are joined into a single expandtemplates request, each preceded
+    by a unique marker line, and the result is split on the markers. Texts
+    that could disturb their neighbours, or whose markers did not survive
+    expansion intact, are expanded individually instead. Outside of a
+    subst_cache block there is nowhere to keep the expansions, so this does
+    nothing.
+    """
+    cache = _subst_cache.get()
+    if cache is None:
+        return
+    pending: List[str] = []
+    single: List[str] = []
+    for text in texts:
+        text = sitedata.strip_subst(text)
+        if (
+            not _needs_expansion(text)
+            or (sitedata.hostname, text) in cache
+            or text in pending
+            or text in single
+        ):
+            continue
+        (pending if _batchable(text) else single).append(text)
+
+    if len(pending) == 1:
+        single.extend(pending)
+    elif pending:
+        marker = f"SIGPROBS-{secrets.token_hex(8)}-"
+        batch = "".join(f"\n{marker}{i}\n{text}" for i, text in enumerate(pending))
+        batch += f"\n{marker}{len(pending)}\n"
+        pieces = re.split(
+            f"\n{marker}(\\d+)\n", _expand(batch, sitedata, method="post")
+        )
+        # pieces alternates between marker numbers and the text between them
+        found = [int(index) for index in pieces[1::2]]
+        expanded = {}
+        for j in range(len(found) - 1):
+            if found[j + 1] == found[j] + 1:
+                expanded[found[j]] = pieces[2 * j + 2]
+        for i, text in enumerate(pending):
+            if i in expanded:
+                cache[(sitedata.hostname, text)] = expanded[i]
+            else:
+                single.append(text)
+        if single:
+            logger.debug(f"Expanding {len(single)} signatures individually")
+
+    for text in single:
+        cache[(sitedata.hostname, text)] = _expand(text, sitedata)
+
+
+def _render(wikitext: str, sitedata: SiteData) -> str:
+    """Render wikitext to HTML with Parsoid, returning the inside of the body"""
+    url = f"https://{sitedata.hostname}/api/rest_v1/transform/wikitext/to/html"
+    payload = {"wikitext": wikitext, "body_only": True}
+    text = datasources.backoff_retry("post", url, json=payload)
+    return text.replace('href="./', f'href="https://{sitedata.hostname}/wiki/')
+
+
+def _unwrap(html_text: str) -> str:
+    """Remove the paragraph Parsoid wraps a single line of wikitext in"""
+    _, sep1, rest = html_text.partition(">")
+    inside, sep2, _ = rest.rpartition("</")
+    if not sep1 or not sep2:
+        return html_text
+    return inside
+
+
+def _balanced(html_text: str) -> bool:
+    """Whether every element opened in an HTML fragment is also closed in it"""
+    stack = []
+    for match in _HTML_TAG.finditer(html_text):
+        closing, name, selfclosing = match.groups()
+        name = name.lower()
+        if selfclosing or name in _VOID_ELEMENTS:
+            continue
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return False
+    return not stack
+
+
+def render_sigs(sigs: Dict[str, str], sitedata: SiteData) -> Dict[str, str]:
+    """Render signatures to HTML, several per Parsoid request
+
+    The signatures are placed on a single line, separated by empty marker
+    elements, and the resulting HTML is split on the markers. Signatures that
+    are not balanced HTML after splitting, for example because formatting
+    leaked into the next signature, are rendered individually.
+    """
+    rendered = {}
+    users = list(sigs)
+    for start in range(0, len(users), RENDER_BATCH_SIZE):
+        batch = users[start : start + RENDER_BATCH_SIZE]
+        single = [user for user in batch if "\n" in sigs[user]]
+        batch = [user for user in batch if user not in single]
+        if len(batch) > 1:
+            marker = f"sigprobs-{secrets.token_hex(8)}-"
+            text = "".join(
+                f'<span id="{marker}{i}"></span>{sigs[user]}'
+                for i, user in enumerate(batch)
+            )
+            text += f'<span id="{marker}{len(batch)}"></span>'
+            pieces = re.split(
+                f'<span[^>]*? id="{marker}(\\d+)"[^>]*></span>',
+                _unwrap(_render(text, sitedata)),
+            )
+            # pieces alternates between marker numbers and the HTML between them
+            found = [int(index) for index in pieces[1::2]]
+            for j in range(len(found) - 1):
+                fragment = pieces[2 * j + 2]
+                if found[j + 1] == found[j] + 1 and _balanced(fragment):
+                    rendered[batch[found[j]]] = fragment
+            single.extend(user for user in batch if user not in rendered)
+        else:
+            single.extend(batch)
+        for user in single:
+            rendered[user] = _unwrap(_render(sigs[user], sitedata))
+    return rendered
+
+
 def check_fanciness(sig: str) -> Optional[SigError]:
     """Check if a signature contains any wikitext formatting
 
@@ -266,20 +641,15 @@ def check_length(sig: str) -> Optional[SigError]:
 def check_images(sig: str, sitedata: SiteData) -> Optional[SigError]:
     """Check for displayed images in a signature"""
     wikitext = mwph.parse(sig)
+    matcher = sitedata.titles
     for link in wikitext.ifilter_wikilinks():
-        title = link.title
+        title = str(link.title)
         # if it starts with :, it's not a displayed image
         if title.startswith(":"):
             continue
-        # Can't interwiki transclude an image, so the extra safety
-        # in check_links isn't required
-        ns, sep, page = title.partition(":")
-        if not sep:
-            continue
-        if datasources.normal_name(ns) in sitedata.file:
+        if matcher.classify(title)[0] is TitleKind.FILE:
             return SigError.IMAGES
-    else:
-        return None
+    return None
 
 
 def check_transclusion(sig: str, sitedata: SiteData) -> Optional[SigError]:
@@ -287,13 +657,11 @@ def check_transclusion(sig: str, sitedata: SiteData) -> Optional[SigError]:
     wikitext = mwph.parse(sig)
     for templ in wikitext.ifilter_templates():
         title = str(templ.name)
-        for subst in sitedata.subst:
-            # {{!}} isn't actually a template, it's a parser function that
-            # is used to escape pipes and should never be subst'd.
-            if title.startswith(subst) or title == "!":
-                break
-        else:
-            return SigError.TRANSCLUSION
+        # {{!}} isn't actually a template, it's a parser function that
+        # is used to escape pipes and should never be subst'd.
+        if title == "!" or title.startswith(sitedata.subst):
+            continue
+        return SigError.TRANSCLUSION
 
     return None
 
@@ -373,103 +741,217 @@ def check_hrule(sig: str) -> Optional[SigError]:
     return None
 
 
+def _filter_lints(errors: Set[SigError], checks: Checks) -> Set[SigError]:
+    """Drop lint errors for checks that were not requested"""
+    if checks & Checks.OBSOLETE_TAG:
+        return errors
+    return errors - {SigError.OBSOLETE_TAG, SigError.OBSOLETE_FONT_TAG}
+
+
 def batch_check_lint(
     accumulate: Dict[str, str],
-    resultdata: Dict[str, Dict[str, Union[str, List[SigError]]]],
+    resultdata: datatypes.SigRecords,
     sitedata: SiteData,
     checks: Checks,
-) -> Tuple[Dict[str, str], Dict[str, Dict[str, Union[str, List[SigError]]]]]:
+    store: Optional[results.ResultStore] = None,
+    workers: Optional[int] = None,
+) -> Tuple[Dict[str, str], datatypes.SigRecords]:
+    """Lint the accumulated signatures, adding any errors to resultdata
+
+    If a result store is given, signatures linted before (on any site with
+    the same configuration) are not linted again, and new results are
+    stored. Stored results include all lint errors, whatever the checks.
+    Results with errors this version does not know are linted again.
+    If the batch has errors, the signatures are linted individually, on up
+    to workers threads (by default CHECK_WORKERS).
+    """
+
+    lint_checks = checks
+    if store is not None:
+        lint_checks = checks | Checks.OBSOLETE_TAG
+        known = store.get_many("lint", accumulate.values(), sitedata.fingerprint)
+        reused = 0
+        for auser in list(accumulate):
+            if accumulate[auser] not in known:
+                continue
+            try:
+                errors = {SigError(error) for error in known[accumulate[auser]]}
+            except ValueError:
+                # Stored before an error was renamed or removed, so lint the
+                # signature again, which replaces the stored result
+                continue
+            asig = accumulate.pop(auser)
+            resultdata.add(auser, asig, _filter_lints(errors, checks))
+            reused += 1
+        logger.debug(f"{reused} lint results reused")
+        if not accumulate:
+            return accumulate, resultdata
+
     logger.debug("Contstructing batched request to linter")
     batch = "\n\n".join(accumulate.values())
-    lint_errors = get_lint_errors(batch, sitedata, checks)
+    lint_errors = get_lint_errors(batch, sitedata, lint_checks)
+    linted: Dict[str, Set[str]] = {}
     if lint_errors:
         # At least one signature has errors. Check them all individually
         userlist = list(accumulate.keys())
+        found = _map_concurrent(
+            lambda asig: get_lint_errors(asig, sitedata, lint_checks),
+            list(accumulate.values()),
+            workers or CHECK_WORKERS,
+        )
         count = 0
-        for auser in userlist:
+        for auser, indiv_lints in zip(userlist, found):
             asig = accumulate.pop(auser)
-            indiv_lints = get_lint_errors(asig, sitedata, checks)
+            linted[asig] = {error.value for error in indiv_lints}
+            indiv_lints = _filter_lints(indiv_lints, checks)
             if indiv_lints:
-                resultdata.setdefault(auser, {})
-                cast(
-                    List[Optional[SigError]],
-                    resultdata[auser].setdefault("errors", []),
-                ).extend(list(indiv_lints))
-                resultdata[auser].setdefault("signature", asig)
+                resultdata.add(auser, asig, indiv_lints)
                 count += 1
         logger.debug(f"{count} users with errors found in batch")
     else:
         logger.debug("No errors in batch")
+        linted = {asig: set() for asig in accumulate.values()}
         accumulate = {}
 
+    if store is not None:
+        store.put_many("lint", linted, sitedata.fingerprint)
     return accumulate, resultdata
 
 
-def main(
-    hostname: str,
-    lastedit: str = "",
-    days: int = 30,
-    checks: datatypes.Checks = datatypes.Checks.DEFAULT,
-    data: Optional[Union[Dict[str, str], List[str]]] = None,
-) -> Optional[Dict]:
-    """Site-level report mode: Iterate over signatures and check for errors"""
-    logger.info(f"Processing signatures for {hostname}")
-    total = 0
+def open_result_store(config: Dict[str, Any]) -> Optional[results.ResultStore]:
+    """Open the result store shared between runs, if one is configured
+
+    The result_store setting may be a path, or true for the default location
+    in the data directory.
+    """
+    path = config.get("result_store")
+    if not path:
+        return None
+    if path is True:
+        path = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "../data", results.RESULTS_DB
+        )
+    return results.ResultStore(path)
+
+
+def in_shard(user: str, shard: Tuple[int, int]) -> bool:
+    """Whether a listed user belongs to the i-th of N shards"""
+    index, count = shard
+    return zlib.crc32(user.encode("utf-8")) % count == index
 
-    sitedata = datasources.get_site_data(hostname)
-    dbname = sitedata.dbname
 
+def _shard_blocks(shard: Optional[Tuple[int, int]]) -> Iterable[int]:
+    """The database blocks a shard checks, or all of them"""
+    if shard is None:
+        return datasources.BLOCKS
+    return datasources.BLOCKS[shard[0] :: shard[1]]
+
+
+def _sigsource(
+    sitedata: SiteData,
+    lastedit: str,
+    days: int,
+    data: Optional[Union[Dict[str, str], List[str]]],
+    shard: Optional[Tuple[int, int]] = None,
+    active_users: Optional[active.ActiveUsers] = None,
+    since: str = "",
+) -> Iterable[Tuple[str, str]]:
+    """Users and signatures to check, from the database or from input data
+
+    Database users are sharded by the last digits of their user id. Users
+    from input data are sharded by a hash of their name. If active_users is
+    given, database users are found in delta mode.
+    """
     if data is None:
-        sigsource = datasources.iter_active_user_sigs(dbname, lastedit, days)
+        return datasources.iter_active_user_sigs(
+            sitedata.dbname,
+            lastedit,
+            days,
+            _shard_blocks(shard),
+            active=active_users,
+            since=since,
+        )
     elif isinstance(data, list):
-        sigsource = datasources.iter_listed_user_sigs(data, dbname)
+        if shard is not None:
+            data = [user for user in data if in_shard(user, shard)]
+        return datasources.iter_listed_user_sigs(data, sitedata.dbname)
     elif isinstance(data, dict):
-        sigsource = data.items()  # type: ignore
+        if shard is not None:
+            return [(user, sig) for user, sig in data.items() if in_shard(user, shard)]
+        return data.items()
     else:
         raise TypeError(
             "Data is of type %s when None, list, or dict expected" % (type(data))
         )
 
-    resultdata: Dict[str, Dict[str, Union[str, List[SigError]]]] = {}
-    accumulate = {}
-    for user, sig in sigsource:
-        total += 1
-        if not sig:
-            continue
-        try:
-            errors = check_sig(
-                user, sig, sitedata, hostname, checks=checks ^ Checks.LINT
-            )
-            if SigError.PLAIN_FANCY_SIG not in errors:
-                accumulate[user] = evaluate_subst(sig, sitedata)
-        except Exception:
-            logger.error(f"Processing User:{user}: {sig}")
-            raise
-        if errors:
-            resultdata[user] = {"signature": sig, "errors": list(errors)}
-        # Batch requests to lint, since network requests are slow
-        # There is probably a better way to do this with async, but
-        # that's more work.
-        if len(accumulate) >= 5:
-            accumulate, resultdata = batch_check_lint(
-                accumulate, resultdata, sitedata, checks
-            )
 
-    # Catch any sigs that didn't get linted
-    if accumulate:
-        accumulate, resultdata = batch_check_lint(
-            accumulate, resultdata, sitedata, checks
+def _sample_sigs(
+    sitedata: SiteData,
+    lastedit: str,
+    days: int,
+    data: Optional[Union[Dict[str, str], List[str]]],
+    shard: Optional[Tuple[int, int]],
+    size: int,
+) -> List[Tuple[str, str]]:
+    """Up to size of the users _sigsource would return, spread over all of them
+
+    Database users are sampled at random. Input data is sampled at even
+    intervals, so the signatures of listed users are only looked up for the
+    sample.
+    """
+    if data is None:
+        return datasources.sample_active_user_sigs(
+            sitedata.dbname, lastedit, days, size, _shard_blocks(shard)
         )
+    if isinstance(data, dict):
+        entries: List[Any] = list(data.items())
+    else:
+        entries = list(data)
+    if shard is not None:
+        entries = [
+            entry
+            for entry in entries
+            if in_shard(entry[0] if isinstance(data, dict) else entry, shard)
+        ]
+    sample = entries[:: max(len(entries) // size, 1)][:size] if size else []
+    if isinstance(data, dict):
+        return sample
+    return list(datasources.iter_listed_user_sigs(sample, sitedata.dbname))
+
+
+def _count_candidates(
+    sitedata: SiteData,
+    lastedit: str,
+    days: int,
+    data: Optional[Union[Dict[str, str], List[str]]],
+    shard: Optional[Tuple[int, int]] = None,
+) -> int:
+    """Number of users _sigsource will return, estimated for database shards"""
+    if data is None:
+        candidates = datasources.count_active_user_sigs(sitedata.dbname, lastedit, days)
+        if shard is not None:
+            candidates = math.ceil(candidates / shard[1])
+        return candidates
+    elif shard is not None:
+        return sum(in_shard(user, shard) for user in data)
+    return len(data)
 
-    # Collect stats, and generate json file
-    stats = {}
-    stats["total"] = len(resultdata)
-    for user, line in resultdata.items():
-        line["errors"] = [error.value for error in cast(List[SigError], line["errors"])]  # type: ignore
-        for error in line.get("errors", []):
-            stats[error] = stats.setdefault(error, 0) + 1
 
+def _build_report(
+    resultdata: datatypes.SigRecords,
+    hostname: str,
+    lastedit: str,
+    days: int,
+    shard: Optional[Tuple[int, int]] = None,
+    final: bool = False,
+) -> Dict[str, Any]:
+    """Serialize the flagged signatures, with stats and metadata
+
+    If final is set, the records are released as they are serialized.
+    """
     meta = {"last_update": datetime.datetime.utcnow().isoformat(), "site": hostname}
+    if shard is not None:
+        meta["shard"] = "%s/%s" % shard
     if lastedit:
         meta["active_since"] = datetime.datetime.strptime(
             lastedit, "%Y%m%d%H%M%S"
@@ -478,16 +960,503 @@ def main(
         meta["active_since"] = (
             datetime.datetime.utcnow() - datetime.timedelta(days=days)
         ).isoformat()
+    stats = resultdata.stats()
+    return {"errors": stats, "meta": meta, "sigs": resultdata.export(clear=final)}
 
-    outdata = {
-        "errors": stats,
-        "meta": meta,
-        "sigs": {key: resultdata[key] for key in sorted(resultdata)},
-    }
+
+@subst_cache()
+def main(
+    hostname: str,
+    lastedit: str = "",
+    days: int = 30,
+    checks: datatypes.Checks = datatypes.Checks.DEFAULT,
+    data: Optional[Union[Dict[str, str], List[str]]] = None,
+    render: bool = False,
+    shard: Optional[Tuple[int, int]] = None,
+    publish: Optional[Callable[[Dict], None]] = None,
+    active_path: Optional[str] = None,
+    since: str = "",
+) -> Optional[Dict]:
+    """Site-level report mode: Iterate over signatures and check for errors
+
+    If render is set, flagged signatures are rendered to HTML and stored in
+    the report as html_sig. If shard is (i, N), only the i-th of N disjoint
+    parts of the users is checked; see merge_shards to combine them.
+
+    If publish is given, it is called with a partial report, marked as such
+    in its meta along with the fraction of users checked so far, every
+    partial_every users or partial_interval seconds as set in config.json.
+
+    If active_path is given, active users are found in delta mode: only
+    edits made since the high-water mark since are queried, and merged with
+    the active users kept in active_path. The new high-water mark is stored
+    in the report's meta.
+    """
+    logger.info(f"Processing signatures for {hostname}")
+    total = 0
+
+    config = load_config(hostname)
+    sitedata = datasources.get_site_data(hostname)
+    store = open_result_store(config)
+    workers = int(config.get("check_concurrency", CHECK_WORKERS))
+
+    active_users = active.ActiveUsers(active_path) if active_path else None
+    sigsource = _sigsource(sitedata, lastedit, days, data, shard, active_users, since)
+    if publish is not None:
+        if active_users is not None:
+            # Counting would scan all the revisions delta mode avoids, so use
+            # the active users of the previous run instead
+            candidates = len(active_users)
+        else:
+            candidates = _count_candidates(sitedata, lastedit, days, data, shard)
+        partial_every = int(config.get("partial_every", 0))
+        partial_interval = float(config.get("partial_interval", 0))
+        published = (0, time.monotonic())
+
+    resultdata = datatypes.SigRecords()
+    accumulate = {}
+    sigiter = iter(sigsource)
+    while True:
+        chunk = list(itertools.islice(sigiter, SUBST_BATCH_SIZE))
+        if not chunk:
+            break
+        # Expand the signatures as they are checked, and then their
+        # expansions (which are expanded again by some checks), a chunk at a
+        # time
+        sigs = [normalize_sig(sig) for user, sig in chunk if sig]
+        evaluate_subst_batch(sigs, sitedata)
+        evaluate_subst_batch((evaluate_subst(sig, sitedata) for sig in sigs), sitedata)
+
+        for user, sig in chunk:
+            total += 1
+            if not sig:
+                continue
+            try:
+                errors = check_sig(
+                    user,
+                    sig,
+                    sitedata,
+                    hostname,
+                    checks=checks ^ Checks.LINT,
+                    workers=workers,
+                )
+                if SigError.PLAIN_FANCY_SIG not in errors:
+                    accumulate[user] = evaluate_subst(normalize_sig(sig), sitedata)
+            except Exception:
+                logger.error(f"Processing User:{user}: {sig}")
+                raise
+            resultdata.add(user, sig, errors)
+            # Batch requests to lint, since network requests are slow
+            # There is probably a better way to do this with async, but
+            # that's more work.
+            if len(accumulate) >= LINT_BATCH_SIZE:
+                accumulate, resultdata = batch_check_lint(
+                    accumulate, resultdata, sitedata, checks, store, workers
+                )
+
+        if publish is not None and (
+            (partial_every and total - published[0] >= partial_every)
+            or (
+                partial_interval and time.monotonic() - published[1] >= partial_interval
+            )
+        ):
+            partial = _build_report(resultdata, hostname, lastedit, days, shard)
+            partial["meta"]["partial"] = True
+            partial["meta"]["progress"] = (
+                round(min(total / candidates, 1.0), 4) if candidates else 0.0
+            )
+            if partial_interval:
+                # Lets readers tell a run that died from one still going
+                partial["meta"]["partial_interval"] = partial_interval
+            publish(partial)
+            published = (total, time.monotonic())
+
+    # Catch any sigs that didn't get linted
+    if accumulate:
+        accumulate, resultdata = batch_check_lint(
+            accumulate, resultdata, sitedata, checks, store, workers
+        )
+    if store is not None:
+        store.close()
+    if render:
+        logger.info(f"Rendering {len(resultdata)} signatures")
+        rendered = render_sigs(
+            {
+                user: evaluate_subst(record.signature, sitedata)
+                for user, record in resultdata.records.items()
+            },
+            sitedata,
+        )
+        for user, html_sig in rendered.items():
+            resultdata.records[user].html_sig = html_sig
+
+    # Collect stats, and generate json file
+    outdata = _build_report(resultdata, hostname, lastedit, days, shard, final=True)
+    if active_users is not None:
+        outdata["meta"]["high_water_mark"] = active_users.high_water_mark() or since
+        active_users.close()
+
+    for host, wait in datasources.get_throttle_wait().items():
+        logger.info(f"Waited {wait:.1f} s for the {host} rate limit")
+    for host, stats in datasources.get_transfer_stats().items():
+        logger.info(
+            f"{stats['requests']} requests to {host}, {stats['sent']} bytes sent, "
+            f"{stats['received']} bytes received"
+        )
 
     return outdata
 
 
+@subst_cache()
+def check_users(
+    users: List[str],
+    sitedata: SiteData,
+    checks: Checks = Checks.DEFAULT,
+    store: Optional[results.ResultStore] = None,
+    render: bool = False,
+    workers: Optional[int] = None,
+) -> datatypes.SigRecords:
+    """Check the current signatures of users, as a report run would"""
+    props = datasources.get_users_properties(users, sitedata.dbname)
+    sigs = {
+        user: user_props.nickname
+        for user, user_props in props.items()
+        if user_props.fancysig and user_props.nickname
+    }
+    texts = [normalize_sig(sig) for sig in sigs.values()]
+    evaluate_subst_batch(texts, sitedata)
+    evaluate_subst_batch((evaluate_subst(text, sitedata) for text in texts), sitedata)
+
+    resultdata = datatypes.SigRecords()
+    accumulate = {}
+    for user, sig in sigs.items():
+        errors = check_sig(
+            user,
+            sig,
+            sitedata,
+            sitedata.hostname,
+            checks=checks ^ Checks.LINT,
+            workers=workers,
+        )
+        resultdata.add(user, sig, errors)
+        if SigError.PLAIN_FANCY_SIG not in errors:
+            accumulate[user] = evaluate_subst(normalize_sig(sig), sitedata)
+        if len(accumulate) >= LINT_BATCH_SIZE:
+            accumulate, resultdata = batch_check_lint(
+                accumulate, resultdata, sitedata, checks, store, workers
+            )
+    if accumulate:
+        batch_check_lint(accumulate, resultdata, sitedata, checks, store, workers)
+    if render:
+        rendered = render_sigs(
+            {
+                user: evaluate_subst(record.signature, sitedata)
+                for user, record in resultdata.records.items()
+            },
+            sitedata,
+        )
+        for user, html_sig in rendered.items():
+            resultdata.records[user].html_sig = html_sig
+    return resultdata
+
+
+def follow(
+    hostname: str,
+    output: Optional[str] = None,
+    checks: datatypes.Checks = datatypes.Checks.DEFAULT,
+    render: bool = False,
+    url: str = datasources.EVENTSTREAM_URL,
+    retry: Optional[float] = datasources.RECONNECT_DELAY,
+) -> None:
+    """Continuous mode: check users as they edit discussion pages
+
+    Edits are taken from a recent changes event stream. The editors are
+    checked in batches, written once FOLLOW_BATCH_SIZE users are waiting or
+    follow_interval seconds have passed, whether or not more events arrive.
+    Each user is checked at most once every follow_recheck seconds, and
+    their results replace their entries in the site's report, which must
+    already exist. If the report file was replaced in the meantime, as by a
+    full run, the batch is merged into the new one. The stream is resumed
+    from the last event included in the report. If retry is None, this
+    returns when the stream is closed.
+    """
+    path = output_path(output, hostname)
+    if path is None:
+        raise ValueError("--follow needs a report file to update")
+    with path.open() as f:
+        report = json.load(f)
+    # When the report was last read or written here
+    mtime = path.stat().st_mtime_ns
+    config = load_config(hostname)
+    interval = float(config.get("follow_interval", FOLLOW_INTERVAL))
+    recheck = float(config.get("follow_recheck", FOLLOW_RECHECK))
+    workers = int(config.get("check_concurrency", CHECK_WORKERS))
+    sitedata = datasources.get_site_data(hostname)
+    store = open_result_store(config)
+
+    last_event_id = report["meta"].get("last_event_id", "")
+    # Users waiting to be checked, and when users were last checked
+    pending: Dict[str, None] = {}
+    checked: Dict[str, float] = {}
+    flushed = time.monotonic()
+
+    def flush() -> None:
+        nonlocal report, mtime, flushed
+        users = list(pending)
+        pending.clear()
+        logger.info(f"Checking {len(users)} users")
+        resultdata = check_users(users, sitedata, checks, store, render, workers)
+        if path.stat().st_mtime_ns != mtime:
+            # Replaced since, e.g. by a full run, so merge into the new report
+            logger.info(f"Reloading {path}")
+            with path.open() as f:
+                report = json.load(f)
+        sigs = {
+            user: info for user, info in report["sigs"].items() if user not in users
+        }
+        sigs.update(resultdata.export(clear=True))
+        sigs = {user: sigs[user] for user in sorted(sigs)}
+        report = {
+            "errors": reports.count_errors(sigs),
+            "meta": {
+                **report["meta"],
+                "last_update": datetime.datetime.utcnow().isoformat(),
+                "last_event_id": last_event_id,
+            },
+            "sigs": sigs,
+        }
+        # Updates are not archived, they belong to the last full report
+        write_report(report, output, hostname, True, archive=False)
+        mtime = path.stat().st_mtime_ns
+
+        flushed = time.monotonic()
+        for user in users:
+            checked[user] = flushed
+        for user in [
+            user for user, when in checked.items() if flushed - when >= recheck
+        ]:
+            del checked[user]
+
+    events = datasources.iter_events(url, last_event_id, retry)
+    try:
+        # Woken up without an event now and then, so a batch is written on
+        # time even when the wiki is quiet
+        for event in datasources.heartbeat(events, min(interval, FOLLOW_HEARTBEAT)):
+            if event is not None and event.id:
+                last_event_id = event.id
+            change = datasources.parse_change(event) if event is not None else None
+            if change is not None and datasources.is_talk_edit(change, hostname):
+                user = change["user"]
+                if time.monotonic() - checked.get(user, -math.inf) >= recheck:
+                    pending[user] = None
+            if pending and (
+                len(pending) >= FOLLOW_BATCH_SIZE
+                or time.monotonic() - flushed >= interval
+            ):
+                flush()
+        if pending:
+            flush()
+    finally:
+        if store is not None:
+            store.close()
+
+
+def estimate(
+    hostname: str,
+    lastedit: str = "",
+    days: int = 30,
+    checks: datatypes.Checks = datatypes.Checks.DEFAULT,
+    data: Optional[Union[Dict[str, str], List[str]]] = None,
+    render: bool = False,
+    shard: Optional[Tuple[int, int]] = None,
+    sample_size: int = ESTIMATE_SAMPLE_SIZE,
+) -> Dict[str, Any]:
+    """Dry run: project the cost of a report run without making it
+
+    Candidate signatures are counted, and a sample of them is run through the
+    checks that need no network requests. From the share of the sample that
+    needs expanding or linting, the number of expandtemplates and lint
+    requests for the whole run is projected, as a range, along with how long
+    they would take at the configured rate limit and check concurrency, as
+    a report run would use them. Rendering
+    is not included, since it depends on how many signatures are flagged.
+    If shard is given, the estimate is for that shard only.
+    """
+    config = load_config(hostname)
+    sitedata = datasources.get_site_data(hostname)
+
+    start = time.perf_counter()
+    candidates = _count_candidates(sitedata, lastedit, days, data, shard)
+    sample = _sample_sigs(sitedata, lastedit, days, data, shard, sample_size)
+    query_time = time.perf_counter() - start
+
+    counts = {"plain": 0, "lint": 0, "expand": 0, "unbatchable": 0}
+    sample_errors: Dict[str, int] = {}
+    for user, sig in sample:
+        if not sig:
+            continue
+        sig = html.unescape(sig)
+        local = {check_length(sig)} if checks & Checks.LENGTH else set()
+        if checks & Checks.FANCY:
+            local.add(check_fanciness(sig))
+        for error in local - {None}:
+            key = cast(SigError, error).value
+            sample_errors[key] = sample_errors.get(key, 0) + 1
+        if SigError.PLAIN_FANCY_SIG in local:
+            counts["plain"] += 1
+            continue
+        counts["lint"] += 1
+        text = sitedata.strip_subst(sig)
+        if _needs_expansion(text):
+            counts["expand"] += 1
+            if not _batchable(text):
+                counts["unbatchable"] += 1
+
+    scale = candidates / len(sample) if sample else 0.0
+
+    def project(count: int) -> int:
+        return math.ceil(count * scale)
+
+    expand = project(counts["expand"])
+    unbatchable = project(counts["unbatchable"])
+    chunks = math.ceil(candidates / SUBST_BATCH_SIZE)
+    # Each chunk needing expansion takes one batched request for the
+    # signatures, and at most one more for their expansions
+    expand_requests = (
+        min(chunks, expand - unbatchable) + unbatchable,
+        2 * min(chunks, expand - unbatchable) + 2 * unbatchable,
+    )
+    lint = project(counts["lint"]) if checks & Checks.LINT else 0
+    # A lint batch with errors in it is followed by a request per signature,
+    # made concurrently
+    lint_batches = math.ceil(lint / LINT_BATCH_SIZE)
+    lint_requests = (lint_batches, lint_batches + lint)
+
+    rate = float(datasources.transport_options(config.get("http"))["rate_limit"])
+    concurrency = max(int(config.get("check_concurrency", CHECK_WORKERS)), 1)
+    latency = float(config.get("request_latency", DEFAULT_REQUEST_LATENCY))
+
+    def duration(requests: int, concurrent: int = 0) -> float:
+        """Seconds for requests, of which concurrent run on several threads"""
+        return round(
+            max(
+                (requests + concurrent) / rate,
+                (requests + concurrent / concurrency) * latency,
+            ),
+            1,
+        )
+
+    return {
+        "site": hostname,
+        "candidates": candidates,
+        "sample": len(sample),
+        "sample_query_seconds": round(query_time, 1),
+        "sample_errors": sample_errors,
+        "requests": {
+            "expandtemplates": {"min": expand_requests[0], "max": expand_requests[1]},
+            "lint": {"min": lint_requests[0], "max": lint_requests[1]},
+        },
+        "rate_limit": rate,
+        "concurrency": concurrency,
+        "request_latency": latency,
+        "seconds": {
+            "min": duration(expand_requests[0] + lint_requests[0]),
+            "max": duration(expand_requests[1] + lint_batches, lint),
+        },
+    }
+
+
+def profile_targets() -> List[Dict[str, Any]]:
+    """Functions timed by --profile, as arguments for profiling.instrument"""
+    module = sys.modules[__name__]
+    return [
+        dict(
+            module=module,
+            prefix="check: ",
+            names=[
+                "check_links",
+                "check_length",
+                "check_fanciness",
+                "get_lint_errors",
+                "check_tildes",
+                "check_images",
+                "check_transclusion",
+                "check_post_subst_length",
+                "check_impersonation",
+                "check_pipes",
+                "check_line_breaks",
+            ],
+        ),
+        dict(
+            module=module,
+            prefix="sigprobs: ",
+            names=[
+                "evaluate_subst",
+                "evaluate_subst_batch",
+                "batch_check_lint",
+                "render_sigs",
+            ],
+        ),
+        dict(
+            module=datasources,
+            prefix="datasources: ",
+            names=[
+                "get_site_data",
+                "iter_active_user_sigs",
+                "iter_listed_user_sigs",
+                "check_user_exists",
+            ],
+        ),
+        dict(module=datasources.db, prefix="db: ", names=["get_user_properties"]),
+        dict(module=mwph, prefix="mwparserfromhell: ", names=["parse"]),
+        # Requests are named by endpoint rather than by function
+        dict(
+            module=datasources, names=["backoff_retry"], namer=profiling.endpoint_name
+        ),
+        dict(
+            module=datasources.api,
+            names=["backoff_retry"],
+            namer=profiling.endpoint_name,
+        ),
+    ]
+
+
+def write_profile(
+    profile: profiling.Profile, output: Optional[str], hostname: str
+) -> None:
+    """Print a profile's breakdown, and save it next to the report"""
+    print(f"Profile for {hostname}:", file=sys.stderr)
+    print(profile.table(), file=sys.stderr)
+    path = output_path(output, hostname)
+    if path is None:
+        return
+    data = {
+        "site": hostname,
+        "last_update": datetime.datetime.utcnow().isoformat(),
+        **profile.as_dict(),
+        "throttle_wait": datasources.get_throttle_wait(),
+        "transfer": datasources.get_transfer_stats(),
+    }
+    with reports.atomic_open(str(path.with_suffix(reports.PROFILE_SUFFIX))) as f:
+        json.dump(data, f, indent=1)
+    if profile.cprofile is not None:
+        profile.cprofile.dump_stats(str(path.with_suffix(".pstats")))
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse an I/N shard argument"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not of the form I/N")
+    if not 0 <= index < count <= len(datasources.BLOCKS):
+        raise argparse.ArgumentTypeError(
+            f"Shard must be between 0/N and {len(datasources.BLOCKS) - 1}/N, "
+            f"with N at most {len(datasources.BLOCKS)}"
+        )
+    return index, count
+
+
 def handle_args(args=sys.argv[1:]):
     check_flags = Checks.__members__
     parser = argparse.ArgumentParser(prog=__file__)
@@ -543,13 +1512,111 @@ def handle_args(args=sys.argv[1:]):
         dest="overwrite",
         help="Do not overwrite existing files",
     )
+    parser.add_argument(
+        "--job",
+        type=int,
+        help="ID of the queued job this run belongs to. The job is marked as "
+        "done or failed in the --jobs-db database when the run ends.",
+    )
+    parser.add_argument(
+        "--jobs-db",
+        type=str,
+        default=os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "../data", jobs.JOBS_DB
+        ),
+        help="Job queue database used with --job.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record time spent in each check and upstream endpoint, print a "
+        "breakdown, and save it as <hostname>.profile.json next to the report.",
+    )
+    parser.add_argument(
+        "--cprofile",
+        action="store_true",
+        help="Also save a cProfile dump as <hostname>.pstats. Implies --profile.",
+    )
+    parser.add_argument(
+        "--render",
+        action="store_true",
+        help="Render flagged signatures to HTML and include them in the report.",
+    )
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="I/N",
+        help="Only check the I-th of N disjoint parts of the users (counting "
+        "from 0), and write the result to the shards/ subdirectory of the "
+        "output directory, to be combined with --merge.",
+    )
+    sharding.add_argument(
+        "--merge",
+        type=int,
+        metavar="N",
+        help="Do not check any signatures. Instead, combine the results of "
+        "the N shards of a sharded run into a report.",
+    )
+    parser.add_argument(
+        "--run-id",
+        default="",
+        help="Identifies the shards of a sharded run, so that --merge does "
+        "not pick up shards left over from another run.",
+    )
+    parser.add_argument(
+        "--wait",
+        type=float,
+        default=0,
+        help="With --merge, seconds to wait for all shards to be written.",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Only query edits made since the previous report, and combine "
+        "them with the active users recorded by earlier --delta runs.",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Keep running, and check users as they edit discussion pages, "
+        "updating the existing report of a single site.",
+    )
+    parser.add_argument(
+        "--stream-url",
+        default=datasources.EVENTSTREAM_URL,
+        help="Recent changes event stream to follow (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="Do not run the report. Instead, print a JSON estimate of the "
+        "number of API requests it would make and how long it would take.",
+    )
     args = parser.parse_args(args)
+    if args.delta and (args.input or args.shard is not None or args.merge):
+        parser.error("--delta can not be used with --input, --shard or --merge")
+    if args.follow and (
+        len(args.hostnames) != 1
+        or args.input
+        or args.shard is not None
+        or args.merge
+        or args.estimate
+        or args.delta
+    ):
+        parser.error(
+            "--follow takes a single site, and can not be used with --input, "
+            "--shard, --merge, --estimate or --delta"
+        )
 
     kwargs = dict(
         days=args.days,
         checks=functools.reduce(operator.or_, args.checks),
         data=json.load(args.input) if args.input else None,
+        render=args.render,
     )
+    if args.shard is not None:
+        kwargs["shard"] = args.shard
     if len(args.output) == len(args.hostnames):
         outputs = args.output
     elif len(args.output) == 1 and not args.output[0].endswith(".json"):
@@ -562,33 +1629,230 @@ def handle_args(args=sys.argv[1:]):
             "If multiple sites are given, input data must not include signatures"
         )
 
-    for hostname, output in zip(args.hostnames, outputs):
-        result = main(hostname, **kwargs)
-        with output_file(
-            output, hostname, (args.overwrite if args.overwrite is not None else True)
-        ) as f:
-            json.dump(result, f)
+    with (
+        jobs.running(args.jobs_db, args.job)
+        if args.job is not None
+        else contextlib.nullcontext()
+    ):
+        for hostname, output in zip(args.hostnames, outputs):
+            datasources.configure_transport(load_config(hostname).get("http"))
+            if args.estimate:
+                print(json.dumps(estimate(hostname, **kwargs)))
+                continue
+            if args.follow:
+                follow(
+                    hostname,
+                    output,
+                    kwargs["checks"],
+                    args.render,
+                    args.stream_url,
+                )
+                continue
+            if args.merge is not None:
+                shards = read_shards(
+                    output, hostname, args.merge, args.run_id, args.wait
+                )
+                write_report(
+                    reports.merge_shards(list(shards.values())),
+                    output,
+                    hostname,
+                    (args.overwrite if args.overwrite is not None else True),
+                )
+                for path in shards:
+                    path.unlink()
+                continue
+            with (
+                profiling.collect(profile_targets(), cprofile=args.cprofile)
+                if args.profile or args.cprofile
+                else contextlib.nullcontext()
+            ) as profile:
+                config = load_config(hostname)
+                site_kwargs = dict(kwargs)
+                if args.shard is None and (
+                    config.get("partial_every") or config.get("partial_interval")
+                ):
+                    site_kwargs["publish"] = functools.partial(
+                        write_partial, output=output, hostname=hostname
+                    )
+                if args.delta:
+                    site_kwargs.update(delta_args(output, hostname))
+                try:
+                    result = main(hostname, **site_kwargs)
+                except BaseException:
+                    # Nothing will replace it, so stop showing it as a run
+                    # in progress
+                    remove_partial(output, hostname)
+                    raise
+            if args.shard is not None:
+                write_shard(result, output, hostname, args.shard, args.run_id)
+            else:
+                write_report(
+                    result,
+                    output,
+                    hostname,
+                    (args.overwrite if args.overwrite is not None else True),
+                )
+            if profile is not None:
+                write_profile(profile, output, hostname)
+
+
+def write_report(
+    result: Optional[Dict],
+    output: Optional[str],
+    hostname: str,
+    overwrite: bool,
+    archive: bool = True,
+) -> None:
+    """Write a report to the output location, plus any configured extra formats
+
+    Unless archive is false, the report is also added to the site's history.
+    """
+    text = json.dumps(result)
+    with output_file(output, hostname, overwrite) as f:
+        f.write(text)
+
+    path = output_path(output, hostname)
+    if path is None or not result:
+        return
+    # Compressed copies of the report and of the per-error view, so the
+    # webservice can send them as-is to clients that accept gzip.
+    reports.write_gzip(text, str(path.with_suffix(reports.GZIP_SUFFIX)))
+    reports.write_gzip(
+        json.dumps(reports.by_error(reports.DictReport(result))),
+        str(path.with_suffix(reports.ERRORS_GZIP_SUFFIX)),
+    )
+    config = load_config(hostname)
+    if config.get("report_backend") == "sqlite":
+        reports.write_sqlite(result, str(path.with_suffix(reports.SQLITE_SUFFIX)))
+    if archive:
+        with reports.ReportHistory(
+            str(path.with_suffix(reports.HISTORY_SUFFIX))
+        ) as history:
+            history.add(result)
+    # The complete report supersedes any partial one from this run
+    remove_partial(output, hostname)
+
+
+def write_partial(result: Dict, output: Optional[str], hostname: str) -> None:
+    """Publish a partial report while the run continues"""
+    path = output_path(output, hostname)
+    if path is None:
+        return
+    with reports.atomic_open(str(path.with_suffix(reports.PARTIAL_SUFFIX))) as f:
+        json.dump(result, f)
+
+
+def remove_partial(output: Optional[str], hostname: str) -> None:
+    """Remove the partial report of a run, if there is one"""
+    path = output_path(output, hostname)
+    if path is not None:
+        path.with_suffix(reports.PARTIAL_SUFFIX).unlink(missing_ok=True)
+
+
+def delta_args(output: Optional[str], hostname: str) -> Dict[str, str]:
+    """Where delta mode keeps the active users of a site, and the high-water
+    mark of the previous run, from its report"""
+    path = output_path(output, hostname)
+    if path is None:
+        raise ValueError("--delta needs a report file to continue from")
+    try:
+        with path.open() as f:
+            since = json.load(f)["meta"].get("high_water_mark", "")
+    except FileNotFoundError:
+        since = ""
+    return {
+        "active_path": str(path.with_suffix(active.ACTIVE_SUFFIX)),
+        "since": since,
+    }
 
 
-def output_file(output: Optional[str], hostname: str, overwrite: bool) -> TextIO:
+def shard_path(
+    output: Optional[str], hostname: str, shard: Tuple[int, int], run_id: str = ""
+) -> Optional[pathlib.Path]:
+    """Resolve the path one shard of a sharded run is written to"""
+    path = output_path(output, hostname)
+    if path is None:
+        return None
+    prefix = f"{hostname}.{run_id}" if run_id else hostname
+    return path.parent.joinpath(
+        reports.SHARD_DIR, "%s.%s-of-%s.json" % (prefix, *shard)
+    )
+
+
+def write_shard(
+    result: Optional[Dict],
+    output: Optional[str],
+    hostname: str,
+    shard: Tuple[int, int],
+    run_id: str = "",
+) -> None:
+    """Write the result of one shard, for a later --merge"""
+    path = shard_path(output, hostname, shard, run_id)
+    if path is None:
+        json.dump(result, sys.stdout)
+        return
+    path.parent.mkdir(exist_ok=True)
+    with reports.atomic_open(str(path)) as f:
+        json.dump(result, f)
+
+
+def read_shards(
+    output: Optional[str], hostname: str, count: int, run_id: str = "", wait: float = 0
+) -> Dict[pathlib.Path, Dict]:
+    """Load the results of all shards of a sharded run, keyed by path
+
+    Waits up to wait seconds for missing shards, then raises
+    FileNotFoundError if any are still missing.
+    """
+    paths = [
+        shard_path(output, hostname, (index, count), run_id) for index in range(count)
+    ]
+    if None in paths:
+        raise ValueError("Shards can not be merged from stdout")
+    deadline = time.monotonic() + wait
+    while True:
+        missing = [path for path in paths if not cast(pathlib.Path, path).exists()]
+        if not missing or time.monotonic() >= deadline:
+            break
+        logger.info(f"Waiting for {len(missing)} of {count} shards")
+        time.sleep(SHARD_POLL_INTERVAL)
+    if missing:
+        raise FileNotFoundError(f"Missing shards: {', '.join(map(str, missing))}")
+
+    shards = {}
+    for path in cast(List[pathlib.Path], paths):
+        with path.open() as f:
+            shards[path] = json.load(f)
+    return shards
+
+
+def output_path(output: Optional[str], hostname: str) -> Optional[pathlib.Path]:
+    """Resolve the path a report will be written to, or None for stdout"""
     if output == "-":
-        return sys.stdout
+        return None
+    elif not output:
+        out_dir = (
+            pathlib.Path(__file__).resolve(strict=True).parent.parent.joinpath("data")
+        )
     else:
-        if not output:
-            out_dir = (
-                pathlib.Path(__file__)
-                .resolve(strict=True)
-                .parent.parent.joinpath("data")
-            )
+        path = pathlib.Path(output)
+        if path.is_dir():
+            out_dir = path.resolve(strict=True)
         else:
-            path = pathlib.Path(output)
-            if path.is_dir():
-                out_dir = path.resolve(strict=True)
-            else:
-                return path.open("w") if overwrite else path.open("x")
+            return path
 
-        out_file = out_dir.joinpath(f"{hostname}.json")
-        return out_file.open("w") if overwrite else out_file.open("x")
+    return out_dir.joinpath(f"{hostname}.json")
+
+
+def output_file(
+    output: Optional[str], hostname: str, overwrite: bool
+) -> ContextManager[TextIO]:
+    path = output_path(output, hostname)
+    if path is None:
+        return sys.stdout
+    # The report is replaced atomically, so the webservice keeps serving the
+    # previous report until the new one is complete.
+    return reports.atomic_open(str(path), overwrite)
 
 
 if __name__ == "__main__":
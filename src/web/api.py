@@ -3,12 +3,13 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 # Copyright 2020 AntiCompositeNumber
 
-import flask
-import os
 import json
+
+import flask
 from flask_restx import Api, Resource, fields  # type: ignore
 
 from . import resources
+import reports
 
 bp = flask.Blueprint("api", __name__, url_prefix="/api")
 api = Api(bp, prefix="/v1", title="Signatures API", version="1.0")
@@ -47,6 +48,90 @@ class Check(Resource):
 
         return data._asdict()
 
+    @api.response(202, "Check queued")
+    @api.response(400, "Invalid username")
+    @api.response(404, "Site not found")
+    @api.response(503, "Too many checks queued")
+    def post(self, site, username):
+        """Queues a check of a single user's signature
+
+        Use this for signatures that may take longer to check than a request
+        is allowed to take. Returns the queued job; poll the URL in the
+        Location header for the result.
+        """
+        signature = flask.request.values.get("signature", "")
+        try:
+            job = resources.check_user_async(site, username, signature)
+        except ValueError as err:
+            flask.abort(400, str(err))
+        return (
+            check_job(job),
+            202,
+            {"Location": api.url_for(CheckJob, job_id=job.id)},
+        )
+
+
+def check_job(job):
+    """Check job status, with the result decoded once the job is done"""
+    data = job._asdict()
+    if job.status == "done":
+        data["result"] = json.loads(job.result)
+    return data
+
+
+@api.route("/check/jobs/<int:job_id>")
+@api.param(
+    "wait",
+    f"Seconds to wait for the job to finish before responding, at most "
+    f"{resources.MAX_CHECK_WAIT}",
+    type=float,
+)
+class CheckJob(Resource):
+    @api.response(200, "Success")
+    @api.response(400, "Invalid wait")
+    @api.response(404, "Job not found")
+    def get(self, job_id):
+        """Status of a queued signature check, and its result once done
+
+        The status is one of queued, running, done or failed. When done, the
+        result is a UserReport; when failed, it is the error message.
+        """
+        try:
+            wait = float(flask.request.values.get("wait", 0))
+        except ValueError:
+            flask.abort(400)
+        return check_job(resources.get_check_job(job_id, wait))
+
+
+@api.route("/check/<site>")
+class BulkCheck(Resource):
+    @api.produces(["application/x-ndjson"])
+    @api.response(200, "Success, one UserReport per line")
+    @api.response(400, "Invalid request, or too many users")
+    @api.response(404, "Site not found")
+    def post(self, site):
+        """Checks many users' signatures for problems
+
+        The request body is a JSON list of usernames, [username, signature]
+        pairs, or objects with "username" and optional "signature" keys. If no
+        signature is given, the user's current signature is checked. Results
+        are streamed as newline-delimited JSON, in the same order as the
+        request, without the rendered signature.
+        """
+        entries = resources.parse_bulk_check(flask.request.get_json(silent=True))
+        try:
+            results = resources.check_users(site, entries)
+        except ValueError as err:
+            flask.abort(400, str(err))
+
+        def generate():
+            for data in results:
+                yield json.dumps(resources.serialize_check(data)) + "\n"
+
+        return flask.Response(
+            flask.stream_with_context(generate()), mimetype="application/x-ndjson"
+        )
+
 
 @api.route("/reports")
 class Reports(Resource):
@@ -56,103 +141,159 @@ class Reports(Resource):
         return sites
 
 
-@api.param("purge", "Force generation of a new report", type=bool)
+def job_accepted(job):
+    """Response for a purge request, pointing at the job's status"""
+    return (
+        job._asdict(),
+        202,
+        {"Location": api.url_for(ReportsSiteJobs, site=job.site)},
+    )
+
+
+@api.param(
+    "format",
+    "Output format; may be 'json' (default), or 'ndjson' or 'csv' to stream "
+    "one line per user",
+)
+@api.param(
+    "purge",
+    "Queue generation of a new report. Returns 202 and the queued job, unless "
+    "the report is less than a day old.",
+    type=bool,
+)
+@api.param("limit", "Maximum number of users to return", type=int)
+@api.param("after", "Only return users after this username (from 'continue')")
+@api.produces(["application/json", "application/x-ndjson", "text/csv"])
 @api.route("/reports/<string:site>")
 class ReportsSite(Resource):
     @api.response(200, "Success")
+    @api.response(304, "Report not modified")
+    @api.response(400, "Invalid limit")
     @api.response(404, "Report not found")
+    @resources.conditional_report(
+        variant=resources.precompressed_variant(reports.GZIP_SUFFIX),
+        vary="Accept-Encoding",
+    )
     def get(self, site):
         """Batch report for a single site, organized by user"""
         if flask.request.values.get("purge", False):
-            resources.purge_site(site)
+            job = resources.purge_site(site)
+            if job is not None:
+                return job_accepted(job)
 
-        try:
-            with open(
-                os.path.join(flask.current_app.config["data_dir"], site + ".json")
-            ) as f:
-                data = json.load(f)
-        except FileNotFoundError:
-            flask.abort(404)
-        return data
+        precompressed = resources.get_precompressed(site, reports.GZIP_SUFFIX)
+        if precompressed:
+            return resources.send_precompressed(precompressed)
 
+        out_format = flask.request.values.get("format", "json")
+        if out_format in resources.EXPORT_FORMATS:
+            return resources.export_report(site, out_format)
 
-@api.param("purge", "Force generation of a new report", type=bool)
+        after, limit = resources.get_page_args()
+        with resources.open_report(site) as report:
+            if limit is None and not after:
+                return report.export()
+
+            data = {"errors": report.counts(), "meta": report.meta()}
+            if limit is None:
+                data["sigs"] = dict(report.iter_users(after=after))
+            else:
+                page, cont = resources.paginate(
+                    report.iter_users(after=after), limit, key=lambda item: item[0]
+                )
+                data["sigs"] = dict(page)
+                if cont is not None:
+                    data["continue"] = cont
+            return data
+
+
+@api.param(
+    "purge",
+    "Queue generation of a new report. Returns 202 and the queued job, unless "
+    "the report is less than a day old.",
+    type=bool,
+)
 @api.route("/reports/<string:site>/error")
 class ReportsSiteErrors(Resource):
     @api.response(200, "Success")
+    @api.response(304, "Report not modified")
     @api.response(404, "Report not found")
+    @resources.conditional_report(
+        variant=resources.precompressed_variant(reports.ERRORS_GZIP_SUFFIX),
+        vary="Accept-Encoding",
+    )
     def get(self, site):
         """Batch report for a single site, organized by error"""
         if flask.request.values.get("purge", False):
-            resources.purge_site(site)
+            job = resources.purge_site(site)
+            if job is not None:
+                return job_accepted(job)
 
-        try:
-            with open(
-                os.path.join(flask.current_app.config["data_dir"], site + ".json")
-            ) as f:
-                raw_data = json.load(f)
-        except FileNotFoundError:
-            flask.abort(404)
+        precompressed = resources.get_precompressed(site, reports.ERRORS_GZIP_SUFFIX)
+        if precompressed:
+            return resources.send_precompressed(precompressed)
 
-        raw_data["errors"].pop("total")
-        errors = raw_data["errors"].keys()
-        data = {
-            error: [
-                user
-                for user, info in raw_data["sigs"].items()
-                if error in info["errors"]
-            ]
-            for error in errors
-        }
-        return {"errors": data, "meta": raw_data["meta"]}
+        with resources.open_report(site) as report:
+            return reports.by_error(report)
 
 
 @api.param(
     "format",
     "Output format; may be 'json' (default), 'plain', 'massmessage', or 'target'",
 )
-@api.param("purge", "Force generation of a new report", type=bool)
+@api.param(
+    "purge",
+    "Queue generation of a new report. Returns 202 and the queued job, unless "
+    "the report is less than a day old.",
+    type=bool,
+)
 @api.param("filter_page", "Do not include usernames that are linked at this URL.")
+@api.param("limit", "Maximum number of users to return", type=int)
+@api.param("after", "Only return users after this username (from 'continue')")
 @api.produces(["application/json", "text/plain"])
 @api.route("/reports/<string:site>/error/<string:error>")
 class ReportsSiteSingleError(Resource):
     @api.response(200, "Success")
+    @api.response(304, "Report not modified")
     @api.response(404, "Report not found")
-    @api.response(400, "Specified error does not exist in data")
+    @api.response(400, "Specified error does not exist in data, or invalid limit")
+    @resources.conditional_report()
     def get(self, site, error):
         """Batch report for a single error on a single site"""
         if flask.request.values.get("purge", False):
-            resources.purge_site(site)
+            job = resources.purge_site(site)
+            if job is not None:
+                return job_accepted(job)
 
-        try:
-            with open(
-                os.path.join(flask.current_app.config["data_dir"], site + ".json")
-            ) as f:
-                raw_data = json.load(f)
-        except FileNotFoundError:
-            flask.abort(404)
+        with resources.open_report(site) as report:
+            counts = report.counts()
+            counts.pop("total")
+            if error not in counts:
+                flask.abort(400)
 
-        raw_data["errors"].pop("total")
-        errors = raw_data["errors"].keys()
-        if error not in errors:
-            flask.abort(400)
+            filter_users = set()
+            if flask.request.values.get("filter_page"):
+                filter_users.update(
+                    resources.filter_page(flask.request.values.get("filter_page", ""))
+                )
 
-        filter_users = set()
-        if flask.request.values.get("filter_page"):
-            filter_users.update(
-                resources.filter_page(flask.request.values.get("filter_page", ""))
+            after, limit = resources.get_page_args()
+            users = (
+                user
+                for user, info in report.iter_users(error=error, after=after)
+                if user not in filter_users
             )
-
-        data = [
-            user
-            for user, info in raw_data["sigs"].items()
-            if (error in info["errors"]) and user not in filter_users
-        ]
+            if limit is None:
+                data, cont = list(users), None
+            else:
+                data, cont = resources.paginate(users, limit)
+            meta = report.meta()
 
         out_format = flask.request.values.get("format", "json")
         if out_format == "json":
-            meta = raw_data["meta"]
             meta["error"] = error
+            if cont is not None:
+                return {"errors": data, "meta": meta, "continue": cont}
             return {"errors": data, "meta": meta}
         elif out_format == "plain":
             return flask.Response(
@@ -172,3 +313,67 @@ class ReportsSiteSingleError(Resource):
                 status=200,
                 mimetype="text/plain",
             )
+
+
+@api.route("/reports/<string:site>/user/<string:username>")
+class ReportsSiteUser(Resource):
+    @api.response(200, "Success")
+    @api.response(304, "Report not modified")
+    @api.response(404, "Report not found, or user not in report")
+    @resources.conditional_report()
+    def get(self, site, username):
+        """Batch report entry for a single user on a single site"""
+        username = (username[0].upper() + username[1:]).replace("_", " ")
+        with resources.open_report(site) as report:
+            info = report.get_user(username)
+            if info is None:
+                flask.abort(404)
+            return {"username": username, **info, "meta": report.meta()}
+
+
+@api.route("/reports/<string:site>/jobs")
+class ReportsSiteJobs(Resource):
+    @api.response(200, "Success")
+    def get(self, site):
+        """Status of recent report generation jobs for a site, newest first"""
+        return [job._asdict() for job in resources.list_purge_jobs(site)]
+
+    @api.response(202, "Report generation queued")
+    @api.response(409, "Report is less than a day old")
+    def post(self, site):
+        """Queue generation of a new report for a site"""
+        job = resources.purge_site(site)
+        if job is None:
+            flask.abort(409)
+        return job_accepted(job)
+
+
+@api.param("error", "Only include the count of this error")
+@api.route("/reports/<string:site>/history")
+class ReportsSiteHistory(Resource):
+    @api.response(200, "Success")
+    @api.response(404, "No archived reports")
+    def get(self, site):
+        """Number of users with each error in every archived report, oldest first"""
+        error = flask.request.values.get("error")
+        with resources.open_history(site) as history:
+            runs = history.runs()
+        if error is not None:
+            for run in runs:
+                run["errors"] = {
+                    key: run["errors"].get(key, 0) for key in ("total", error)
+                }
+        return {"site": site, "runs": runs}
+
+
+@api.route("/reports/<string:site>/history/<int:run>")
+class ReportsSiteHistoryRun(Resource):
+    @api.response(200, "Success")
+    @api.response(404, "Run not found")
+    def get(self, site, run):
+        """Archived batch report for a single site, as of an earlier run"""
+        with resources.open_history(site) as history:
+            report = history.get(run)
+        if report is None:
+            flask.abort(404)
+        return report.export()
@@ -7,11 +7,11 @@ import flask
 from werkzeug.datastructures import MultiDict
 import werkzeug.utils
 from flask_babel import gettext, ngettext, format_datetime  # type: ignore  # noqa: F401
-import os
+import flask_babel  # type: ignore
 import datetime
-import json
 import functools
 import logging
+from typing import cast
 
 from . import resources
 import datasources
@@ -20,6 +20,8 @@ logger = logging.getLogger(__name__)
 
 bp = flask.Blueprint("frontend", __name__)
 
+REPORT_PAGE_SIZE = 500
+
 
 def setlang(f):
     @functools.wraps(f)
@@ -89,19 +91,27 @@ def report():
     return flask.render_template("report.html", sites=sites)
 
 
+def report_variant(**kwargs) -> str:
+    """Identify what the report page depends on besides the report data"""
+    version = flask.current_app.config["version"].strip()
+    variant = f"{flask_babel.get_locale()}-{version}"
+    partial = resources.get_partial_meta(kwargs["site"])
+    if partial is not None:
+        variant += f"-{partial['last_update']}"
+    return variant
+
+
 @bp.route("/reports/<site>")
 @setlang
+@resources.conditional_report(variant=report_variant, vary="Accept-Language, Cookie")
 def report_site(site):
-    try:
-        with open(
-            os.path.join(
-                flask.current_app.config["data_dir"],
-                werkzeug.utils.secure_filename(site + ".json"),
-            )
-        ) as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        flask.abort(404)
+    after, limit = resources.get_page_args(default_limit=REPORT_PAGE_SIZE)
+    with resources.open_report(werkzeug.utils.secure_filename(site)) as report:
+        data = {"errors": report.counts(), "meta": report.meta()}
+        page, cont = resources.paginate(
+            report.iter_users(after=after), cast(int, limit), key=lambda item: item[0]
+        )
+        data["sigs"] = dict(page)
 
     data["meta"]["last_update"] = format_datetime(
         datetime.datetime.fromisoformat(data["meta"]["last_update"])
@@ -109,4 +119,12 @@ def report_site(site):
     data["meta"]["active_since"] = format_datetime(
         datetime.datetime.fromisoformat(data["meta"]["active_since"])
     )
-    return flask.render_template("report_site.html", site=site, d=data)
+    return flask.render_template(
+        "report_site.html",
+        site=site,
+        d=data,
+        after=after,
+        limit=limit,
+        cont=cont,
+        partial=resources.get_partial_meta(werkzeug.utils.secure_filename(site)),
+    )
@@ -3,20 +3,66 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 # Copyright 2020 AntiCompositeNumber
 
-import sigprobs
+import reports
+import jobs
 import logging
 import datetime
 import os
 import datasources
 import re
+import io
+import csv
 import json
+import itertools
+import functools
+import collections
+import threading
 import flask
+import werkzeug.http
 import urllib.parse
-from datatypes import WebAppMessage, UserCheck, Result
-from typing import Any, cast, Dict, List, Set
+from datatypes import (
+    Checks,
+    Result,
+    SigError,
+    SigRecords,
+    SiteData,
+    UserCheck,
+    UserProps,
+    WebAppMessage,
+)
+from typing import (
+    Any,
+    Callable,
+    cast,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 logger = logging.getLogger(__name__)
 
+MAX_PAGE_SIZE = 5000
+BULK_BATCH_SIZE = 25
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+DEFAULT_MAX_BULK_CHECK = 500
+# Longest time a client may wait for a check job in a single request
+MAX_CHECK_WAIT = 30
+CHECK_JOB_RETENTION = datetime.timedelta(days=1)
+
+FILTER_PAGE_USER = re.compile(r"(?<=User[_ ]talk:)[^\#\<\>\[\]\|\{\}\/:\n]*(?=[\}@\]])")
+FILTER_PAGE_CACHE_SIZE = 64
+# Users linked from each filter page, with the revision they were read from.
+# Least recently used pages are evicted first.
+_filter_page_cache: "collections.OrderedDict[str, Tuple[int, FrozenSet[str]]]" = (
+    collections.OrderedDict()
+)
+_filter_page_lock = threading.Lock()
+
 SAFE_DOMAINS = {
     "wikipedia.org",
     "wiktionary.org",
@@ -57,7 +103,61 @@ def get_default_sig(site: str, user: str = "$1", nickname: str = "$2") -> str:
     return text.replace("$1", user).replace("$2", nickname)
 
 
+def normalize_username(user: str) -> str:
+    return (user[0].upper() + user[1:]).replace("_", " ")
+
+
+def resolve_signature(
+    user: str,
+    user_props: UserProps,
+    user_exists: Callable[[str], bool],
+    default_sig: Callable[[str, str], str],
+) -> Tuple[str, Set[Result], Optional[bool]]:
+    """Work out which signature a user has from their preferences
+
+    Returns the signature, any messages about it, and whether the check
+    failed (True), passed (False), or the signature still needs checking
+    (None).
+    """
+    errors: Set[Result] = set()
+    failure = None
+    sig = ""
+    if not user_props.nickname:
+        # user does not exist or uses default sig
+        if not user_exists(user):
+            # user does not exist
+            errors.add(WebAppMessage.USER_DOES_NOT_EXIST)
+            failure = True
+        else:
+            # user exists but uses default signature
+            errors.add(WebAppMessage.DEFAULT_SIG)
+            sig = default_sig(user, user)
+            failure = False
+    elif not user_props.fancysig:
+        # user exists but uses non-fancy sig with nickname
+        errors.add(WebAppMessage.SIG_NOT_FANCY)
+        sig = default_sig(user, user_props.nickname)
+        failure = False
+    else:
+        # user exists and has custom fancy sig, check it
+        sig = user_props.nickname
+    return sig, errors, failure
+
+
+def get_replag(dbname: str) -> str:
+    """Replication lag for a site, if it is high enough to mention"""
+    try:
+        _replag = datasources.get_site_replag(dbname)
+    except (ConnectionError, ValueError):
+        return ""
+    if _replag > datetime.timedelta(minutes=2):
+        return str(_replag)
+    return ""
+
+
 def check_user(site: str, user: str, sig: str = "") -> UserCheck:
+    import sigprobs  # imported on first use, to keep startup fast
+
     validate_username(user)
     errors: Set[Result] = set()
     failure = None
@@ -67,42 +167,20 @@ def check_user(site: str, user: str, sig: str = "") -> UserCheck:
 
     sitedata = datasources.get_site_data(site)
     dbname = sitedata.dbname
-    user = (user[0].upper() + user[1:]).replace("_", " ")
+    user = normalize_username(user)
 
     if not sig:
         # signature not supplied, get data from database
         user_props = datasources.get_user_properties(user, dbname)
         logger.debug(user_props)
+        sig, errors, failure = resolve_signature(
+            user,
+            user_props,
+            lambda name: datasources.check_user_exists(name, sitedata),
+            functools.partial(get_default_sig, site),
+        )
 
-        if not user_props.nickname:
-            # user does not exist or uses default sig
-            if not datasources.check_user_exists(user, sitedata):
-                # user does not exist
-                errors.add(WebAppMessage.USER_DOES_NOT_EXIST)
-                failure = True
-            else:
-                # user exists but uses default signature
-                errors.add(WebAppMessage.DEFAULT_SIG)
-                sig = get_default_sig(site, user, user)
-                failure = False
-        elif not user_props.fancysig:
-            # user exists but uses non-fancy sig with nickname
-            errors.add(WebAppMessage.SIG_NOT_FANCY)
-            sig = get_default_sig(site, user, user_props.nickname)
-            failure = False
-        else:
-            # user exists and has custom fancy sig, check it
-            sig = user_props.nickname
-
-    try:
-        _replag = datasources.get_site_replag(dbname)
-    except (ConnectionError, ValueError):
-        replag = ""
-    else:
-        if _replag > datetime.timedelta(minutes=2):
-            replag = str(_replag)
-        else:
-            replag = ""
+    replag = get_replag(dbname)
 
     if failure is None:
         # OK so far, actually check the signature
@@ -127,6 +205,191 @@ def check_user(site: str, user: str, sig: str = "") -> UserCheck:
     return data
 
 
+def serialize_check(data: UserCheck) -> Dict[str, Any]:
+    result = data._asdict()
+    result["errors"] = [error.value for error in data.errors]
+    return result
+
+
+def check_user_async(site: str, user: str, sig: str = "") -> jobs.Job:
+    """Queue a signature check to run on the background worker pool
+
+    Checks can take minutes if the wiki is slow to respond, which is longer
+    than a request may take. Returns the queued job; its result is the
+    serialized UserCheck. Aborts with 503 if too many checks are queued.
+    """
+    validate_username(user)
+    if site not in datasources.get_sitematrix():
+        flask.abort(404)
+
+    config = flask.current_app.config
+    db_path = os.path.join(config["data_dir"], jobs.JOBS_DB)
+    with jobs.JobStore(db_path) as store:
+        store.reap("check")
+        store.prune("check", CHECK_JOB_RETENTION)
+        if store.count("check", "queued") >= config.get("max_queued_checks", 100):
+            flask.abort(503)
+        job, _ = store.enqueue("check", site)
+        # The job runs in this process, so it fails if this process exits
+        store.set_pid(job.id, os.getpid())
+
+    app = flask.current_app._get_current_object()  # type: ignore
+
+    def run() -> Dict[str, Any]:
+        with app.app_context():
+            return serialize_check(check_user(site, user, sig))
+
+    jobs.submit(db_path, job, run, config.get("check_workers", 4))
+    return job
+
+
+def get_check_job(job_id: int, wait: float = 0) -> jobs.Job:
+    """Get a check job, waiting up to wait seconds for it to finish"""
+    config = flask.current_app.config
+    with jobs.JobStore(os.path.join(config["data_dir"], jobs.JOBS_DB)) as store:
+        store.reap("check")
+        job = store.wait(job_id, min(max(wait, 0), MAX_CHECK_WAIT))
+    if job is None or job.kind != "check":
+        flask.abort(404)
+    return job
+
+
+def check_users(site: str, entries: List[Tuple[str, str]]) -> Iterator[UserCheck]:
+    """Check many users' signatures, setting up the site only once
+
+    entries is a list of (username, signature) pairs, where the signature may
+    be empty to use the user's current signature. Database lookups, existence
+    checks and lint requests are batched, and results are generated in
+    batches as they become available. The usernames and site are validated
+    before this returns, so errors are raised before any results are sent.
+    """
+    for user, sig in entries:
+        validate_username(user)
+    if site not in datasources.get_sitematrix():
+        flask.abort(404)
+
+    sitedata = datasources.get_site_data(site)
+    replag = get_replag(sitedata.dbname)
+
+    @functools.lru_cache(maxsize=None)
+    def sig_template() -> str:
+        return get_default_sig(site)
+
+    def default_sig(user: str, nickname: str) -> str:
+        return sig_template().replace("$1", user).replace("$2", nickname)
+
+    def generate() -> Iterator[UserCheck]:
+        for i in range(0, len(entries), BULK_BATCH_SIZE):
+            batch = [
+                (normalize_username(user), sig)
+                for user, sig in entries[i : i + BULK_BATCH_SIZE]
+            ]
+            yield from _check_batch(batch, sitedata, replag, default_sig)
+
+    return generate()
+
+
+def parse_bulk_check(data: Any) -> List[Tuple[str, str]]:
+    """Parse the body of a bulk check request into (username, signature) pairs
+
+    The body is a list, or an object with a "users" list. Each item is a
+    username, a [username, signature] pair, or an object with "username" and
+    optionally "signature" keys. Aborts with 400 if the body is invalid or
+    lists too many users.
+    """
+    if isinstance(data, dict):
+        data = data.get("users")
+    if not isinstance(data, list):
+        flask.abort(400, "Expected a list of users")
+    limit = flask.current_app.config.get("max_bulk_check", DEFAULT_MAX_BULK_CHECK)
+    if len(data) > limit:
+        flask.abort(400, f"Too many users, at most {limit} may be checked at once")
+
+    entries = []
+    for item in data:
+        if isinstance(item, str):
+            user, sig = item, ""
+        elif isinstance(item, list) and len(item) == 2:
+            user, sig = item
+        elif isinstance(item, dict) and "username" in item:
+            user, sig = item["username"], item.get("signature", "")
+        else:
+            flask.abort(400, f"Invalid user: {item!r}")
+        if not isinstance(user, str) or not isinstance(sig, str) or not user:
+            flask.abort(400, f"Invalid user: {item!r}")
+        entries.append((user, sig))
+    return entries
+
+
+def _check_batch(
+    batch: List[Tuple[str, str]],
+    sitedata: SiteData,
+    replag: str,
+    default_sig: Callable[[str, str], str],
+) -> Iterator[UserCheck]:
+    import sigprobs  # imported on first use, to keep startup fast
+
+    lookup = [user for user, sig in batch if not sig]
+    props = datasources.get_users_properties(lookup, sitedata.dbname) if lookup else {}
+    no_nickname = [user for user in lookup if not props[user].nickname]
+    existing = (
+        datasources.check_users_exist(no_nickname, sitedata) if no_nickname else set()
+    )
+
+    results = []
+    # Keyed by position, as the same user may be listed with several signatures
+    accumulate: Dict[str, str] = {}
+    for index, (user, sig) in enumerate(batch):
+        errors: Set[Result] = set()
+        failure = None
+        if not sig:
+            sig, errors, failure = resolve_signature(
+                user, props[user], existing.__contains__, default_sig
+            )
+        if failure is None:
+            errors = cast(
+                Set[Result],
+                sigprobs.check_sig(
+                    user,
+                    sig,
+                    sitedata,
+                    sitedata.hostname,
+                    checks=Checks.DEFAULT ^ Checks.LINT,
+                ),
+            )
+            if SigError.PLAIN_FANCY_SIG not in errors:
+                accumulate[str(index)] = sigprobs.evaluate_subst(
+                    sigprobs.normalize_sig(sig), sitedata
+                )
+        results.append((user, sig, errors, failure))
+
+    # Lint the signatures together, the same way report runs do
+    lint = SigRecords()
+    keys = list(accumulate)
+    for i in range(0, len(keys), sigprobs.LINT_BATCH_SIZE):
+        sigprobs.batch_check_lint(
+            {key: accumulate[key] for key in keys[i : i + sigprobs.LINT_BATCH_SIZE]},
+            lint,
+            sitedata,
+            Checks.DEFAULT,
+        )
+
+    for index, (user, sig, errors, failure) in enumerate(results):
+        errors.update(lint.errors(str(index)))
+        if not errors:
+            errors.add(WebAppMessage.NO_ERRORS)
+            failure = False
+        yield UserCheck(
+            site=sitedata.hostname,
+            username=user,
+            errors=list(errors),
+            signature=sig,
+            failure=failure,
+            html_sig="",
+            replag=replag,
+        )
+
+
 def get_rendered_sig(site: str, wikitext: str) -> str:
     url = f"https://{site}/api/rest_v1/transform/wikitext/to/html"
     payload = {"wikitext": wikitext, "body_only": True}
@@ -141,35 +404,263 @@ def get_rendered_sig(site: str, wikitext: str) -> str:
 
 
 def list_report_sites(config: Dict[str, Any]) -> List[str]:
-    sites = [
-        item.rpartition(".json")[0]
-        for item in os.listdir(config["data_dir"])
-        if item.endswith(".json")
-    ]
-    return sites
+    return reports.list_sites(config["data_dir"])
+
+
+def open_report(site: str) -> reports.Report:
+    """Open a site's report using the configured backend, or 404"""
+    config = flask.current_app.config
+    try:
+        return reports.open_report(
+            config["data_dir"], site, config.get("report_backend", "json")
+        )
+    except FileNotFoundError:
+        flask.abort(404)
+
+
+def get_partial_meta(site: str) -> Optional[Dict[str, Any]]:
+    """Meta of the partial report of a run in progress for site, if any"""
+    return reports.partial_meta(flask.current_app.config["data_dir"], site)
+
+
+def open_history(site: str) -> reports.ReportHistory:
+    """Open the archive of a site's past reports, or 404"""
+    try:
+        return reports.ReportHistory(
+            os.path.join(
+                flask.current_app.config["data_dir"], site + reports.HISTORY_SUFFIX
+            ),
+            readonly=True,
+        )
+    except FileNotFoundError:
+        flask.abort(404)
+
+
+def conditional_report(
+    variant: Optional[Callable[..., str]] = None, vary: Optional[str] = None
+):
+    """Handle conditional GET requests for views of a site's report
+
+    The report's ETag and Last-Modified are added to the response, and a
+    304 Not Modified is returned without calling the view if the client's
+    copy is still current. Responses that depend on more than the report
+    (purges and filter_page) are never treated as unchanged. If the view's
+    output also depends on something else, such as the interface language,
+    variant is called with the view arguments and should return a string
+    identifying it, and vary should list the request headers involved.
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            data_dir = flask.current_app.config["data_dir"]
+            request = flask.request
+            cacheable = not (
+                request.values.get("purge") or request.values.get("filter_page")
+            )
+            try:
+                validators = reports.get_validators(data_dir, kwargs["site"])
+            except FileNotFoundError:
+                validators = None
+
+            if cacheable and validators is not None:
+                etag = _make_etag(validators, variant, kwargs)
+                if request.if_none_match:
+                    not_modified = request.if_none_match.contains(etag)
+                elif request.if_modified_since:
+                    not_modified = (
+                        request.if_modified_since
+                        >= validators.last_modified.replace(microsecond=0)
+                    )
+                else:
+                    not_modified = False
+                if not_modified:
+                    response = flask.Response(status=304)
+                    response.set_etag(etag)
+                    response.last_modified = validators.last_modified
+                    if vary:
+                        response.headers["Vary"] = vary
+                    return response
+
+            result = f(*args, **kwargs)
+            if not cacheable:
+                return result
+            try:
+                validators = reports.get_validators(data_dir, kwargs["site"])
+            except FileNotFoundError:
+                return result
+            headers = {
+                "ETag": f'"{_make_etag(validators, variant, kwargs)}"',
+                "Last-Modified": werkzeug.http.http_date(validators.last_modified),
+            }
+            if vary:
+                headers["Vary"] = vary
+            if isinstance(result, flask.Response):
+                result.headers.update(headers)
+                return result
+            return result, 200, headers
+
+        return decorated_function
+
+    return decorator
+
+
+def _make_etag(
+    validators: reports.Validators,
+    variant: Optional[Callable[..., str]],
+    view_args: Dict[str, Any],
+) -> str:
+    suffix = variant(**view_args) if variant is not None else ""
+    if not suffix:
+        return validators.etag
+    return f"{validators.etag}-{suffix}"
+
+
+def get_precompressed(site: str, suffix: str) -> Optional[str]:
+    """Path of a pre-compressed report artifact that can be sent as-is
+
+    Only used when the client accepts gzip and the request has no parameters
+    that change the output.
+    """
+    request = flask.request
+    if (
+        request.values.get("format", "json") != "json"
+        or request.values.get("limit")
+        or request.values.get("after")
+        or not request.accept_encodings["gzip"]
+    ):
+        return None
+    return reports.precompressed_path(
+        flask.current_app.config["data_dir"], site, suffix
+    )
+
+
+def precompressed_variant(suffix: str) -> Callable[..., str]:
+    """ETag variant for views that may send a pre-compressed artifact"""
+
+    def variant(site: str, **kwargs) -> str:
+        return "gzip" if get_precompressed(site, suffix) else ""
+
+    return variant
+
+
+def send_precompressed(path: str) -> flask.Response:
+    """Send a gzip-compressed JSON file without decompressing it"""
+    response = flask.send_file(
+        path, mimetype="application/json", conditional=False, etag=False
+    )
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
 
+def get_page_args(default_limit: Optional[int] = None) -> Tuple[str, Optional[int]]:
+    """Get the pagination cursor and page size from the request, or 400"""
+    after = flask.request.values.get("after", "")
+    limit: Optional[int] = default_limit
+    raw_limit = flask.request.values.get("limit")
+    if raw_limit:
+        try:
+            limit = int(raw_limit)
+        except ValueError:
+            flask.abort(400)
+        if limit < 1:
+            flask.abort(400)
+    if limit is not None:
+        limit = min(limit, MAX_PAGE_SIZE)
+    return after, limit
+
+
+def paginate(
+    items: Iterable[Any], limit: int, key=lambda item: item
+) -> Tuple[List[Any], Optional[Dict[str, str]]]:
+    """Take one page of items, and the continuation for the next page
+
+    The continuation is None if there are no more items.
+    """
+    page = list(itertools.islice(items, limit + 1))
+    if len(page) > limit:
+        page = page[:limit]
+        return page, {"after": key(page[-1])}
+    return page, None
+
+
+def export_report(site: str, out_format: str) -> flask.Response:
+    """Stream every user in a report as NDJSON or CSV
+
+    Rows are written to the client as they are read from the report, so the
+    full response is never built in memory.
+    """
+    report = open_report(site)
+
+    def generate() -> Iterator[str]:
+        with report:
+            if out_format == "csv":
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(["username", "errors", "signature"])
+                for user, info in report.iter_users():
+                    writer.writerow([user, " ".join(info["errors"]), info["signature"]])
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                yield buffer.getvalue()
+            else:
+                for user, info in report.iter_users():
+                    yield json.dumps({"username": user, **info}) + "\n"
 
-def purge_site(site: str) -> bool:
+    return flask.Response(
+        flask.stream_with_context(generate()), mimetype=EXPORT_FORMATS[out_format]
+    )
+
+
+def purge_site(site: str) -> Optional[jobs.Job]:
+    """Queue a new report for a site, unless the current one is recent
+
+    The report is generated by a separate process, and the current report
+    keeps being served until the new one replaces it. Returns the queued or
+    already running job, or None if the report is less than a day old.
+    """
+    config = flask.current_app.config
     try:
-        with open(
-            os.path.join(flask.current_app.config["data_dir"], site + ".json")
-        ) as f:
-            raw_data = json.load(f)
+        last_modified = reports.get_validators(config["data_dir"], site).last_modified
     except FileNotFoundError:
-        raw_data = {}
+        pass
+    else:
+        if datetime.datetime.now(datetime.timezone.utc) - last_modified < (
+            datetime.timedelta(days=1)
+        ):
+            return None
+    if site not in datasources.get_sitematrix():
+        flask.abort(404)
+
+    with jobs.JobStore(os.path.join(config["data_dir"], jobs.JOBS_DB)) as store:
+        job, created = store.enqueue("purge", site)
+    if created:
+        logger.info(f"Queued purge job {job.id} for {site}")
+    jobs.dispatch(config["data_dir"], config.get("max_purge_jobs", 1))
+    return job
 
-    if raw_data and datetime.datetime.now() - datetime.datetime.fromisoformat(
-        raw_data["meta"]["last_update"]
-    ) < datetime.timedelta(days=1):
-        return False
 
-    result = sigprobs.main(site)
-    with sigprobs.output_file("", site, True) as f:
-        json.dump(result, f)
-    return True
+def list_purge_jobs(site: str) -> List[jobs.Job]:
+    config = flask.current_app.config
+    jobs.dispatch(config["data_dir"], config.get("max_purge_jobs", 1))
+    with jobs.JobStore(os.path.join(config["data_dir"], jobs.JOBS_DB)) as store:
+        return store.list_jobs(site, "purge")
+
+
+def _filter_page_title(parse: urllib.parse.ParseResult) -> Optional[str]:
+    if parse.path.startswith("/wiki/"):
+        return urllib.parse.unquote(parse.path[len("/wiki/") :])
+    title = urllib.parse.parse_qs(parse.query).get("title")
+    return title[0] if title else None
 
 
 def filter_page(url: str) -> Set[str]:
+    """Get the users whose talk pages are linked from a page
+
+    Results are cached per URL, and only fetched again once the page has a
+    new revision. A URL with an oldid always gets that revision.
+    """
     if not url:
         return set()
     parse = urllib.parse.urlparse(url)
@@ -179,17 +670,40 @@ def filter_page(url: str) -> Set[str]:
     ):
         logger.warn(f"Rejecting unsafe URL {url}")
         return set()
+
     qs = urllib.parse.parse_qs(parse.query)
     qs["action"] = ["raw"]
+    revid: Optional[int] = None
+    if "oldid" in qs:
+        # The requested revision never changes
+        if qs["oldid"][0].isdigit():
+            revid = int(qs["oldid"][0])
+    else:
+        title = _filter_page_title(parse)
+        revid = datasources.get_latest_revid(parse.netloc, title) if title else None
+        if revid is not None:
+            # Fetch the revision that was checked, in case of a concurrent edit
+            qs["oldid"] = [str(revid)]
+    if revid is not None:
+        with _filter_page_lock:
+            cached = _filter_page_cache.get(url)
+            if cached is not None and cached[0] == revid:
+                _filter_page_cache.move_to_end(url)
+                return set(cached[1])
+
     new_url = urllib.parse.urlunparse(
         parse._replace(query=urllib.parse.urlencode(qs, doseq=True))
     )
-    res = datasources.backoff_retry("get", new_url, output="text")
+    lines = datasources.backoff_retry("get", new_url, output="lines", stream=True)
     users = set()
-    for line in res.split("\n"):
-        match = re.search(
-            r"(?<=User[_ ]talk:)[^\#\<\>\[\]\|\{\}\/:\n]*(?=[\}@\]])", line
-        )
+    for line in lines:
+        match = FILTER_PAGE_USER.search(line)
         if match:
             users.add(match.group(0))
+
+    if revid is not None:
+        with _filter_page_lock:
+            _filter_page_cache[url] = (revid, frozenset(users))
+            while len(_filter_page_cache) > FILTER_PAGE_CACHE_SIZE:
+                _filter_page_cache.popitem(last=False)
     return users
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest  # type: ignore
+import http.server
+import json
+import threading
+
+
+def _format_events(events):
+    """Format (id, data) pairs as event stream chunks, with a comment first"""
+    yield b":ok\n\n"
+    for event_id, data in events:
+        lines = ["event: message", f"id: {event_id}"]
+        lines.extend(f"data: {line}" for line in json.dumps(data).splitlines())
+        yield ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+@pytest.fixture
+def sse_server():
+    """Local stand-in for EventStreams
+
+    Call with a list of streams, each a list of (id, data) pairs, to start
+    it. Each connection gets the next stream, sent in chunks like
+    EventStreams does, which is kept open for hold seconds after its events
+    are sent, and then closed. Returns the stream URL and the list of
+    request headers received.
+    """
+    servers = []
+    stop = threading.Event()
+
+    def start(streams, hold=0):
+        streams = list(streams)
+        headers = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                headers.append(dict(self.headers))
+                self.close_connection = True
+                if not streams:
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in _format_events(streams.pop(0)):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    self.wfile.flush()
+                stop.wait(hold)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}/v2/stream/recentchange", headers
+
+    yield start
+    stop.set()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import os
+import sys
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+import active  # noqa: E402
+
+
+def test_active_users(tmp_path):
+    path = str(tmp_path / ("en.wikipedia.org" + active.ACTIVE_SUFFIX))
+    with active.ActiveUsers(path) as users:
+        assert users.high_water_mark() == ""
+        users.update([("Example1", "20200101000000"), ("Example2", "20200102000000")])
+        users.update([("Example1", "20200103000000"), ("Example2", "20200101000000")])
+        assert len(users) == 2
+        assert users.high_water_mark() == "20200103000000"
+
+    with active.ActiveUsers(path) as users:
+        assert users.expire("20200102000000") == 1
+        assert users.users() == ["Example1"]
@@ -7,6 +7,7 @@ import pytest  # type: ignore
 import unittest.mock as mock
 import sys
 import os
+import subprocess
 import urllib.parse
 from bs4 import BeautifulSoup  # type: ignore
 
@@ -267,3 +268,28 @@ def test_report(client):
 
     assert res.status_code == 200
     assert b"foo.example.org" in res.data
+
+
+def test_lazy_imports(tmp_path):
+    # A fresh interpreter, as the tests have already imported sigprobs
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, app; "
+            "print(sorted({'sigprobs', 'mwparserfromhell'} & set(sys.modules)))",
+        ],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": os.path.dirname(app.__file__)},
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    assert proc.stdout.strip() == "[]"
+
+
+def test_get_version(tmp_path):
+    version = tmp_path / "VERSION"
+    assert app.get_version(str(version)) == ""
+    version.write_text("abc1234\n")
+    assert app.get_version(str(version)) == "abc1234"
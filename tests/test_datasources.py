@@ -7,8 +7,16 @@ import pytest  # type: ignore
 import unittest.mock as mock
 import sys
 import datetime
+import email.utils
+import gzip
+import http.server
+import itertools
+import json
+import threading
+import time
 from decimal import Decimal
 import os
+import requests
 
 # import urllib.parse
 # from bs4 import BeautifulSoup  # type: ignore
@@ -18,6 +26,7 @@ sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
 # import sigprobs  # noqa: E402
 import datasources  # noqa: E402
 import datasources.db  # noqa: E402
+import active  # noqa: E402
 
 
 @pytest.fixture(
@@ -141,3 +150,330 @@ def test_get_site_replag(sec):
         assert datasources.get_site_replag("enwiki_p") == datetime.timedelta(
             seconds=sec
         )
+
+
+def make_response(status=200, content=b"{}", headers=None):
+    res = requests.Response()
+    res.status_code = status
+    res._content = content
+    res.headers.update(headers or {})
+    res.url = "https://en.wikipedia.org/w/api.php"
+    return res
+
+
+@pytest.fixture
+def buckets():
+    """Fake clock, returning the list of sleeps"""
+    now = [1000.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    datasources.api._buckets.clear()
+    with mock.patch("time.sleep", sleep), mock.patch("time.monotonic", lambda: now[0]):
+        yield sleeps
+    datasources.api._buckets.clear()
+
+
+def test_token_bucket(buckets):
+    bucket = datasources.api.TokenBucket(rate=10, capacity=2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(0.1)
+    # The bucket refilled while sleeping
+    assert bucket.acquire() == pytest.approx(0.1)
+    bucket.pause(5)
+    assert bucket.acquire() == pytest.approx(5)
+    assert bucket.waited == pytest.approx(5.2)
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (None, 0),
+        ("", 0),
+        ("5", 5),
+        ("-1", 0),
+        ("garbage", 0),
+        ("Wed, 21 Oct 2015 07:28:00 GMT", 0),
+    ],
+)
+def test_parse_retry_after(value, expected):
+    assert datasources.api.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_date():
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < datasources.api.parse_retry_after(date) <= 60
+
+
+def test_backoff_retry(buckets):
+    responses = [
+        make_response(503, headers={"Retry-After": "30"}),
+        make_response(headers={"MediaWiki-API-Error": "maxlag", "Retry-After": "5"}),
+        requests.ConnectionError(),
+        make_response(content=b'{"query": {}}'),
+    ]
+    with mock.patch.object(
+        datasources.api.session, "request", side_effect=responses
+    ) as request:
+        result = datasources.backoff_retry(
+            "get",
+            "https://en.wikipedia.org/w/api.php",
+            output="json",
+            params={"action": "query"},
+        )
+    assert result == {"query": {}}
+    assert request.call_count == 4
+    assert request.call_args.kwargs["params"] == {"action": "query", "maxlag": 5}
+    # Retry-After is honored, other delays are jittered exponential backoff
+    assert buckets[0] == 30
+    assert buckets[1] == 5
+    assert 4.5 <= buckets[2] <= 13.5
+    assert len(buckets) == 3
+
+
+def test_backoff_retry_fatal(buckets):
+    with mock.patch.object(
+        datasources.api.session, "request", return_value=make_response(404)
+    ) as request:
+        with pytest.raises(requests.HTTPError):
+            datasources.backoff_retry("get", "https://en.wikipedia.org/wiki/Foo")
+    request.assert_called_once()
+    assert "params" not in request.call_args.kwargs
+
+
+def test_backoff_retry_exhausted(buckets):
+    with mock.patch.object(
+        datasources.api.session, "request", return_value=make_response(500)
+    ) as request:
+        with pytest.raises(datasources.api.RetryableError):
+            datasources.backoff_retry("get", "https://en.wikipedia.org/wiki/Foo")
+    assert request.call_count == datasources.api.MAX_TRIES
+
+
+@pytest.fixture
+def transport():
+    yield datasources.configure_transport
+    datasources.configure_transport()
+    datasources.api._transfer_stats.clear()
+
+
+def test_transport_defaults(transport):
+    transport({"pool_maxsize": 50, "read_timeout": 5})
+    adapter = datasources.api.session.get_adapter("https://en.wikipedia.org")
+    assert adapter._pool_maxsize == 50
+    with mock.patch("requests.adapters.HTTPAdapter.send") as send:
+        request = requests.Request("GET", "https://en.wikipedia.org").prepare()
+        adapter.send(request)
+    assert send.call_args.kwargs["timeout"] == (10.0, 5)
+    assert datasources.api.session.headers["Connection"] == "keep-alive"
+
+
+def test_transport_lazy(transport):
+    with mock.patch.object(datasources.api, "TransportAdapter") as adapter:
+        transport({"pool_maxsize": 50})
+        adapter.assert_not_called()
+        datasources.api.session.get_adapter("https://en.wikipedia.org")
+        datasources.api.session.get_adapter("https://de.wikipedia.org")
+    adapter.assert_called_once()
+    assert adapter.call_args.args[0]["pool_maxsize"] == 50
+
+
+def test_transport_rate_limit(transport, buckets):
+    existing = datasources.api.get_bucket("en.wikipedia.org")
+    transport({"rate_limit": 2, "rate_burst": 1})
+    for bucket in (existing, datasources.api.get_bucket("de.wikipedia.org")):
+        assert (bucket.rate, bucket.capacity) == (2, 1)
+        bucket.acquire()
+        assert bucket.acquire() == pytest.approx(0.5)
+
+
+def test_transport_gzip_requests(transport):
+    transport({"gzip_requests": True, "gzip_min_size": 10})
+    adapter = datasources.api.session.get_adapter("https://en.wikipedia.org")
+    with mock.patch("requests.adapters.HTTPAdapter.send") as send:
+        small = requests.Request(
+            "POST", "https://en.wikipedia.org", data={"a": "b"}
+        ).prepare()
+        adapter.send(small)
+        assert send.call_args.args[0].body == "a=b"
+
+        large = requests.Request(
+            "POST", "https://en.wikipedia.org", data={"text": "a" * 100}
+        ).prepare()
+        adapter.send(large)
+    sent = send.call_args.args[0]
+    assert sent.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(sent.body) == b"text=" + b"a" * 100
+
+
+def test_transport_account_sizes(transport):
+    body = gzip.compress(b"x" * 10000)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    transport({"account_sizes": True})
+    url = f"http://127.0.0.1:{server.server_port}/"
+    res = datasources.api.session.post(url, data=b"y" * 100)
+    thread.join()
+    server.server_close()
+
+    assert res.text == "x" * 10000
+    assert datasources.get_transfer_stats()[f"127.0.0.1:{server.server_port}"] == {
+        "requests": 1,
+        "sent": 100,
+        "received": len(body),
+    }
+
+
+def test_iter_active_user_sigs_blocks():
+    cur = mock.MagicMock()
+    cur.fetchall.side_effect = [[(b"Example5", b"[[User:Example5]]")], []]
+    conn = mock.MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cur
+    with mock.patch("toolforge.connect", return_value=conn):
+        sigs = list(
+            datasources.iter_active_user_sigs("enwiki", "20200101000000", blocks=[5, 6])
+        )
+
+    assert sigs == [("Example5", "[[User:Example5]]")]
+    # Blocks are compared as numbers, so ids ending in 05 are in block 5
+    for call, block in zip(cur.execute.call_args_list, [5, 6]):
+        assert "up_user %% 100 = %s" in call.args[0]
+        assert call.kwargs["args"] == ("20200101000000", block)
+
+
+def test_iter_active_user_sigs_delta(tmp_path):
+    cur = mock.MagicMock()
+    cur.fetchall.side_effect = [
+        [(b"Example2", b"20200110000000")],
+        [(b"Example1", b"[[User:Example1]]"), (b"Example2", b"[[User:Example2]]")],
+    ]
+    conn = mock.MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cur
+    with active.ActiveUsers(str(tmp_path / "active.sqlite3")) as users:
+        users.update([("Example1", "20200105000000"), ("Old", "20191201000000")])
+        with mock.patch("toolforge.connect", return_value=conn):
+            sigs = list(
+                datasources.iter_active_user_sigs(
+                    "enwiki",
+                    "20200101000000",
+                    active=users,
+                    since="20200108000000",
+                    blocks=[1, 2],
+                )
+            )
+        assert users.users() == ["Example1", "Example2"]
+
+    assert sigs == [
+        ("Example1", "[[User:Example1]]"),
+        ("Example2", "[[User:Example2]]"),
+    ]
+    # Only edits since the high-water mark, less the overlap, are queried
+    assert cur.execute.call_args_list[0].kwargs["args"] == ("20200107000000",)
+    assert cur.execute.call_args_list[1].kwargs["args"] == (
+        "Example1",
+        "Example2",
+        1,
+        2,
+    )
+    assert "up_user %% 100 IN (%s, %s)" in cur.execute.call_args_list[1].args[0]
+
+
+def test_sample_active_user_sigs():
+    cur = mock.MagicMock()
+    cur.fetchall.return_value = [(b"Example5", b"[[User:Example5]]")]
+    conn = mock.MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cur
+    with mock.patch("toolforge.connect", return_value=conn):
+        sample = datasources.sample_active_user_sigs(
+            "enwiki", "20200101000000", size=10, blocks=range(1, 100, 4)
+        )
+
+    assert sample == [("Example5", "[[User:Example5]]")]
+    assert "ORDER BY RAND()" in cur.execute.call_args.args[0]
+    assert cur.execute.call_args.kwargs["args"] == (
+        "20200101000000",
+        *range(1, 100, 4),
+        10,
+    )
+
+
+def test_iter_user_sigs_all_blocks():
+    cur = mock.MagicMock()
+    cur.fetchall.return_value = [(b"Example100", b"[[User:Example100]]")]
+    conn = mock.MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cur
+    with mock.patch("toolforge.connect", return_value=conn):
+        sigs = list(datasources.iter_user_sigs("enwiki", ["Example100"]))
+
+    assert sigs == [("Example100", "[[User:Example100]]")]
+    # No need to filter by block when all of them are wanted
+    assert "up_user %%" not in cur.execute.call_args.args[0]
+    assert cur.execute.call_args.kwargs["args"] == ("Example100",)
+
+
+def test_parse_events():
+    lines = [
+        ": comment",
+        "event: message",
+        "id: 1",
+        "data: first",
+        "data:second",
+        "",
+        "retry: 1000",
+        "",
+        "data: third",
+        "",
+    ]
+    assert list(datasources.parse_events(lines)) == [
+        datasources.Event("1", "message", "first\nsecond"),
+        # The id of the previous event is kept
+        datasources.Event("1", "message", "third"),
+    ]
+
+
+def test_iter_events_resume(sse_server):
+    url, headers = sse_server([[("[1]", {"n": 1})], [("[2]", {"n": 2})]])
+    events = list(itertools.islice(datasources.iter_events(url, retry=0), 2))
+    assert [json.loads(event.data) for event in events] == [{"n": 1}, {"n": 2}]
+    assert "Last-Event-ID" not in headers[0]
+    assert headers[1]["Last-Event-ID"] == "[1]"
+
+    # Without retry, iteration ends with the stream
+    url, headers = sse_server([[("[3]", {"n": 3})]])
+    assert [event.id for event in datasources.iter_events(url, "[2]", None)] == ["[3]"]
+    assert headers[0]["Last-Event-ID"] == "[2]"
+
+
+@pytest.mark.parametrize(
+    "change,expected",
+    [
+        ({"namespace": 1, "user": "Example"}, True),
+        ({"namespace": 4, "user": "Example", "type": "new"}, True),
+        ({"namespace": 0, "user": "Example"}, False),
+        ({"namespace": 3, "user": "192.0.2.1"}, False),
+        ({"namespace": 3, "user": "2001:db8::1"}, False),
+        ({"namespace": 3, "user": "Example", "type": "log"}, False),
+        ({"namespace": 3, "user": "Example", "server_name": "de.wikipedia.org"}, False),
+    ],
+)
+def test_is_talk_edit(change, expected):
+    change = {"type": "edit", "server_name": "en.wikipedia.org", **change}
+    assert datasources.is_talk_edit(change, "en.wikipedia.org") is expected
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest  # type: ignore
+import dataclasses
+import os
+import pickle
+import sys
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+import datatypes  # noqa: E402
+from datatypes import SigError, SiteData, TitleKind  # noqa: E402
+
+
+@pytest.fixture
+def matcher():
+    # Names as get_site_data normalizes them
+    sitedata = SiteData(
+        user={"User", "Benutzerin"},
+        user_talk={"User_talk", "Benutzerin_diskussion"},
+        file={"File", "Image", "Datei"},
+        special={"Special", "Spezial"},
+        contribs={"Contributions", "Contribs", "Beiträge"},
+        subst=["subst:"],
+        dbname="enwiki",
+        hostname="en.wikipedia.org",
+    )
+    return datatypes.TitleMatcher(sitedata)
+
+
+@pytest.mark.parametrize(
+    "title,expected",
+    [
+        ("User:Example", (TitleKind.USER, "Example")),
+        ("user talk:Example", (TitleKind.USER_TALK, "Example")),
+        ("USER_TALK:Example", (TitleKind.USER_TALK, "Example")),
+        ("Benutzerin Diskussion:Example", (TitleKind.USER_TALK, "Example")),
+        (":User:Example", (TitleKind.USER, "Example")),
+        (" User : Example #top", (TitleKind.USER, "Example")),
+        ("Special:Contributions/Example", (TitleKind.CONTRIBS, "Example")),
+        ("spezial:beiträge/Example", (TitleKind.CONTRIBS, "Example")),
+        ("Special:Log/Example", (None, "Log/Example")),
+        ("meta:User:Example", (TitleKind.INTERWIKI, "Example")),
+        ("m:de:User talk:Example", (TitleKind.INTERWIKI, "Example")),
+        ("meta:Special:Contribs/Example", (TitleKind.INTERWIKI, "Example")),
+        ("Image:Example.jpg", (TitleKind.FILE, "Example.jpg")),
+        ("commons:File:Example.jpg", (None, "Example.jpg")),
+        ("meta:foo/bar", (None, "meta:foo/bar")),
+        ("Example", (None, "Example")),
+        # Usernames with colons
+        ("User:(:Example:)", (TitleKind.USER, "(:Example:)")),
+        ("Special:Contributions/(:Example:)", (TitleKind.CONTRIBS, "(:Example:)")),
+        ("meta:User:(:Example:)", (TitleKind.INTERWIKI, "(:Example:)")),
+        (":User:(:Example:)", (TitleKind.USER, "(:Example:)")),
+        ("User talk:Foo:Bar", (TitleKind.USER_TALK, "Foo:Bar")),
+    ],
+)
+def test_title_matcher(matcher, title, expected):
+    assert matcher.classify(title) == expected
+
+
+def sitedata(hostname="en.wikipedia.org", user="User"):
+    return SiteData(
+        user={user},
+        user_talk={"User talk"},
+        file={"File"},
+        special={"Special"},
+        contribs={"contribs"},
+        subst=["subst:", "safesubst:"],
+        dbname=hostname.split(".")[0] + "wiki",
+        hostname=hostname,
+    )
+
+
+def test_sitedata_frozen():
+    data = sitedata()
+    assert data.user == frozenset({"User"})
+    assert data.subst == ("subst:", "safesubst:")
+    assert hash(data) == hash(sitedata())
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        data.hostname = "de.wikipedia.org"  # type: ignore
+
+
+def test_sitedata_fingerprint():
+    en = sitedata().fingerprint
+    assert en == sitedata("simple.wikipedia.org").fingerprint
+    assert en != sitedata("de.wikipedia.org", user="Benutzer").fingerprint
+
+
+def test_sitedata_pickle():
+    data = sitedata()
+    # Only the names are pickled, the rest is rebuilt
+    assert b"TitleMatcher" not in pickle.dumps(data)
+    loaded = pickle.loads(pickle.dumps(data))
+    assert loaded == data
+    assert loaded.fingerprint == data.fingerprint
+    assert loaded.titles.classify("User:Example") == (TitleKind.USER, "Example")
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("{{subst:Foo}}", "{{Foo}}"),
+        ("{{safesubst:Foo}} {{subst:Bar}}", "{{Foo}} {{Bar}}"),
+        ("[[User:Example]]", "[[User:Example]]"),
+    ],
+)
+def test_sitedata_strip_subst(text, expected):
+    assert sitedata().strip_subst(text) == expected
+
+
+def test_error_mask():
+    errors = [SigError.SIG_TOO_LONG, SigError.MISSING_END_TAG]
+    mask = datatypes.error_mask(errors)
+    assert datatypes.mask_errors(mask) == sorted(errors, key=list(SigError).index)
+    assert datatypes.error_mask([]) == 0
+
+
+def test_sig_records():
+    records = datatypes.SigRecords()
+    records.add("Example1", "[[User:Example1]]", [SigError.NO_USER_LINKS])
+    records.add("Example2", "a" * 300, [])
+    records.add(
+        "Example1", "ignored", [SigError.NO_USER_LINKS, SigError.MISSING_END_TAG]
+    )
+    records.add("Example0", "a" * 300, {SigError.SIG_TOO_LONG})
+    records.records["Example0"].html_sig = "<b>a</b>"
+
+    assert len(records) == 2
+    assert "Example2" not in records
+    assert records.errors("Example1") == [
+        SigError.MISSING_END_TAG,
+        SigError.NO_USER_LINKS,
+    ]
+    assert records.errors("Example2") == []
+    assert records.stats() == {
+        "total": 2,
+        "missing-end-tag": 1,
+        "no-user-links": 1,
+        "sig-too-long": 1,
+    }
+    assert records.export() == {
+        "Example0": {
+            "signature": "a" * 300,
+            "errors": ["sig-too-long"],
+            "html_sig": "<b>a</b>",
+        },
+        "Example1": {
+            "signature": "[[User:Example1]]",
+            "errors": ["missing-end-tag", "no-user-links"],
+        },
+    }
+    assert not hasattr(records.records["Example1"], "__dict__")
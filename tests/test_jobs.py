@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest  # type: ignore
+import unittest.mock as mock
+import datetime
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+import jobs  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    with jobs.JobStore(str(tmp_path / jobs.JOBS_DB)) as store:
+        yield store
+
+
+@pytest.fixture(autouse=True)
+def dispatchers():
+    yield
+    jobs.stop_dispatchers()
+
+
+def test_enqueue_dedup(store):
+    job, created = store.enqueue("purge", "en.wikipedia.org")
+    assert created
+    assert job.status == "queued"
+
+    again, created = store.enqueue("purge", "en.wikipedia.org")
+    assert not created
+    assert again == job
+
+    other, created = store.enqueue("purge", "de.wikipedia.org")
+    assert created
+    assert other.id != job.id
+
+
+def test_enqueue_after_finish(store):
+    job, _ = store.enqueue("purge", "en.wikipedia.org")
+    store.finish(job.id, "done")
+    again, created = store.enqueue("purge", "en.wikipedia.org")
+    assert created
+    assert again.id != job.id
+    assert [j.id for j in store.list_jobs("en.wikipedia.org", "purge")] == [
+        again.id,
+        job.id,
+    ]
+
+
+def test_claim_limit(store):
+    first, _ = store.enqueue("purge", "en.wikipedia.org")
+    second, _ = store.enqueue("purge", "de.wikipedia.org")
+
+    claimed = store.claim("purge", 1)
+    assert claimed.id == first.id
+    assert claimed.status == "running"
+    assert claimed.started
+    assert store.claim("purge", 1) is None
+
+    store.finish(first.id, "done")
+    assert store.claim("purge", 1).id == second.id
+
+
+def test_reap(store):
+    job, _ = store.enqueue("purge", "en.wikipedia.org")
+    store.claim("purge", 1)
+    store.set_pid(job.id, 12345)
+    with mock.patch("jobs._pid_alive", return_value=True):
+        store.reap("purge")
+    assert store.get(job.id).status == "running"
+    with mock.patch("jobs._pid_alive", return_value=False):
+        store.reap("purge")
+    assert store.get(job.id).status == "failed"
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_running(tmp_path, fail):
+    path = str(tmp_path / jobs.JOBS_DB)
+    with jobs.JobStore(path) as store:
+        job, _ = store.enqueue("purge", "en.wikipedia.org")
+
+    if fail:
+        with pytest.raises(ValueError):
+            with jobs.running(path, job.id):
+                raise ValueError("Oops")
+    else:
+        with jobs.running(path, job.id):
+            pass
+
+    with jobs.JobStore(path) as store:
+        finished = store.get(job.id)
+    assert finished.status == ("failed" if fail else "done")
+    assert finished.finished
+    assert finished.result == ("Oops" if fail else None)
+
+
+def test_dispatch(tmp_path):
+    path = str(tmp_path / jobs.JOBS_DB)
+    with jobs.JobStore(path) as store:
+        job, _ = store.enqueue("purge", "en.wikipedia.org")
+        store.enqueue("purge", "de.wikipedia.org")
+
+    popen = mock.Mock()
+    popen.return_value.pid = 12345
+    with mock.patch("subprocess.Popen", popen):
+        jobs.dispatch(str(tmp_path), max_running=1)
+
+    popen.assert_called_once()
+    command = popen.call_args[0][0]
+    assert command[2:] == [
+        "en.wikipedia.org",
+        "--output",
+        str(tmp_path),
+        "--job",
+        str(job.id),
+        "--jobs-db",
+        path,
+    ]
+    with jobs.JobStore(path) as store:
+        assert store.get(job.id).status == "running"
+    jobs._children.clear()
+
+
+def test_dispatch_background(tmp_path):
+    path = str(tmp_path / jobs.JOBS_DB)
+    with jobs.JobStore(path) as store:
+        first, _ = store.enqueue("purge", "en.wikipedia.org")
+        second, _ = store.enqueue("purge", "de.wikipedia.org")
+
+    # Each job process exits at once, without finishing its job
+    real_popen = subprocess.Popen
+
+    def popen(command, **kwargs):
+        return real_popen([sys.executable, "-c", "pass"], **kwargs)
+
+    with mock.patch("jobs.DISPATCH_INTERVAL", 0.05), mock.patch(
+        "subprocess.Popen", side_effect=popen
+    ) as started:
+        jobs.dispatch(str(tmp_path), max_running=1)
+        assert started.call_count == 1
+        # No further requests: the queued job is started, and both are reaped
+        with jobs.JobStore(path) as store:
+            assert store.wait(second.id, timeout=10).status == "failed"
+            assert store.get(first.id).status == "failed"
+        assert started.call_count == 2
+        for _ in range(100):
+            if not jobs._dispatchers:
+                break
+            time.sleep(0.05)
+        assert not jobs._dispatchers
+
+
+def test_enqueue_check_concurrent(store):
+    first, created = store.enqueue("check", "en.wikipedia.org")
+    assert created
+    second, created = store.enqueue("check", "en.wikipedia.org")
+    assert created
+    assert second.id != first.id
+    assert store.count("check", "queued") == 2
+
+
+def test_submit(store, tmp_path):
+    job, _ = store.enqueue("check", "en.wikipedia.org")
+    future = jobs.submit(str(tmp_path / jobs.JOBS_DB), job, lambda: {"a": 1})
+    future.result(timeout=10)
+    done = store.wait(job.id, 10)
+    assert done.status == "done"
+    assert done.started
+    assert done.result == '{"a": 1}'
+
+
+def test_submit_failed(store, tmp_path):
+    def fail():
+        raise ValueError("Oops")
+
+    job, _ = store.enqueue("check", "en.wikipedia.org")
+    jobs.submit(str(tmp_path / jobs.JOBS_DB), job, fail).result(timeout=10)
+    failed = store.get(job.id)
+    assert failed.status == "failed"
+    assert failed.result == "Oops"
+
+
+def test_submit_concurrent(store, tmp_path):
+    def slow_executor(**kwargs):
+        # Long enough for the other requests to get there too
+        threading.Event().wait(0.1)
+        return mock.MagicMock()
+
+    job, _ = store.enqueue("check", "en.wikipedia.org")
+    with mock.patch.object(jobs, "_executor", None), mock.patch(
+        "concurrent.futures.ThreadPoolExecutor", side_effect=slow_executor
+    ) as executor:
+        threads = [
+            threading.Thread(
+                target=jobs.submit,
+                args=(str(tmp_path / jobs.JOBS_DB), job, lambda: None),
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    # One pool is shared by every request
+    executor.assert_called_once()
+
+
+def test_wait_timeout(store):
+    job, _ = store.enqueue("check", "en.wikipedia.org")
+    assert store.wait(job.id, 0.1, interval=0.05) == job
+
+
+def test_prune(store):
+    old, _ = store.enqueue("check", "en.wikipedia.org")
+    store.finish(old.id, "done")
+    unfinished, _ = store.enqueue("check", "en.wikipedia.org")
+    with mock.patch("jobs._now", return_value="2020-01-01T00:00:00"):
+        purge, _ = store.enqueue("purge", "en.wikipedia.org")
+        store.finish(purge.id, "done")
+        ancient, _ = store.enqueue("check", "en.wikipedia.org")
+        store.finish(ancient.id, "done")
+
+    store.prune("check", datetime.timedelta(days=1))
+    assert store.get(ancient.id) is None
+    assert store.get(old.id) is not None
+    assert store.get(unfinished.id) is not None
+    assert store.get(purge.id) is not None
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest  # type: ignore
+import os
+import sys
+import threading
+import types
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+import profiling  # noqa: E402
+
+
+@pytest.fixture
+def module():
+    module = types.ModuleType("fake")
+
+    def square(x):
+        return x * x
+
+    def count(n):
+        yield from range(n)
+
+    module.square = square
+    module.count = count
+    return module
+
+
+def test_collect(module):
+    square, count = module.square, module.count
+    targets = [dict(module=module, prefix="fake: ", names=["square", "count"])]
+    with profiling.collect(targets) as profile:
+        assert module.square(3) == 9
+        assert module.square(4) == 16
+        assert list(module.count(3)) == [0, 1, 2]
+    # The original functions are restored afterwards
+    assert module.square is square
+    assert module.count is count
+
+    data = profile.as_dict()
+    assert data["wall_time"] > 0
+    assert data["timings"].keys() == {"fake: square", "fake: count"}
+    assert data["timings"]["fake: square"]["calls"] == 2
+    assert data["timings"]["fake: count"]["calls"] == 1
+    assert profile.cprofile is None
+
+    table = profile.table().splitlines()
+    assert table[0].split() == ["Name", "Calls", "Seconds", "Mean", "ms", "%", "wall"]
+    assert {line.split(":")[0] for line in table[1:-1]} == {"fake"}
+    assert table[-1].startswith("Total")
+
+
+def test_collect_error(module):
+    def fail():
+        raise ValueError
+
+    module.fail = fail
+    with pytest.raises(ValueError):
+        with profiling.collect([dict(module=module, names=["fail"])]) as profile:
+            module.fail()
+    assert module.fail is fail
+    assert profile.as_dict()["timings"]["fail"]["calls"] == 1
+
+
+def test_collect_cprofile(module):
+    with profiling.collect([], cprofile=True) as profile:
+        module.square(2)
+    assert profile.cprofile is not None
+    assert profile.cprofile.getstats()
+
+
+@pytest.mark.parametrize(
+    "args,kwargs,expected",
+    [
+        (
+            ("get", "https://en.wikipedia.org/w/api.php"),
+            {"params": {"action": "expandtemplates", "text": "foo"}},
+            "GET en.wikipedia.org/w/api.php?action=expandtemplates",
+        ),
+        (
+            ("post", "https://en.wikipedia.org/w/api.php"),
+            {"data": {"action": "expandtemplates"}},
+            "POST en.wikipedia.org/w/api.php?action=expandtemplates",
+        ),
+        (
+            ("post", "https://en.wikipedia.org/api/rest_v1/transform/wikitext/to/lint"),
+            {"json": {"wikitext": "foo"}},
+            "POST en.wikipedia.org/api/rest_v1/transform/wikitext/to/lint",
+        ),
+    ],
+)
+def test_endpoint_name(args, kwargs, expected):
+    assert profiling.endpoint_name(*args, **kwargs) == expected
+
+
+def test_add_threads():
+    profile = profiling.Profile()
+
+    def add():
+        for _ in range(1000):
+            profile.add("check", 0.001)
+
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert profile.as_dict()["timings"]["check"]["calls"] == 8000
+    assert profile.as_dict()["timings"]["check"]["seconds"] == pytest.approx(8.0)
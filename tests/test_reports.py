@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest  # type: ignore
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+import reports  # noqa: E402
+
+
+@pytest.fixture
+def report():
+    return {
+        "errors": {"total": 3, "no-user-links": 2, "sig-too-long": 1},
+        "meta": {
+            "last_update": "2020-01-01T00:00:00",
+            "site": "en.wikipedia.org",
+            "active_since": "2019-12-01T00:00:00",
+        },
+        "sigs": {
+            "Example1": {"signature": "Example1", "errors": ["no-user-links"]},
+            "Example2": {
+                "signature": "a" * 300,
+                "errors": ["no-user-links", "sig-too-long"],
+            },
+            "Example3": {
+                "signature": "[[User:Foo]]",
+                "errors": ["no-user-links"],
+                "html_sig": '<a href="https://en.wikipedia.org/wiki/User:Foo">'
+                "User:Foo</a>",
+            },
+        },
+    }
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def opened(request, report, tmp_path):
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    if request.param == "sqlite":
+        reports.write_sqlite(report, str(tmp_path / "en.wikipedia.org.sqlite3"))
+    with reports.open_report(str(tmp_path), "en.wikipedia.org", request.param) as r:
+        yield r
+
+
+def test_open_report_backend(report, tmp_path):
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    r = reports.open_report(str(tmp_path), "en.wikipedia.org", "sqlite")
+    assert isinstance(r, reports.JSONReport)
+
+    reports.write_sqlite(report, str(tmp_path / "en.wikipedia.org.sqlite3"))
+    r = reports.open_report(str(tmp_path), "en.wikipedia.org", "sqlite")
+    assert isinstance(r, reports.SQLiteReport)
+    r.close()
+
+
+def test_open_report_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        reports.open_report(str(tmp_path), "en.wikipedia.org", "sqlite")
+
+
+def test_report_abstract():
+    class Incomplete(reports.Report):
+        def meta(self):
+            return {}
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_list_sites(report, tmp_path):
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    reports.write_sqlite(report, str(tmp_path / "en.wikipedia.org.sqlite3"))
+    (tmp_path / ("en.wikipedia.org" + reports.PROFILE_SUFFIX)).write_text("{}")
+    assert reports.list_sites(str(tmp_path)) == ["en.wikipedia.org"]
+
+
+def test_export(opened, report):
+    exported = opened.export()
+    assert exported["errors"] == report["errors"]
+    assert exported["meta"] == report["meta"]
+    assert exported["sigs"] == report["sigs"]
+    assert list(exported["sigs"]) == sorted(report["sigs"])
+
+
+def test_get_user(opened, report):
+    assert opened.get_user("Example2") == report["sigs"]["Example2"]
+    assert opened.get_user("Example4") is None
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected",
+    [
+        ({}, ["Example1", "Example2", "Example3"]),
+        ({"error": "sig-too-long"}, ["Example2"]),
+        ({"error": "no-user-links", "after": "Example1"}, ["Example2", "Example3"]),
+        ({"limit": 2}, ["Example1", "Example2"]),
+        ({"after": "Example1", "limit": 1}, ["Example2"]),
+        ({"error": "missing-end-tag"}, []),
+    ],
+)
+def test_iter_users(opened, kwargs, expected):
+    assert [user for user, info in opened.iter_users(**kwargs)] == expected
+
+
+def test_write_sqlite_replace(report, tmp_path):
+    path = str(tmp_path / "en.wikipedia.org.sqlite3")
+    reports.write_sqlite(report, path)
+    report["sigs"].pop("Example3")
+    report["errors"]["total"] = 2
+    report["errors"]["no-user-links"] = 1
+    reports.write_sqlite(report, path)
+    with reports.SQLiteReport(path) as r:
+        assert r.counts() == report["errors"]
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_merge_shards(report):
+    shards = []
+    for index, users in enumerate([["Example2"], ["Example3", "Example1"]]):
+        shard = {
+            "errors": {},
+            "meta": {**report["meta"], "shard": f"{index}/2"},
+            "sigs": {user: report["sigs"][user] for user in users},
+        }
+        shards.append(shard)
+    shards[1]["meta"]["last_update"] = "2020-01-01T01:00:00"
+
+    merged = reports.merge_shards(shards)
+    assert merged["errors"] == {"total": 3, "no-user-links": 3, "sig-too-long": 1}
+    assert list(merged["sigs"]) == ["Example1", "Example2", "Example3"]
+    assert merged["meta"] == {**report["meta"], "last_update": "2020-01-01T01:00:00"}
+
+    with pytest.raises(ValueError):
+        reports.merge_shards(shards[1:])
+
+
+def test_report_history(report, tmp_path):
+    path = str(tmp_path / ("en.wikipedia.org" + reports.HISTORY_SUFFIX))
+    second = {
+        "errors": {"total": 2, "no-user-links": 1, "sig-too-long": 1},
+        "meta": {**report["meta"], "last_update": "2020-01-08T00:00:00"},
+        "sigs": {
+            "Example2": {"signature": "a" * 300, "errors": ["sig-too-long"]},
+            "Example3": report["sigs"]["Example3"],
+        },
+    }
+    with reports.ReportHistory(path) as history:
+        assert history.add(report)
+        assert history.add(second)
+        # Already archived
+        assert not history.add(second)
+        # Example1 removed and Example2 changed, Example3 is not stored again
+        assert history.conn.execute(
+            "SELECT user_name, info IS NULL FROM changes WHERE run_id = 2 "
+            "ORDER BY user_name"
+        ).fetchall() == [("Example1", 1), ("Example2", 0)]
+
+    with reports.ReportHistory(path, readonly=True) as history:
+        assert [run["errors"] for run in history.runs()] == [
+            report["errors"],
+            second["errors"],
+        ]
+        assert history.runs()[1] == {
+            "run": 2,
+            "last_update": "2020-01-08T00:00:00",
+            "errors": second["errors"],
+        }
+        assert history.get(1).export() == report
+        assert history.get(2).export() == second
+        assert history.get(3) is None
+
+
+def test_report_history_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        reports.ReportHistory(str(tmp_path / "missing.sqlite3"), readonly=True)
+
+
+def test_partial_meta(report, tmp_path):
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    assert reports.partial_meta(str(tmp_path), "en.wikipedia.org") is None
+
+    meta = {**report["meta"], "partial": True, "progress": 0.25}
+    partial = tmp_path / "en.wikipedia.org.partial.json"
+    with partial.open("w") as f:
+        json.dump({**report, "meta": meta}, f)
+    assert reports.partial_meta(str(tmp_path), "en.wikipedia.org") == meta
+    assert reports.list_sites(str(tmp_path)) == ["en.wikipedia.org"]
+
+    # Left over from before the complete report was written
+    os.utime(partial, ns=(0, 0))
+    assert reports.partial_meta(str(tmp_path), "en.wikipedia.org") is None
+
+
+def test_partial_meta_stale(report, tmp_path):
+    report_path = tmp_path / "en.wikipedia.org.json"
+    with report_path.open("w") as f:
+        json.dump(report, f)
+    os.utime(report_path, ns=(0, 0))
+    partial = tmp_path / "en.wikipedia.org.partial.json"
+    meta = {**report["meta"], "partial": True, "progress": 0.25}
+    with partial.open("w") as f:
+        json.dump({**report, "meta": meta}, f)
+
+    # Not updated for too long, so left behind by a run that died
+    now = time.time()
+    os.utime(partial, (now, now - reports.PARTIAL_MAX_AGE + 60))
+    assert reports.partial_meta(str(tmp_path), "en.wikipedia.org") == meta
+    os.utime(partial, (now, now - reports.PARTIAL_MAX_AGE - 60))
+    assert reports.partial_meta(str(tmp_path), "en.wikipedia.org") is None
+
+    # Runs that publish on a timer go stale after a few of their intervals
+    meta["partial_interval"] = 60
+    with partial.open("w") as f:
+        json.dump({**report, "meta": meta}, f)
+    os.utime(partial, (now, now - 120))
+    assert reports.partial_meta(str(tmp_path), "en.wikipedia.org") == meta
+    os.utime(partial, (now, now - 240))
+    assert reports.partial_meta(str(tmp_path), "en.wikipedia.org") is None
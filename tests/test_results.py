@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import datetime
+import os
+import sys
+import unittest.mock as mock
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+import results  # noqa: E402
+
+
+def test_store(tmp_path):
+    path = str(tmp_path / results.RESULTS_DB)
+    with results.ResultStore(path) as store:
+        store.put_many("lint", {"<b>A": {"missing-end-tag"}, "''B''": set()}, "f1")
+        assert store.get_many("lint", ["<b>A", "''B''", "C"], "f1") == {
+            "<b>A": ["missing-end-tag"],
+            "''B''": [],
+        }
+        assert store.get_many("lint", ["<b>A"], "f2") == {}
+        assert store.get_many("other", ["<b>A"], "f1") == {}
+
+    # Results are kept between runs, until they are too old
+    with results.ResultStore(path) as store:
+        assert store.get_many("lint", ["<b>A"], "f1") == {"<b>A": ["missing-end-tag"]}
+    later = datetime.datetime.utcnow() + results.MAX_AGE + datetime.timedelta(days=1)
+    with mock.patch("results.datetime.datetime") as dt:
+        dt.utcnow.return_value = later
+        with results.ResultStore(path) as store:
+            assert store.get_many("lint", ["<b>A"], "f1") == {}
@@ -5,14 +5,24 @@
 
 import pytest  # type: ignore
 import unittest.mock as mock
+import argparse
+import contextlib
+import dataclasses
+import gzip
 import json
 import os
+import re
 import sys
+import threading
+import time
 
 sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
 import sigprobs  # noqa: E402
-from datatypes import SigError, Checks  # noqa: E402
+from datatypes import SigError, Checks, SiteData  # noqa: E402
 import datasources  # noqa: E402
+import reports  # noqa: E402
+import datatypes  # noqa: E402
+import results  # noqa: E402
 
 
 @pytest.fixture(
@@ -482,7 +492,15 @@ def devnull():
     [
         (
             ["en.wikipedia.org", "--days", "60"],
-            [mock.call("en.wikipedia.org", days=60, checks=Checks.DEFAULT, data=None)],
+            [
+                mock.call(
+                    "en.wikipedia.org",
+                    days=60,
+                    checks=Checks.DEFAULT,
+                    data=None,
+                    render=False,
+                )
+            ],
             [mock.call("", "en.wikipedia.org", True)],
         ),
         (
@@ -493,28 +511,66 @@ def devnull():
                     days=30,
                     checks=Checks.LINT | Checks.LINKS,
                     data=None,
+                    render=False,
+                )
+            ],
+            [mock.call("", "en.wikipedia.org", True)],
+        ),
+        (
+            ["en.wikipedia.org", "--render"],
+            [
+                mock.call(
+                    "en.wikipedia.org",
+                    days=30,
+                    checks=Checks.DEFAULT,
+                    data=None,
+                    render=True,
                 )
             ],
             [mock.call("", "en.wikipedia.org", True)],
         ),
         (
             ["en.wikipedia.org", "--output", "data.json"],
-            [mock.call("en.wikipedia.org", days=30, checks=Checks.DEFAULT, data=None)],
+            [
+                mock.call(
+                    "en.wikipedia.org",
+                    days=30,
+                    checks=Checks.DEFAULT,
+                    data=None,
+                    render=False,
+                )
+            ],
             [mock.call("data.json", "en.wikipedia.org", True)],
         ),
         (
             ["en.wikipedia.org", "--output", "data.json", "--no-overwrite"],
-            [mock.call("en.wikipedia.org", days=30, checks=Checks.DEFAULT, data=None)],
+            [
+                mock.call(
+                    "en.wikipedia.org",
+                    days=30,
+                    checks=Checks.DEFAULT,
+                    data=None,
+                    render=False,
+                )
+            ],
             [mock.call("data.json", "en.wikipedia.org", False)],
         ),
         (
             ["de.wikipedia.org", "en.wikipedia.org", "--output", "de.json", "en.json"],
             [
                 mock.call(
-                    "de.wikipedia.org", days=30, checks=Checks.DEFAULT, data=None
+                    "de.wikipedia.org",
+                    days=30,
+                    checks=Checks.DEFAULT,
+                    data=None,
+                    render=False,
                 ),
                 mock.call(
-                    "en.wikipedia.org", days=30, checks=Checks.DEFAULT, data=None
+                    "en.wikipedia.org",
+                    days=30,
+                    checks=Checks.DEFAULT,
+                    data=None,
+                    render=False,
                 ),
             ],
             [
@@ -542,7 +598,7 @@ def test_handle_args_input(tmp_path, data):
         json.dump(data, f)
     cliargs, kwargs, ofargs = (
         ["en.wikipedia.org", "--input", str(path)],
-        {"days": 30, "checks": Checks.DEFAULT, "data": data},
+        {"days": 30, "checks": Checks.DEFAULT, "data": data, "render": False},
         ("", "en.wikipedia.org", True),
     )
     output_file = mock.MagicMock(__enter__=devnull())
@@ -600,3 +656,840 @@ def test_handle_args_validation(args, expected):
         with mock.patch("sigprobs.main", main):
             with pytest.raises(expected):
                 sigprobs.handle_args(args)
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_write_report(tmp_path, backend):
+    result = {
+        "errors": {"total": 1, "no-user-links": 1},
+        "meta": {"last_update": "2020-01-01T00:00:00", "site": "en.wikipedia.org"},
+        "sigs": {"Example": {"signature": "Example", "errors": ["no-user-links"]}},
+    }
+    with mock.patch("sigprobs.load_config", return_value={"report_backend": backend}):
+        sigprobs.write_report(result, str(tmp_path), "en.wikipedia.org", True)
+
+    with (tmp_path / "en.wikipedia.org.json").open() as f:
+        assert json.load(f) == result
+    with gzip.open(tmp_path / "en.wikipedia.org.json.gz") as f:
+        assert json.load(f) == result
+    with gzip.open(tmp_path / "en.wikipedia.org.error.json.gz") as f:
+        assert json.load(f) == {
+            "errors": {"no-user-links": ["Example"]},
+            "meta": result["meta"],
+        }
+    assert (tmp_path / "en.wikipedia.org.sqlite3").exists() is (backend == "sqlite")
+    with reports.ReportHistory(
+        str(tmp_path / "en.wikipedia.org.history.sqlite3")
+    ) as history:
+        assert history.get(1).export() == result
+
+
+@pytest.fixture
+def local_sitedata():
+    return SiteData(
+        user={"User"},
+        user_talk={"User talk"},
+        file={"File"},
+        special={"Special"},
+        contribs={"contribs"},
+        subst=["subst:", "safesubst:"],
+        dbname="enwiki",
+        hostname="en.wikipedia.org",
+    )
+
+
+@pytest.fixture
+def expandtemplates():
+    """Fake expandtemplates, which expands {{t}} and swallows after {{eat}}"""
+
+    def expand(method, url, output, params=None, data=None):
+        text = (params or data)["text"]
+        text = re.sub(r"\{\{eat\}\}\n[^\n]*\n", "", text)
+        return {"expandtemplates": {"wikitext": text.replace("{{t}}", "T")}}
+
+    with sigprobs.subst_cache(), mock.patch(
+        "datasources.backoff_retry", side_effect=expand
+    ) as m:
+        yield m
+
+
+def test_evaluate_subst_batch(expandtemplates, local_sitedata):
+    sigs = ["[[User:A]] {{subst:t}}", "{{t}}\n{{t}}", "Plain", " {{t}} "]
+    sigprobs.evaluate_subst_batch(sigs, local_sitedata)
+    expandtemplates.assert_called_once()
+    assert expandtemplates.call_args.args[0] == "post"
+
+    expected = ["[[User:A]] T", "T\nT", "Plain", " T "]
+    assert [sigprobs.evaluate_subst(sig, local_sitedata) for sig in sigs] == expected
+    expandtemplates.assert_called_once()
+
+
+def test_evaluate_subst_batch_disturbed(expandtemplates, local_sitedata):
+    sigs = ["{{t}}1", "{{eat}}", "{{t}}2", "<nowiki>{{t}}3", "{{t}}4"]
+    sigprobs.evaluate_subst_batch(sigs, local_sitedata)
+    # The signature after {{eat}} lost its marker, and the unclosed nowiki
+    # tag is never batched, so those are expanded individually
+    assert [call.args[0] for call in expandtemplates.call_args_list] == [
+        "post",
+        "get",
+        "get",
+        "get",
+    ]
+    expandtemplates.reset_mock()
+    assert [sigprobs.evaluate_subst(sig, local_sitedata) for sig in sigs] == [
+        "T1",
+        "{{eat}}",
+        "T2",
+        "<nowiki>T3",
+        "T4",
+    ]
+    expandtemplates.assert_not_called()
+
+
+def test_evaluate_subst_no_templates(expandtemplates, local_sitedata):
+    assert sigprobs.evaluate_subst("[[User:A|subst:A]]", local_sitedata) == (
+        "[[User:A|A]]"
+    )
+    sigprobs.evaluate_subst_batch(["[[User:A]]", "''A''"], local_sitedata)
+    expandtemplates.assert_not_called()
+
+
+def test_main_batched_expansion(expandtemplates, local_sitedata):
+    data = {f"Example{i}": f"[[User:Example{i}]] {{{{t}}}}" for i in range(0, 3)}
+    data["Example3"] = "{{t}}"
+    with mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch("sigprobs.get_lint_errors", return_value=set()):
+        resultdata = sigprobs.main("en.wikipedia.org", data=data)
+
+    assert resultdata["sigs"] == {
+        "Example3": {"signature": "{{t}}", "errors": ["no-user-links"]}
+    }
+    # One request for the whole chunk, instead of several per signature
+    expandtemplates.assert_called_once()
+    # The run's expansions were kept in its own cache
+    assert not sigprobs._subst_cache.get()
+
+
+def test_main_expansion_entities(expandtemplates, local_sitedata):
+    data = {"Example1": "&#91;&#91;User:Example1]] {{t}}", "Example2": "{{t}}"}
+    with mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch("sigprobs.get_lint_errors", return_value=set()), mock.patch(
+        "sigprobs.batch_check_lint", side_effect=lambda a, r, *args: ({}, r)
+    ) as batch_check_lint:
+        sigprobs.main("en.wikipedia.org", data=data)
+
+    # The checks of the unescaped signature use the prefetched expansion
+    expandtemplates.assert_called_once()
+    assert batch_check_lint.call_args.args[0]["Example1"] == "[[User:Example1]] T"
+
+
+def test_subst_cache_threads(expandtemplates, local_sitedata):
+    sigprobs.evaluate_subst_batch(["{{t}}1", "{{t}}2"], local_sitedata)
+    assert len(sigprobs._subst_cache.get()) == 2
+
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(sigprobs._subst_cache.get()))
+    thread.start()
+    thread.join()
+    assert seen == [None]
+
+
+@pytest.fixture
+def parsoid():
+    """Fake Parsoid, which renders ''x'' and leaves <b> open to the line end"""
+
+    def render(method, url, json):
+        text = re.sub(r"''(.*?)''", r"<i>\1</i>", json["wikitext"])
+        if text.count("<b>") > text.count("</b>"):
+            text += "</b>"
+        text = text.replace("[[User:Foo]]", '<a href="./User:Foo">User:Foo</a>')
+        return f'<p id="mwAQ">{text}</p>'
+
+    with mock.patch("datasources.backoff_retry", side_effect=render) as m:
+        yield m
+
+
+def test_render_sigs(parsoid, local_sitedata):
+    sigs = {
+        "A": "''A''",
+        "B": "[[User:Foo]]",
+        "C": "<b>C",
+        "D": "''D''",
+    }
+    rendered = sigprobs.render_sigs(sigs, local_sitedata)
+    assert rendered == {
+        "A": "<i>A</i>",
+        "B": '<a href="https://en.wikipedia.org/wiki/User:Foo">User:Foo</a>',
+        "C": "<b>C</b>",
+        "D": "<i>D</i>",
+    }
+    # <b> was not closed within C, so C was rendered again on its own
+    assert len(parsoid.call_args_list) == 2
+    assert parsoid.call_args.kwargs["json"]["wikitext"] == "<b>C"
+
+
+def test_main_render(parsoid, local_sitedata):
+    data = {"Example1": "''Example1''", "Example2": "[[User:Example2]]"}
+    with mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch("sigprobs.get_lint_errors", return_value=set()), mock.patch(
+        "sigprobs.evaluate_subst", side_effect=lambda text, sitedata: text
+    ):
+        resultdata = sigprobs.main("en.wikipedia.org", data=data, render=True)
+    assert resultdata["sigs"] == {
+        "Example1": {
+            "signature": "''Example1''",
+            "errors": ["no-user-links"],
+            "html_sig": "<i>Example1</i>",
+        }
+    }
+
+
+@pytest.mark.parametrize("cprofile", [False, True])
+def test_handle_args_profile(tmp_path, cprofile, capsys):
+    def main(hostname, **kwargs):
+        sigprobs.check_length("a" * 300)
+        return ""
+
+    args = ["en.wikipedia.org", "--output", str(tmp_path)]
+    args.append("--cprofile" if cprofile else "--profile")
+    check_length = sigprobs.check_length
+    with mock.patch("sigprobs.main", main):
+        sigprobs.handle_args(args)
+    assert sigprobs.check_length is check_length
+
+    with (tmp_path / "en.wikipedia.org.profile.json").open() as f:
+        profile = json.load(f)
+    assert profile["site"] == "en.wikipedia.org"
+    assert profile["timings"]["check: check_length"]["calls"] == 1
+    assert "check: check_length" in capsys.readouterr().err
+    assert (tmp_path / "en.wikipedia.org.pstats").exists() == cprofile
+
+
+def test_estimate(local_sitedata):
+    sigs = [
+        ("Plain", "Plain"),
+        ("Links", "[[User:Links]]"),
+        ("Template", "[[User:Template]] {{subst:t}}"),
+    ]
+    config = {"request_latency": 1, "check_concurrency": 3}
+    with mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch("datasources.count_active_user_sigs", return_value=400), mock.patch(
+        "datasources.sample_active_user_sigs", return_value=sigs
+    ) as sample, mock.patch(
+        "datasources.backoff_retry"
+    ) as backoff_retry, mock.patch(
+        "sigprobs.load_config", return_value=config
+    ):
+        result = sigprobs.estimate("en.wikipedia.org", sample_size=3, shard=(1, 4))
+        config["http"] = {"rate_limit": 2}
+        limited = sigprobs.estimate("en.wikipedia.org", sample_size=3)
+    backoff_retry.assert_not_called()
+    # The sample is drawn from all of the shard's blocks
+    assert sample.call_args_list[0].args[3:] == (3, range(1, 100, 4))
+
+    assert result["candidates"] == 100
+    assert result["sample"] == 3
+    assert result["sample_errors"] == {"plain-fancy-sig": 1}
+    # A third of 100 need expanding, in 2 chunks of 50
+    assert result["requests"]["expandtemplates"] == {"min": 2, "max": 4}
+    # Two thirds of 100 are linted, 5 to a batch
+    assert result["requests"]["lint"] == {"min": 14, "max": 81}
+    # The individual lint requests are made 3 at a time
+    assert result["concurrency"] == 3
+    assert result["seconds"] == {"min": 16.0, "max": 40.3}
+
+    assert limited["rate_limit"] == 2.0
+    # 337 requests at 2 per second take longer than the latency allows for
+    assert limited["seconds"]["max"] == 168.5
+
+
+def test_estimate_input_sample(local_sitedata):
+    data = {f"Example{i}": f"[[User:Example{i}]]" for i in range(100)}
+    with mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch("sigprobs.load_config", return_value={}):
+        result = sigprobs.estimate("en.wikipedia.org", data=data, sample_size=10)
+    assert result["candidates"] == 100
+    assert result["sample"] == 10
+    # Spread over the input, rather than its first entries
+    assert sigprobs._sample_sigs(local_sitedata, "", 30, data, None, 10)[-1] == (
+        "Example90",
+        "[[User:Example90]]",
+    )
+
+
+def test_handle_args_estimate(capsys):
+    with mock.patch("sigprobs.main") as main, mock.patch(
+        "sigprobs.estimate", return_value={"site": "en.wikipedia.org"}
+    ) as estimate, mock.patch("sigprobs.write_report") as write_report:
+        sigprobs.handle_args(["en.wikipedia.org", "--estimate"])
+    main.assert_not_called()
+    write_report.assert_not_called()
+    assert estimate.call_args.args == ("en.wikipedia.org",)
+    assert json.loads(capsys.readouterr().out) == {"site": "en.wikipedia.org"}
+
+
+@pytest.mark.parametrize("value", ["0/1", "3/4", "99/100"])
+def test_parse_shard(value):
+    index, count = value.split("/")
+    assert sigprobs.parse_shard(value) == (int(index), int(count))
+
+
+@pytest.mark.parametrize("value", ["1", "a/b", "4/4", "-1/4", "0/101"])
+def test_parse_shard_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        sigprobs.parse_shard(value)
+
+
+def test_sigsource_shard(local_sitedata):
+    data = {f"Example{i}": f"[[User:Example{i}]]" for i in range(0, 20)}
+    parts = [
+        dict(sigprobs._sigsource(local_sitedata, "", 30, data, (index, 3)))
+        for index in range(3)
+    ]
+    assert all(parts)
+    assert sum(len(part) for part in parts) == len(data)
+    assert {user: sig for part in parts for user, sig in part.items()} == data
+
+    with mock.patch("datasources.iter_active_user_sigs") as active:
+        sigprobs._sigsource(local_sitedata, "", 30, None, (1, 3))
+    assert list(active.call_args.args[3]) == list(range(1, 100, 3))
+
+
+def test_handle_args_shard_merge(tmp_path, local_sitedata):
+    data = {f"Example{i}": f"Example{i}" for i in range(0, 10)}
+    data["Example5"] = "[[User:Example5]]"
+    path = tmp_path / "data.json"
+    with path.open("w") as f:
+        json.dump(data, f)
+
+    args = ["en.wikipedia.org", "--input", str(path), "--output", str(tmp_path)]
+    with mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch("sigprobs.get_lint_errors", return_value=set()):
+        for index in range(3):
+            sigprobs.handle_args(args + ["--shard", f"{index}/3", "--run-id", "x"])
+        with pytest.raises(FileNotFoundError):
+            sigprobs.handle_args(args + ["--merge", "3"])
+        sigprobs.handle_args(args + ["--merge", "3", "--run-id", "x"])
+        expected = sigprobs.main("en.wikipedia.org", data=data)
+
+    with (tmp_path / "en.wikipedia.org.json").open() as f:
+        merged = json.load(f)
+    assert merged["errors"] == expected["errors"]
+    assert merged["sigs"] == expected["sigs"]
+    assert "shard" not in merged["meta"]
+    assert (tmp_path / "en.wikipedia.org.json.gz").exists()
+    assert not list((tmp_path / "shards").iterdir())
+
+
+def test_main_result_store(tmp_path, local_sitedata, expandtemplates):
+    data = {"Example1": "<b>[[User:Example1]]", "Example2": "[[User:Example2]]"}
+    config = {"result_store": str(tmp_path / "results.sqlite3")}
+
+    def lint(sig, sitedata, checks):
+        errors = set()
+        if "<b>" in sig:
+            errors.add(SigError.MISSING_END_TAG)
+        if "<font>" in sig and checks & Checks.OBSOLETE_TAG:
+            errors.add(SigError.OBSOLETE_FONT_TAG)
+        return errors
+
+    with mock.patch("sigprobs.load_config", return_value=config), mock.patch(
+        "sigprobs.get_lint_errors", side_effect=lint
+    ) as get_lint_errors:
+        with mock.patch("datasources.get_site_data", return_value=local_sitedata):
+            first = sigprobs.main("en.wikipedia.org", data=data)
+        assert get_lint_errors.call_count == 3
+
+        # Another site with the same configuration reuses the results
+        get_lint_errors.reset_mock()
+        simple = dataclasses.replace(
+            local_sitedata, hostname="simple.wikipedia.org", dbname="simplewiki"
+        )
+        data["Example3"] = "<font>[[User:Example3]]</font>"
+        with mock.patch("datasources.get_site_data", return_value=simple):
+            second = sigprobs.main("simple.wikipedia.org", data=data)
+        assert {call.args[0] for call in get_lint_errors.call_args_list} == {
+            data["Example3"]
+        }
+
+    assert second["sigs"] == first["sigs"]
+    assert first["sigs"]["Example1"]["errors"] == ["missing-end-tag"]
+
+
+def test_batch_check_lint_unknown_error(tmp_path, local_sitedata):
+    store = results.ResultStore(str(tmp_path / "results.sqlite3"))
+    sigs = {"Example1": "<b>[[User:Example1]]", "Example2": "[[User:Example2]]"}
+    # Stored by a version with an error that no longer exists
+    store.put_many(
+        "lint",
+        {sigs["Example1"]: {"removed-error"}, sigs["Example2"]: set()},
+        local_sitedata.fingerprint,
+    )
+    with mock.patch(
+        "sigprobs.get_lint_errors", return_value={SigError.MISSING_END_TAG}
+    ) as get_lint_errors:
+        _, resultdata = sigprobs.batch_check_lint(
+            dict(sigs), datatypes.SigRecords(), local_sitedata, Checks.DEFAULT, store
+        )
+
+    # Linted again instead of failing the run, and the stored result replaced
+    assert {call.args[0] for call in get_lint_errors.call_args_list} == {
+        sigs["Example1"]
+    }
+    assert resultdata.errors("Example1") == [SigError.MISSING_END_TAG]
+    assert store.get_many("lint", [sigs["Example1"]], local_sitedata.fingerprint) == {
+        sigs["Example1"]: ["missing-end-tag"]
+    }
+    store.close()
+
+
+def test_main_publish(local_sitedata, expandtemplates):
+    data = {
+        "Example1": "<b>[[User:Example1]]",
+        "Example2": "[[User:Example2]]",
+        "Example3": "<b>[[User:Example3]]",
+    }
+    publish = mock.Mock()
+    with mock.patch(
+        "sigprobs.load_config", return_value={"partial_every": 2}
+    ), mock.patch(
+        "sigprobs.get_lint_errors",
+        side_effect=lambda sig, sitedata, checks: (
+            {SigError.MISSING_END_TAG} if "<b>" in sig else set()
+        ),
+    ), mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch(
+        "sigprobs.SUBST_BATCH_SIZE", 1
+    ):
+        result = sigprobs.main("en.wikipedia.org", data=data, publish=publish)
+
+    publish.assert_called_once()
+    partial = publish.call_args.args[0]
+    assert partial["meta"]["partial"] is True
+    assert partial["meta"]["progress"] == 0.6667
+    assert "partial_interval" not in partial["meta"]
+    # Example1 is still waiting to be linted
+    assert partial["sigs"] == {}
+    assert "partial" not in result["meta"]
+    assert list(result["sigs"]) == ["Example1", "Example3"]
+
+
+def test_main_delta(tmp_path, local_sitedata, expandtemplates):
+    path = str(tmp_path / "en.wikipedia.org.active.sqlite3")
+    with mock.patch("sigprobs.load_config", return_value={}), mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch(
+        "datasources.db.iter_recent_editors",
+        return_value=[("Example1", "20200110000000")],
+    ) as recent, mock.patch(
+        "datasources.db.iter_user_sigs", return_value=[]
+    ) as user_sigs:
+        result = sigprobs.main(
+            "en.wikipedia.org",
+            lastedit="20200101000000",
+            active_path=path,
+            since="20200105000000",
+        )
+
+    assert recent.call_args.args == ("enwiki", "20200104000000")
+    assert user_sigs.call_args.args[1] == ["Example1"]
+    assert result["meta"]["high_water_mark"] == "20200110000000"
+
+
+def test_handle_args_delta(tmp_path):
+    report = {"meta": {"last_update": "", "high_water_mark": "20200110000000"}}
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    main = mock.MagicMock(return_value={})
+    with mock.patch("sigprobs.main", main), mock.patch(
+        "sigprobs.write_report"
+    ), mock.patch("sigprobs.load_config", return_value={}):
+        sigprobs.handle_args(["en.wikipedia.org", "--delta", "--output", str(tmp_path)])
+        sigprobs.handle_args(["de.wikipedia.org", "--delta", "--output", str(tmp_path)])
+
+    assert main.call_args_list[0].kwargs["since"] == "20200110000000"
+    assert main.call_args_list[0].kwargs["active_path"] == str(
+        tmp_path / "en.wikipedia.org.active.sqlite3"
+    )
+    # No previous report
+    assert main.call_args_list[1].kwargs["since"] == ""
+
+    with pytest.raises(SystemExit):
+        sigprobs.handle_args(["en.wikipedia.org", "--delta", "--shard", "0/2"])
+
+
+def test_write_partial(tmp_path):
+    result = {
+        "errors": {"total": 0},
+        "meta": {"last_update": "2020-01-01T00:00:00", "site": "en.wikipedia.org"},
+        "sigs": {},
+    }
+    partial = {**result, "meta": {**result["meta"], "partial": True, "progress": 0.5}}
+    sigprobs.write_partial(partial, str(tmp_path), "en.wikipedia.org")
+    with (tmp_path / "en.wikipedia.org.partial.json").open() as f:
+        assert json.load(f) == partial
+
+    # Removed once the complete report is written
+    with mock.patch("sigprobs.load_config", return_value={}):
+        sigprobs.write_report(result, str(tmp_path), "en.wikipedia.org", True)
+    assert not (tmp_path / "en.wikipedia.org.partial.json").exists()
+
+
+def test_handle_args_failed_partial(tmp_path):
+    def fail(hostname, publish, **kwargs):
+        publish({"errors": {"total": 0}, "meta": {"partial": True}, "sigs": {}})
+        raise RuntimeError("Oops")
+
+    with mock.patch("sigprobs.main", side_effect=fail), mock.patch(
+        "sigprobs.load_config", return_value={"partial_every": 10}
+    ):
+        with pytest.raises(RuntimeError):
+            sigprobs.handle_args(["en.wikipedia.org", "--output", str(tmp_path)])
+    # A run that failed is not shown as in progress
+    assert not (tmp_path / "en.wikipedia.org.partial.json").exists()
+
+
+@pytest.mark.parametrize(
+    "user,sig,expected",
+    [
+        ("Example", "[[User talk:Example]]", None),
+        ("Example", "[[special:contribs/Example]]", None),
+        ("Example", "[[meta:User:Example]]", SigError.INTERWIKI_USER_LINK),
+        ("Example", "[[User:Example2]]", SigError.LINK_USER_MISMATCH),
+        ("(:Example:)", "[[User:(:Example:)|(:Example:)]]", None),
+        ("(:Example:)", "[[Special:contribs/(:Example:)]]", None),
+        ("(:Example:)", "[[meta:User:(:Example:)]]", SigError.INTERWIKI_USER_LINK),
+        ("(:Example:)", "[[User:Example]]", SigError.LINK_USER_MISMATCH),
+    ],
+)
+def test_check_links_local(user, sig, expected, local_sitedata):
+    assert sigprobs.check_links(user, sig, local_sitedata) == expected
+
+
+@pytest.fixture
+def recorded_checks():
+    """Replace the checks with mocks that record the order they are called in"""
+    calls = []
+    names = [
+        "check_links",
+        "check_length",
+        "check_fanciness",
+        "get_lint_errors",
+        "check_tildes",
+        "check_post_subst_length",
+        "check_impersonation",
+        "check_pipes",
+        "check_line_breaks",
+    ]
+    with contextlib.ExitStack() as stack:
+        mocks = {}
+        for name in names:
+            mocks[name] = stack.enter_context(
+                mock.patch(
+                    f"sigprobs.{name}",
+                    side_effect=lambda *args, _name=name: calls.append(_name),
+                )
+            )
+        yield calls, mocks
+
+
+def test_check_sig_cost_order(recorded_checks, local_sitedata):
+    calls, mocks = recorded_checks
+    checks = Checks.DEFAULT | Checks.FREE_PIPES | Checks.LINK_NAME
+    errors = sigprobs.check_sig(
+        "Example", "''Ex''", local_sitedata, "", checks, workers=1
+    )
+    assert errors == set()
+    # Local checks first, then those that parse, then the network checks
+    assert calls[:4] == [
+        "check_length",
+        "check_fanciness",
+        "check_pipes",
+        "check_line_breaks",
+    ]
+    assert sorted(calls[4:]) == sorted(
+        [
+            "check_links",
+            "get_lint_errors",
+            "check_tildes",
+            "check_post_subst_length",
+            "check_impersonation",
+        ]
+    )
+
+
+def test_check_sig_needs(recorded_checks, local_sitedata):
+    calls, mocks = recorded_checks
+    mocks["check_length"].side_effect = None
+    mocks["check_length"].return_value = SigError.SIG_TOO_LONG
+    mocks["check_links"].side_effect = None
+    mocks["check_links"].return_value = SigError.NO_USER_LINKS
+    errors = sigprobs.check_sig("Example", "''Ex''", local_sitedata, "")
+    assert errors == {SigError.SIG_TOO_LONG, SigError.NO_USER_LINKS}
+    # Too long already, so not worth expanding to check again
+    mocks["check_post_subst_length"].assert_not_called()
+
+    mocks["check_fanciness"].side_effect = None
+    mocks["check_fanciness"].return_value = SigError.PLAIN_FANCY_SIG
+    calls.clear()
+    errors = sigprobs.check_sig("Example", "Ex", local_sitedata, "")
+    # Links are still checked, but a plain signature has no links to find
+    assert errors == {SigError.SIG_TOO_LONG, SigError.PLAIN_FANCY_SIG}
+    assert mocks["check_links"].call_count == 2
+    assert calls == []
+
+
+def test_check_sig_first_error(recorded_checks, local_sitedata):
+    calls, mocks = recorded_checks
+    mocks["check_tildes"].side_effect = None
+    mocks["check_tildes"].return_value = SigError.NESTED_SUBST
+    errors = sigprobs.check_sig(
+        "Example", "''Ex''", local_sitedata, "", first_error=True
+    )
+    assert errors == {SigError.NESTED_SUBST}
+    assert calls[-1] == "get_lint_errors"
+    mocks["check_post_subst_length"].assert_not_called()
+
+
+def test_schedule():
+    def spec(flag, cost, needs=Checks(0)):
+        return sigprobs.CheckSpec(flag, cost, needs, lambda u, s, d, c: None)
+
+    links = spec(Checks.LINKS, sigprobs.Cost.NETWORK, Checks.BREAKS)
+    breaks = spec(Checks.BREAKS, sigprobs.Cost.PARSE, Checks.LENGTH)
+    length = spec(Checks.LENGTH, sigprobs.Cost.PARSE)
+    fancy = spec(Checks.FANCY, sigprobs.Cost.LOCAL)
+    # Needs come first, whatever the order they are listed in
+    assert sigprobs._schedule([links, breaks, length, fancy]) == [
+        fancy,
+        length,
+        breaks,
+        links,
+    ]
+
+    with pytest.raises(ValueError):
+        sigprobs._schedule([links, breaks])
+    with pytest.raises(ValueError):
+        sigprobs._schedule(
+            [links, spec(Checks.BREAKS, sigprobs.Cost.NETWORK), length, fancy]
+        )
+    with pytest.raises(ValueError):
+        sigprobs._schedule(
+            [
+                spec(Checks.LENGTH, sigprobs.Cost.LOCAL, Checks.FANCY),
+                spec(Checks.FANCY, sigprobs.Cost.LOCAL, Checks.LENGTH),
+            ]
+        )
+
+
+def test_check_sig_parallel(local_sitedata):
+    # Each check waits for the other, so they must run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def check(*args):
+        barrier.wait()
+
+    with mock.patch("sigprobs.check_links", side_effect=check), mock.patch(
+        "sigprobs.check_tildes", side_effect=check
+    ):
+        errors = sigprobs.check_sig(
+            "Example",
+            "''Ex''",
+            local_sitedata,
+            "",
+            checks=Checks.LINKS | Checks.NESTED_SUBST,
+        )
+    assert errors == set()
+
+
+def test_follow(tmp_path, local_sitedata, expandtemplates, sse_server):
+    report = {
+        "errors": {"total": 2, "missing-end-tag": 2},
+        "meta": {"last_update": "2020-01-01T00:00:00", "site": "en.wikipedia.org"},
+        "sigs": {
+            "Example1": {
+                "signature": "<b>[[User:Example1]]",
+                "errors": ["missing-end-tag"],
+            },
+            "Example2": {
+                "signature": "<b>[[User:Example2]]",
+                "errors": ["missing-end-tag"],
+            },
+        },
+    }
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+
+    def change(user, namespace=3, server_name="en.wikipedia.org"):
+        return {
+            "type": "edit",
+            "namespace": namespace,
+            "server_name": server_name,
+            "user": user,
+        }
+
+    url, headers = sse_server(
+        [
+            [
+                ("[1]", change("Example1")),
+                ("[2]", change("Example3")),
+                ("[3]", change("192.0.2.1")),
+                ("[4]", change("Example4", namespace=0)),
+                ("[5]", change("Example5", server_name="de.wikipedia.org")),
+                ("[6]", change("Example1", namespace=4)),
+            ]
+        ]
+    )
+    props = {
+        "Example1": datatypes.UserProps(nickname="[[User:Example1]]", fancysig=True),
+        "Example3": datatypes.UserProps(nickname="<b>[[User:Example3]]", fancysig=True),
+    }
+    with mock.patch("sigprobs.load_config", return_value={}), mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch(
+        "datasources.get_users_properties",
+        side_effect=lambda users, dbname: {user: props[user] for user in users},
+    ) as get_users_properties, mock.patch(
+        "sigprobs.get_lint_errors",
+        side_effect=lambda sig, sitedata, checks: (
+            {SigError.MISSING_END_TAG} if "<b>" in sig else set()
+        ),
+    ):
+        sigprobs.follow("en.wikipedia.org", str(tmp_path), url=url, retry=None)
+
+    # Only registered users' discussion edits on the site, each checked once
+    get_users_properties.assert_called_once_with(["Example1", "Example3"], "enwiki")
+    assert "Last-Event-ID" not in headers[0]
+    with (tmp_path / "en.wikipedia.org.json").open() as f:
+        result = json.load(f)
+    # Example1 fixed their signature, Example2 was not checked
+    assert list(result["sigs"]) == ["Example2", "Example3"]
+    assert result["errors"] == {"total": 2, "missing-end-tag": 2}
+    assert result["meta"]["last_event_id"] == "[6]"
+    assert result["meta"]["last_update"] > report["meta"]["last_update"]
+    # Updates are not archived
+    assert not (tmp_path / "en.wikipedia.org.history.sqlite3").exists()
+
+    # The stream is resumed after the last event in the report
+    url, headers = sse_server([[]])
+    with mock.patch("sigprobs.load_config", return_value={}), mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ):
+        sigprobs.follow("en.wikipedia.org", str(tmp_path), url=url, retry=None)
+    assert headers[0]["Last-Event-ID"] == "[6]"
+
+
+def test_follow_reload(tmp_path, local_sitedata, expandtemplates, sse_server):
+    path = tmp_path / "en.wikipedia.org.json"
+    stale = {
+        "errors": {"total": 1, "missing-end-tag": 1},
+        "meta": {"last_update": "2020-01-01T00:00:00"},
+        "sigs": {
+            "Example2": {
+                "signature": "<b>[[User:Example2]]",
+                "errors": ["missing-end-tag"],
+            }
+        },
+    }
+    fresh = {
+        "errors": {"total": 1, "missing-end-tag": 1},
+        "meta": {"last_update": "2020-01-08T00:00:00"},
+        "sigs": {
+            "Example4": {
+                "signature": "<b>[[User:Example4]]",
+                "errors": ["missing-end-tag"],
+            }
+        },
+    }
+    with path.open("w") as f:
+        json.dump(stale, f)
+    change = {
+        "type": "edit",
+        "namespace": 3,
+        "server_name": "en.wikipedia.org",
+        "user": "Example1",
+    }
+    url, headers = sse_server([[("[1]", change)]])
+    check_users = sigprobs.check_users
+
+    def full_run_finishes(*args, **kwargs):
+        # A full run writes its report while the batch is being checked
+        with path.open("w") as f:
+            json.dump(fresh, f)
+        os.utime(path, ns=(0, 0))
+        return check_users(*args, **kwargs)
+
+    props = {
+        "Example1": datatypes.UserProps(nickname="<b>[[User:Example1]]", fancysig=True)
+    }
+    with mock.patch("sigprobs.load_config", return_value={}), mock.patch(
+        "datasources.get_site_data", return_value=local_sitedata
+    ), mock.patch("datasources.get_users_properties", return_value=props), mock.patch(
+        "sigprobs.get_lint_errors", return_value={SigError.MISSING_END_TAG}
+    ), mock.patch(
+        "sigprobs.check_users", side_effect=full_run_finishes
+    ):
+        sigprobs.follow("en.wikipedia.org", str(tmp_path), url=url, retry=None)
+
+    with path.open() as f:
+        result = json.load(f)
+    # Merged into the full run's report, not the one read at startup
+    assert list(result["sigs"]) == ["Example1", "Example4"]
+    assert result["errors"] == {"total": 2, "missing-end-tag": 2}
+    assert result["meta"]["last_event_id"] == "[1]"
+
+
+def test_follow_quiet(tmp_path, local_sitedata, expandtemplates, sse_server):
+    report = {"errors": {"total": 0}, "meta": {"last_update": ""}, "sigs": {}}
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    change = {
+        "type": "edit",
+        "namespace": 3,
+        "server_name": "en.wikipedia.org",
+        "user": "Example1",
+    }
+    # One edit, then nothing until the stream is closed
+    url, headers = sse_server([[("[1]", change)]], hold=3)
+    written = []
+    start = time.monotonic()
+    props = {
+        "Example1": datatypes.UserProps(nickname="<b>[[User:Example1]]", fancysig=True)
+    }
+    with mock.patch(
+        "sigprobs.load_config", return_value={"follow_interval": 0.2}
+    ), mock.patch("datasources.get_site_data", return_value=local_sitedata), mock.patch(
+        "datasources.get_users_properties", return_value=props
+    ), mock.patch(
+        "sigprobs.get_lint_errors", return_value={SigError.MISSING_END_TAG}
+    ), mock.patch(
+        "sigprobs.write_report",
+        side_effect=lambda result, *args, **kwargs: written.append(
+            (time.monotonic() - start, list(result["sigs"]))
+        ),
+    ):
+        sigprobs.follow("en.wikipedia.org", str(tmp_path), url=url, retry=None)
+
+    # The batch was written on time, while the stream was still open
+    assert len(written) == 1
+    assert written[0][0] < 2
+    assert written[0][1] == ["Example1"]
+
+
+def test_handle_args_follow(tmp_path):
+    with mock.patch("sigprobs.follow") as follow:
+        sigprobs.handle_args(
+            ["en.wikipedia.org", "--follow", "--output", str(tmp_path)]
+        )
+    assert follow.call_args.args[:2] == ("en.wikipedia.org", str(tmp_path))
+
+    for extra in (["de.wikipedia.org"], ["--delta"], ["--shard", "0/2"]):
+        with pytest.raises(SystemExit):
+            sigprobs.handle_args(["en.wikipedia.org", "--follow", *extra])
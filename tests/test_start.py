@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import json
+import os
+import sys
+import unittest.mock as mock
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
+import sigprobs_start  # noqa: E402
+
+# Runs sigprobs.py without network access, using fixed site data and no lint
+SIGPROBS = """
+import sys
+sys.path.insert(0, {src!r})
+import datasources
+import sigprobs
+from datatypes import SiteData
+
+datasources.get_site_data = lambda hostname: SiteData(
+    user={{"User"}},
+    user_talk={{"User talk"}},
+    file={{"File"}},
+    special={{"Special"}},
+    contribs={{"contribs"}},
+    subst=["subst:"],
+    dbname="enwiki",
+    hostname=hostname,
+)
+sigprobs.get_lint_errors = lambda *args: set()
+sigprobs.handle_args(sys.argv[1:])
+"""
+
+
+def test_start_jobs():
+    with mock.patch("sigprobs_start.apply", return_value=0) as apply:
+        sigprobs_start.main(["en.wikipedia.org", "--shards", "2", "--days", "7"])
+    configs = [call.args[0] for call in apply.call_args_list]
+    names = [config["metadata"]["name"] for config in configs]
+    run_id = names[0].split("-")[1]
+    assert names == [f"signatures.sigprobs-{run_id}-{i}" for i in ("0", "1", "merge")]
+
+    args = [
+        config["spec"]["template"]["spec"]["containers"][0]["args"]
+        for config in configs
+    ]
+    assert args[0] == [
+        "en.wikipedia.org",
+        "--days",
+        "7",
+        "--shard",
+        "0/2",
+        "--run-id",
+        run_id,
+    ]
+    assert args[2][:7] == [
+        "en.wikipedia.org",
+        "--days",
+        "7",
+        "--merge",
+        "2",
+        "--run-id",
+        run_id,
+    ]
+    assert "--wait" in args[2]
+
+
+def test_start_jobs_unsharded():
+    with mock.patch("sigprobs_start.apply", return_value=0) as apply:
+        sigprobs_start.main(["en.wikipedia.org"])
+    config = apply.call_args.args[0]
+    assert config["metadata"]["name"] == "signatures.sigprobs"
+    assert config["spec"]["template"]["spec"]["containers"][0]["args"] == [
+        "en.wikipedia.org"
+    ]
+
+
+def test_run_local(tmp_path):
+    script = tmp_path / "sigprobs.py"
+    script.write_text(
+        SIGPROBS.format(src=os.path.realpath(os.path.dirname(__file__) + "/../src"))
+    )
+    data = {f"Example{i}": f"Example{i}" for i in range(0, 10)}
+    data["Example5"] = "[[User:Example5]]"
+    with (tmp_path / "data.json").open("w") as f:
+        json.dump(data, f)
+
+    args = [
+        "en.wikipedia.org",
+        "--input",
+        str(tmp_path / "data.json"),
+        "--output",
+        str(tmp_path),
+    ]
+    returncode = sigprobs_start.run_local(
+        args, 4, "test", command=[sys.executable, str(script)]
+    )
+    assert returncode == 0
+
+    with (tmp_path / "en.wikipedia.org.json").open() as f:
+        report = json.load(f)
+    assert report["errors"] == {"total": 9, "plain-fancy-sig": 9}
+    assert list(report["sigs"]) == sorted(set(data) - {"Example5"})
@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest  # type: ignore
+import unittest.mock as mock
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import sys
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../src"))
+import app  # noqa: E402
+from web import resources  # noqa: E402
+import reports  # noqa: E402
+from datatypes import SigError, SiteData, UserCheck, UserProps  # noqa: E402
+
+
+@pytest.fixture
+def report():
+    return {
+        "errors": {"total": 2, "no-user-links": 2, "sig-too-long": 1},
+        "meta": {
+            "last_update": "2020-01-01T00:00:00",
+            "site": "en.wikipedia.org",
+            "active_since": "2019-12-01T00:00:00",
+        },
+        "sigs": {
+            "Example 2": {
+                "signature": "a" * 300,
+                "errors": ["no-user-links", "sig-too-long"],
+            },
+            "Example1": {
+                "signature": "Example1",
+                "errors": ["no-user-links"],
+                "html_sig": "<b>Example1</b>",
+            },
+        },
+    }
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def flask_app(request, report, tmp_path):
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    reports.write_sqlite(report, str(tmp_path / "en.wikipedia.org.sqlite3"))
+
+    flask_app = app.create_app()[0]
+    flask_app.config["TESTING"] = True
+    flask_app.config["data_dir"] = str(tmp_path)
+    flask_app.config["report_backend"] = request.param
+    return flask_app
+
+
+@pytest.fixture
+def client(flask_app):
+    with flask_app.test_client() as client:
+        yield client
+
+
+def test_api_reports(client):
+    res = client.get("/api/v1/reports")
+    assert res.json == ["en.wikipedia.org"]
+
+
+def test_api_reports_site(client, report):
+    res = client.get("/api/v1/reports/en.wikipedia.org")
+    assert res.status_code == 200
+    assert res.json == report
+
+
+def test_api_reports_site_missing(client):
+    res = client.get("/api/v1/reports/de.wikipedia.org")
+    assert res.status_code == 404
+
+
+def test_api_reports_site_errors(client, report):
+    res = client.get("/api/v1/reports/en.wikipedia.org/error")
+    assert res.json == {
+        "errors": {
+            "no-user-links": ["Example 2", "Example1"],
+            "sig-too-long": ["Example 2"],
+        },
+        "meta": report["meta"],
+    }
+
+
+@pytest.mark.parametrize(
+    "out_format,expected",
+    [
+        ("plain", "Example 2\nExample1"),
+        (
+            "massmessage",
+            "User talk:Example 2@en.wikipedia.org\n"
+            "User talk:Example1@en.wikipedia.org",
+        ),
+    ],
+)
+def test_api_reports_site_single_error(client, out_format, expected):
+    res = client.get(
+        "/api/v1/reports/en.wikipedia.org/error/no-user-links?format=" + out_format
+    )
+    assert res.status_code == 200
+    assert res.get_data(as_text=True) == expected
+
+
+def test_api_reports_site_single_error_invalid(client):
+    res = client.get("/api/v1/reports/en.wikipedia.org/error/missing-end-tag")
+    assert res.status_code == 400
+
+
+@pytest.mark.parametrize("username", ["Example 2", "example_2"])
+def test_api_reports_site_user(client, report, username):
+    res = client.get(f"/api/v1/reports/en.wikipedia.org/user/{username}")
+    assert res.status_code == 200
+    assert res.json["username"] == "Example 2"
+    assert res.json["errors"] == report["sigs"]["Example 2"]["errors"]
+    assert res.json["signature"] == report["sigs"]["Example 2"]["signature"]
+
+
+def test_api_reports_site_user_missing(client):
+    res = client.get("/api/v1/reports/en.wikipedia.org/user/Example3")
+    assert res.status_code == 404
+
+
+def test_report_site(client):
+    res = client.get("/reports/en.wikipedia.org")
+    assert res.status_code == 200
+    assert b"Example1" in res.data
+    # Rendered signatures are included as-is, and missing ones are skipped
+    assert res.data.count(b"<b>Example1</b>") == 1
+
+
+def test_api_reports_site_paginated(client, report):
+    res = client.get("/api/v1/reports/en.wikipedia.org?limit=1")
+    assert res.status_code == 200
+    assert list(res.json["sigs"]) == ["Example 2"]
+    assert res.json["continue"] == {"after": "Example 2"}
+    assert res.json["errors"] == report["errors"]
+
+    res = client.get("/api/v1/reports/en.wikipedia.org?limit=1&after=Example 2")
+    assert list(res.json["sigs"]) == ["Example1"]
+    assert "continue" not in res.json
+
+
+@pytest.mark.parametrize("limit", ["0", "-1", "foo"])
+def test_api_reports_site_bad_limit(client, limit):
+    res = client.get(f"/api/v1/reports/en.wikipedia.org?limit={limit}")
+    assert res.status_code == 400
+
+
+def test_api_reports_site_single_error_paginated(client):
+    res = client.get(
+        "/api/v1/reports/en.wikipedia.org/error/no-user-links?limit=1&after=Example 2"
+    )
+    assert res.json["errors"] == ["Example1"]
+    assert "continue" not in res.json
+
+    res = client.get("/api/v1/reports/en.wikipedia.org/error/no-user-links?limit=1")
+    assert res.json["errors"] == ["Example 2"]
+    assert res.json["continue"] == {"after": "Example 2"}
+
+
+def test_api_reports_site_ndjson(client, report):
+    res = client.get("/api/v1/reports/en.wikipedia.org?format=ndjson")
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    assert res.is_streamed
+    lines = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    assert lines == [
+        {"username": user, **info} for user, info in report["sigs"].items()
+    ]
+
+
+def test_api_reports_site_csv(client, report):
+    res = client.get("/api/v1/reports/en.wikipedia.org?format=csv")
+    assert res.status_code == 200
+    assert res.mimetype == "text/csv"
+    rows = list(csv.reader(io.StringIO(res.get_data(as_text=True))))
+    assert rows == [
+        ["username", "errors", "signature"],
+        ["Example 2", "no-user-links sig-too-long", "a" * 300],
+        ["Example1", "no-user-links", "Example1"],
+    ]
+
+
+def test_report_site_paginated(client):
+    res = client.get("/reports/en.wikipedia.org?limit=1")
+    assert res.status_code == 200
+    assert b"Example 2" in res.data
+    assert b"Example1</th>" not in res.data
+    assert b"after=Example+2" in res.data
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "/api/v1/reports/en.wikipedia.org",
+        "/api/v1/reports/en.wikipedia.org/error",
+        "/api/v1/reports/en.wikipedia.org/error/no-user-links",
+        "/api/v1/reports/en.wikipedia.org/user/Example1",
+        "/reports/en.wikipedia.org",
+    ],
+)
+def test_conditional_etag(client, url):
+    res = client.get(url)
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+    assert res.headers["Last-Modified"] == "Wed, 01 Jan 2020 00:00:00 GMT"
+
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.headers["ETag"] == etag
+    assert not res.data
+
+    res = client.get(url, headers={"If-None-Match": '"foo"'})
+    assert res.status_code == 200
+
+
+@pytest.mark.parametrize(
+    "since,expected",
+    [
+        ("Wed, 01 Jan 2020 00:00:00 GMT", 304),
+        ("Thu, 02 Jan 2020 00:00:00 GMT", 304),
+        ("Tue, 31 Dec 2019 00:00:00 GMT", 200),
+    ],
+)
+def test_conditional_modified_since(client, since, expected):
+    res = client.get(
+        "/api/v1/reports/en.wikipedia.org", headers={"If-Modified-Since": since}
+    )
+    assert res.status_code == expected
+
+
+def test_conditional_report_changed(client, report, tmp_path):
+    etag = client.get("/api/v1/reports/en.wikipedia.org").headers["ETag"]
+    report["meta"]["last_update"] = "2020-01-08T00:00:00"
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    reports.write_sqlite(report, str(tmp_path / "en.wikipedia.org.sqlite3"))
+
+    res = client.get(
+        "/api/v1/reports/en.wikipedia.org", headers={"If-None-Match": etag}
+    )
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+
+
+@pytest.mark.parametrize(
+    "url,suffix",
+    [
+        ("/api/v1/reports/en.wikipedia.org", ".json.gz"),
+        ("/api/v1/reports/en.wikipedia.org/error", ".error.json.gz"),
+    ],
+)
+def test_precompressed(client, report, tmp_path, url, suffix):
+    plain = client.get(url)
+    reports.write_gzip(
+        json.dumps(plain.json), str(tmp_path / f"en.wikipedia.org{suffix}")
+    )
+
+    res = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert res.status_code == 200
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.headers["Vary"] == "Accept-Encoding"
+    assert json.loads(gzip.decompress(res.data)) == plain.json
+    assert res.headers["ETag"] != plain.headers["ETag"]
+
+    res = client.get(
+        url, headers={"Accept-Encoding": "gzip", "If-None-Match": res.headers["ETag"]}
+    )
+    assert res.status_code == 304
+
+    res = client.get(url + "?limit=1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in res.headers
+
+
+def test_precompressed_stale(client, report, tmp_path):
+    path = tmp_path / "en.wikipedia.org.json.gz"
+    reports.write_gzip(json.dumps(report), str(path))
+    os.utime(path, ns=(0, 0))
+    res = client.get(
+        "/api/v1/reports/en.wikipedia.org", headers={"Accept-Encoding": "gzip"}
+    )
+    assert "Content-Encoding" not in res.headers
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "/api/v1/reports/en.wikipedia.org?purge=true",
+        "/api/v1/reports/en.wikipedia.org/error?purge=true",
+        "/api/v1/reports/en.wikipedia.org/error/no-user-links?purge=true",
+    ],
+)
+def test_purge_queued(client, url):
+    with mock.patch("datasources.get_sitematrix", return_value=["en.wikipedia.org"]):
+        with mock.patch("jobs.dispatch") as dispatch:
+            res = client.get(url)
+            again = client.get(url)
+
+    assert res.status_code == 202
+    assert res.json["status"] == "queued"
+    assert res.json["site"] == "en.wikipedia.org"
+    assert res.headers["Location"].endswith("/api/v1/reports/en.wikipedia.org/jobs")
+    assert again.json["id"] == res.json["id"]
+    dispatch.assert_called()
+
+    with mock.patch("jobs.dispatch"):
+        res = client.get("/api/v1/reports/en.wikipedia.org/jobs")
+    assert [job["id"] for job in res.json] == [again.json["id"]]
+
+
+def test_purge_fresh(client, report, tmp_path):
+    report["meta"]["last_update"] = datetime.datetime.utcnow().isoformat()
+    with (tmp_path / "en.wikipedia.org.json").open("w") as f:
+        json.dump(report, f)
+    with mock.patch("jobs.dispatch") as dispatch:
+        res = client.get("/api/v1/reports/en.wikipedia.org?purge=true")
+        post = client.post("/api/v1/reports/en.wikipedia.org/jobs")
+    assert res.status_code == 200
+    assert res.json["sigs"] == report["sigs"]
+    assert post.status_code == 409
+    dispatch.assert_not_called()
+
+
+def test_purge_unknown_site(client):
+    with mock.patch("datasources.get_sitematrix", return_value=[]):
+        with mock.patch("jobs.dispatch"):
+            res = client.post("/api/v1/reports/en.wikipedia.org/jobs")
+    assert res.status_code == 404
+
+
+@pytest.fixture
+def bulk_sitedata():
+    return SiteData(
+        user={"User"},
+        user_talk={"User talk"},
+        file={"File"},
+        special={"Special"},
+        contribs={"contribs"},
+        subst=["subst:"],
+        dbname="enwiki",
+        hostname="en.wikipedia.org",
+    )
+
+
+@pytest.fixture
+def bulk_mocks(bulk_sitedata):
+    props = {
+        "Example": UserProps(nickname="[[User:Example]]", fancysig=True),
+        "Missing": UserProps(nickname="", fancysig=False),
+        "Default": UserProps(nickname="", fancysig=False),
+    }
+    with mock.patch(
+        "datasources.get_sitematrix", return_value=["en.wikipedia.org"]
+    ), mock.patch(
+        "datasources.get_site_data", return_value=bulk_sitedata
+    ) as get_site_data, mock.patch(
+        "datasources.get_site_replag", return_value=datetime.timedelta(0)
+    ), mock.patch(
+        "datasources.get_users_properties",
+        side_effect=lambda users, dbname: {user: props[user] for user in users},
+    ) as get_users_properties, mock.patch(
+        "datasources.check_users_exist", return_value={"Default"}
+    ) as check_users_exist, mock.patch(
+        "web.resources.get_default_sig",
+        return_value="[[User:$1|$2]] ([[User talk:$1|talk]])",
+    ) as get_default_sig, mock.patch(
+        "sigprobs.evaluate_subst", side_effect=lambda text, sitedata: text
+    ), mock.patch(
+        "sigprobs.get_lint_errors", return_value=set()
+    ) as get_lint_errors:
+        yield {
+            "get_site_data": get_site_data,
+            "get_users_properties": get_users_properties,
+            "check_users_exist": check_users_exist,
+            "get_default_sig": get_default_sig,
+            "get_lint_errors": get_lint_errors,
+        }
+
+
+def test_api_bulk_check(client, bulk_mocks):
+    body = [
+        "Example",
+        "missing",
+        {"username": "Default"},
+        ["Example_2", "Example 2"],
+        {"username": "Example3", "signature": "[[User:Example3]]" + "a" * 300},
+    ]
+    res = client.post("/api/v1/check/en.wikipedia.org", json=body)
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in res.data.decode().splitlines()]
+    assert [line["username"] for line in lines] == [
+        "Example",
+        "Missing",
+        "Default",
+        "Example 2",
+        "Example3",
+    ]
+    results = {line["username"]: line for line in lines}
+    assert results["Example"]["errors"] == ["no-errors"]
+    assert results["Missing"]["errors"] == ["user-does-not-exist"]
+    assert results["Missing"]["failure"] is True
+    assert results["Default"]["errors"] == ["default-sig"]
+    assert results["Default"]["signature"] == (
+        "[[User:Default|Default]] ([[User talk:Default|talk]])"
+    )
+    assert results["Example 2"]["errors"] == ["plain-fancy-sig"]
+    assert results["Example3"]["errors"] == ["sig-too-long"]
+
+    # Site setup and lookups happen once for the whole request
+    bulk_mocks["get_site_data"].assert_called_once()
+    bulk_mocks["get_users_properties"].assert_called_once_with(
+        ["Example", "Missing", "Default"], "enwiki"
+    )
+    bulk_mocks["check_users_exist"].assert_called_once_with(
+        ["Missing", "Default"], mock.ANY
+    )
+    bulk_mocks["get_default_sig"].assert_called_once()
+    bulk_mocks["get_lint_errors"].assert_called_once()
+
+
+def test_api_bulk_check_duplicate_users(client, bulk_mocks):
+    bulk_mocks["get_lint_errors"].side_effect = lambda sig, sitedata, checks: (
+        {SigError.MISSING_END_TAG} if "<b>" in sig else set()
+    )
+    body = [
+        {"username": "Example", "signature": "<b>[[User:Example]]"},
+        {"username": "Example", "signature": "[[User:Example]]"},
+    ]
+    res = client.post("/api/v1/check/en.wikipedia.org", json=body)
+    assert res.status_code == 200
+    lines = [json.loads(line) for line in res.data.decode().splitlines()]
+    # Each variant gets the lint errors of its own signature
+    assert [(line["signature"], line["errors"]) for line in lines] == [
+        ("<b>[[User:Example]]", ["missing-end-tag"]),
+        ("[[User:Example]]", ["no-errors"]),
+    ]
+
+
+def test_api_bulk_check_object(client, bulk_mocks):
+    res = client.post("/api/v1/check/en.wikipedia.org", json={"users": ["Example"]})
+    assert res.status_code == 200
+    assert json.loads(res.data)["errors"] == ["no-errors"]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"user": "Example"},
+        "Example",
+        [1],
+        [["Example"]],
+        [{"signature": "Example"}],
+        ["Example|"],
+    ],
+)
+def test_api_bulk_check_invalid(client, bulk_mocks, body):
+    res = client.post("/api/v1/check/en.wikipedia.org", json=body)
+    assert res.status_code == 400
+
+
+def test_api_bulk_check_too_many(client, flask_app, bulk_mocks):
+    flask_app.config["max_bulk_check"] = 2
+    res = client.post(
+        "/api/v1/check/en.wikipedia.org", json=["Example", "Example", "Example"]
+    )
+    assert res.status_code == 400
+
+
+def test_api_bulk_check_unknown_site(client, bulk_mocks):
+    res = client.post("/api/v1/check/de.wikipedia.org", json=["Example"])
+    assert res.status_code == 404
+
+
+@pytest.fixture
+def check_result():
+    return UserCheck(
+        site="en.wikipedia.org",
+        username="Example",
+        errors=[SigError.NO_USER_LINKS],
+        signature="Example",
+        failure=None,
+        html_sig="<p>Example</p>",
+        replag="",
+    )
+
+
+def test_api_check_async(client, check_result):
+    with mock.patch(
+        "datasources.get_sitematrix", return_value=["en.wikipedia.org"]
+    ), mock.patch("web.resources.check_user", return_value=check_result) as check:
+        res = client.post(
+            "/api/v1/check/en.wikipedia.org/Example", data={"signature": "Example"}
+        )
+        assert res.status_code == 202
+        assert res.json["status"] in {"queued", "running", "done"}
+        location = res.headers["Location"]
+        assert location.endswith(f"/api/v1/check/jobs/{res.json['id']}")
+
+        res = client.get(location, query_string={"wait": 10})
+    assert res.status_code == 200
+    assert res.json["status"] == "done"
+    assert res.json["result"] == {
+        **check_result._asdict(),
+        "errors": ["no-user-links"],
+    }
+    check.assert_called_once_with("en.wikipedia.org", "Example", "Example")
+
+
+def test_api_check_async_failed(client):
+    with mock.patch(
+        "datasources.get_sitematrix", return_value=["en.wikipedia.org"]
+    ), mock.patch("web.resources.check_user", side_effect=ConnectionError("Down")):
+        res = client.post("/api/v1/check/en.wikipedia.org/Example")
+        res = client.get(res.headers["Location"], query_string={"wait": 10})
+    assert res.json["status"] == "failed"
+    assert res.json["result"] == "Down"
+
+
+def test_api_check_async_invalid(client):
+    with mock.patch("datasources.get_sitematrix", return_value=["en.wikipedia.org"]):
+        assert client.post("/api/v1/check/en.wikipedia.org/Ex|ample").status_code == 400
+        assert client.post("/api/v1/check/de.wikipedia.org/Example").status_code == 404
+
+
+def test_api_check_async_queue_full(client, flask_app):
+    flask_app.config["max_queued_checks"] = 0
+    with mock.patch("datasources.get_sitematrix", return_value=["en.wikipedia.org"]):
+        res = client.post("/api/v1/check/en.wikipedia.org/Example")
+    assert res.status_code == 503
+
+
+def test_api_check_job_missing(client):
+    assert client.get("/api/v1/check/jobs/1234").status_code == 404
+
+
+@pytest.fixture
+def filter_page_mocks():
+    resources._filter_page_cache.clear()
+    lines = [
+        "# {{#target:User talk:Example1}}",
+        "* [[User_talk:Example 2]]",
+        "Not a target: User:Example3",
+    ]
+    with mock.patch(
+        "datasources.get_latest_revid", return_value=100
+    ) as revid, mock.patch(
+        "datasources.backoff_retry", side_effect=lambda *args, **kwargs: iter(lines)
+    ) as fetch:
+        yield revid, fetch
+    resources._filter_page_cache.clear()
+
+
+def test_filter_page(filter_page_mocks):
+    revid, fetch = filter_page_mocks
+    url = "https://meta.wikimedia.org/wiki/Global_message_delivery/Targets/Test"
+    assert resources.filter_page(url) == {"Example1", "Example 2"}
+    revid.assert_called_once_with(
+        "meta.wikimedia.org", "Global_message_delivery/Targets/Test"
+    )
+    assert fetch.call_args.args[1] == url + "?action=raw&oldid=100"
+
+    # Unchanged pages are not fetched again
+    assert resources.filter_page(url) == {"Example1", "Example 2"}
+    assert fetch.call_count == 1
+
+    revid.return_value = 101
+    resources.filter_page(url)
+    assert fetch.call_count == 2
+    assert fetch.call_args.args[1] == url + "?action=raw&oldid=101"
+
+
+def test_filter_page_oldid(filter_page_mocks):
+    revid, fetch = filter_page_mocks
+    url = "https://meta.wikimedia.org/w/index.php?title=Test&oldid=50"
+    assert resources.filter_page(url) == {"Example1", "Example 2"}
+    # The requested revision is fetched, not the latest one
+    revid.assert_not_called()
+    assert fetch.call_args.args[1] == (
+        "https://meta.wikimedia.org/w/index.php?title=Test&oldid=50&action=raw"
+    )
+    assert resources.filter_page(url) == {"Example1", "Example 2"}
+    assert fetch.call_count == 1
+
+
+def test_filter_page_no_title(filter_page_mocks):
+    revid, fetch = filter_page_mocks
+    url = "https://meta.wikimedia.org/w/index.php?curid=1"
+    assert resources.filter_page(url) == {"Example1", "Example 2"}
+    assert resources.filter_page(url) == {"Example1", "Example 2"}
+    revid.assert_not_called()
+    assert fetch.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "url", ["http://meta.wikimedia.org/wiki/Test", "https://example.com/wiki/Test"]
+)
+def test_filter_page_unsafe(filter_page_mocks, url):
+    revid, fetch = filter_page_mocks
+    assert resources.filter_page(url) == set()
+    fetch.assert_not_called()
+
+
+def test_api_reports_site_single_error_filter_page(client, filter_page_mocks):
+    res = client.get(
+        "/api/v1/reports/en.wikipedia.org/error/no-user-links",
+        query_string={"filter_page": "https://meta.wikimedia.org/wiki/Test"},
+    )
+    assert res.json["errors"] == []
+
+
+def test_api_reports_site_history(client, flask_app, report):
+    res = client.get("/api/v1/reports/en.wikipedia.org/history")
+    assert res.status_code == 404
+
+    path = os.path.join(
+        flask_app.config["data_dir"], "en.wikipedia.org" + reports.HISTORY_SUFFIX
+    )
+    with reports.ReportHistory(path) as history:
+        history.add(report)
+        history.add(
+            {
+                "errors": {"total": 1, "sig-too-long": 1},
+                "meta": {**report["meta"], "last_update": "2020-01-08T00:00:00"},
+                "sigs": {
+                    "Example 2": {"signature": "a" * 300, "errors": ["sig-too-long"]}
+                },
+            }
+        )
+
+    res = client.get("/api/v1/reports/en.wikipedia.org/history?error=no-user-links")
+    assert res.status_code == 200
+    assert res.json == {
+        "site": "en.wikipedia.org",
+        "runs": [
+            {
+                "run": 1,
+                "last_update": "2020-01-01T00:00:00",
+                "errors": {"total": 2, "no-user-links": 2},
+            },
+            {
+                "run": 2,
+                "last_update": "2020-01-08T00:00:00",
+                "errors": {"total": 1, "no-user-links": 0},
+            },
+        ],
+    }
+
+    res = client.get("/api/v1/reports/en.wikipedia.org/history/1")
+    assert res.json == report
+    res = client.get("/api/v1/reports/en.wikipedia.org/history/3")
+    assert res.status_code == 404
+
+
+def test_report_site_partial(client, flask_app, report):
+    res = client.get("/reports/en.wikipedia.org")
+    assert b"progress-bar" not in res.data
+    etag = res.headers["ETag"]
+
+    meta = {**report["meta"], "last_update": "2020-01-02T00:00:00"}
+    path = os.path.join(flask_app.config["data_dir"], "en.wikipedia.org.partial.json")
+    with open(path, "w") as f:
+        json.dump({**report, "meta": {**meta, "partial": True, "progress": 0.25}}, f)
+
+    res = client.get("/reports/en.wikipedia.org", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert b'style="width: 25%"' in res.data
@@ -15,3 +15,6 @@ pip install --upgrade pip wheel poetry
 poetry install --no-root --only main
 
 deactivate
+
+# Record the checked out commit for the webservice's footer
+git rev-parse --short HEAD > VERSION